@@ -0,0 +1,317 @@
+"""
+    This module contains the anchor fitting of the
+    Faster RCNN model.
+
+    All the boxes of the annotations are read from the
+    compiled annotation index as one array and scaled to
+    the resolution the model resizes the images to. The
+    widths and heights are clustered with k-means using
+    1 - IoU as the distance, and the clusters are turned
+    into the anchor sizes of the FPN levels and the shared
+    aspect ratios of `AnchorGenerator`.
+
+    Running the module prints the box histograms, compares
+    the proposed anchors with the torchvision defaults and
+    saves them to anchors.json, which `faster_rcnn` accepts:
+
+        python anchors.py
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from src.annotation_index import AnnotationIndex
+from src.config import ANNOTATION_DIR, ANNOTATION_INDEX_PATH
+
+ANCHORS_PATH = "anchors.json"
+# The resizing of torchvision detection models
+MIN_SIZE = 800
+MAX_SIZE = 1333
+# The anchors of torchvision fasterrcnn_resnet50_fpn
+DEFAULT_ANCHORS = {
+    "sizes": [[32], [64], [128], [256], [512]],
+    "aspect_ratios": [[.5, 1., 2.]] * 5,
+}
+
+
+def load_boxes(annotation_dir=ANNOTATION_DIR, index_path=ANNOTATION_INDEX_PATH,
+               min_size=MIN_SIZE, max_size=MAX_SIZE):
+    """
+        Reads the widths and heights of all the annotated
+        boxes, scaled like the model scales their images.
+
+        Args:
+            annotation_dir (str): Folder of the XML annotations
+            index_path (str): Path to the compiled index
+            min_size (int): Shorter image side of the model
+            max_size (int): Longest image side of the model
+
+        Returns:
+            (N, 2) float array of box widths and heights
+    """
+    arrays = AnnotationIndex.load(annotation_dir, index_path).arrays
+    boxes = arrays["boxes"].astype(np.float64)
+    sizes = arrays["sizes"].astype(np.float64)
+    # The boxes of the images without a size cannot be
+    # scaled like the model scales them
+    known = (sizes > 0).all(axis=1)
+    sizes[~known] = 1
+
+    # The scale of every image, repeated for its boxes
+    scales = np.minimum(min_size / sizes.min(axis=1), max_size / sizes.max(axis=1))
+    counts = np.diff(arrays["offsets"])
+    scales = np.repeat(scales, counts)
+    known = np.repeat(known, counts)
+
+    wh = np.abs(boxes[:, 2:] - boxes[:, :2]) * scales[:, None]
+    # Degenerate boxes have no shape to fit
+    return wh[known & (wh > 0).all(axis=1)]
+
+
+def histograms(wh, bins=10):
+    """
+        Computes the histograms of the box sizes, the square
+        root of the area, and the aspect ratios, height per
+        width, on logarithmic bins.
+
+        Args:
+            wh (ndarray): (N, 2) box widths and heights
+            bins (int): Number of bins
+
+        Returns:
+            Dictionary of (counts, bin edges) per statistic
+    """
+    statistics = {
+        "size": np.sqrt(wh.prod(axis=1)),
+        "aspect_ratio": wh[:, 1] / wh[:, 0],
+    }
+    result = {}
+    for name, values in statistics.items():
+        edges = np.geomspace(values.min(), values.max() * (1 + 1e-9), bins + 1)
+        result[name] = np.histogram(values, edges)
+    return result
+
+
+def print_histograms(wh, bins=10, width=50):
+    """
+        Prints the histograms as text bars.
+
+        Args:
+            wh (ndarray): (N, 2) box widths and heights
+            bins (int): Number of bins
+            width (int): Characters of the longest bar
+    """
+    for name, (counts, edges) in histograms(wh, bins).items():
+        print(f"Box {name.replace('_', ' ')}:")
+        for count, low, high in zip(counts, edges, edges[1:]):
+            bar = "#" * int(round(width * count / max(counts.max(), 1)))
+            print(f"    {low:8.2f} - {high:8.2f} {count:8d} {bar}")
+
+
+def wh_iou(wh, centroids):
+    """
+        Computes the IoU of every box and centroid shape
+        when they are aligned to the same corner.
+
+        Args:
+            wh (ndarray): (N, 2) widths and heights
+            centroids (ndarray): (K, 2) widths and heights
+
+        Returns:
+            (N, K) array of IoUs
+    """
+    intersection = (
+        np.minimum(wh[:, None, 0], centroids[None, :, 0]) * np.minimum(wh[:, None, 1], centroids[None, :, 1])
+    )
+    union = wh.prod(axis=1)[:, None] + centroids.prod(axis=1)[None, :] - intersection
+    return intersection / union
+
+
+def kmeans_iou(wh, k, iterations=100, max_samples=100000, seed=0):
+    """
+        Clusters the box shapes with k-means using 1 - IoU as
+        the distance, so the large boxes do not dominate the
+        clusters like with the euclidean distance. Initialized
+        with k-means++ and updated with the cluster medians.
+
+        Args:
+            wh (ndarray): (N, 2) box widths and heights
+            k (int): Number of clusters
+            iterations (int): Maximum number of iterations
+            max_samples (int): Boxes sampled for the clustering
+            seed (int): Seed of the sampling and initialization
+
+        Returns:
+            (K, 2) cluster centroids sorted by the area
+    """
+    rng = np.random.default_rng(seed)
+    wh = np.asarray(wh, dtype=np.float64)
+    if len(wh) > max_samples:
+        wh = wh[rng.choice(len(wh), max_samples, replace=False)]
+    k = min(k, len(np.unique(wh, axis=0)))
+    if k < 1:
+        raise ValueError("No boxes to cluster")
+
+    centroids = wh[[rng.integers(len(wh))]]
+    while len(centroids) < k:
+        distance = 1 - wh_iou(wh, centroids).max(axis=1)
+        probability = distance ** 2 / (distance ** 2).sum()
+        centroids = np.vstack([centroids, wh[rng.choice(len(wh), p=probability)]])
+
+    for _ in range(iterations):
+        assignment = wh_iou(wh, centroids).argmax(axis=1)
+        updated = np.array([
+            np.median(wh[assignment == cluster], axis=0) if (assignment == cluster).any() else centroids[cluster]
+            for cluster in range(k)
+        ])
+        if np.allclose(updated, centroids):
+            break
+        centroids = updated
+    return centroids[np.argsort(centroids.prod(axis=1))]
+
+
+def propose_anchors(wh, num_levels=5, num_ratios=3, seed=0):
+    """
+        Proposes the anchor configuration of the FPN levels.
+
+        The box shapes are clustered into num_levels * num_ratios
+        clusters. The sizes of the levels are the quantiles of the
+        cluster sizes weighted by the boxes in the clusters, so
+        every level covers an equal share of the boxes, and so
+        are the aspect ratios, which are shared by the levels as
+        AnchorGenerator needs the same number of anchors on every
+        level. A dataset with fewer distinct box shapes than
+        clusters repeats some of the values.
+
+        Args:
+            wh (ndarray): (N, 2) box widths and heights
+            num_levels (int): Number of FPN levels, 5 in the
+                torchvision ResNet FPN
+            num_ratios (int): Aspect ratios per level
+            seed (int): Seed of the clustering
+
+        Returns:
+            Dictionary of the sizes and the aspect ratios per level
+    """
+    centroids = kmeans_iou(wh, num_levels * num_ratios, seed=seed)
+    # The shape of the cluster of every box
+    shapes = centroids[wh_iou(np.asarray(wh, dtype=np.float64), centroids).argmax(axis=1)]
+    sizes = np.sqrt(shapes.prod(axis=1))
+    ratios = shapes[:, 1] / shapes[:, 0]
+
+    # The centers of equal shares of the boxes
+    level_sizes = np.exp(np.quantile(np.log(sizes), (np.arange(num_levels) + .5) / num_levels))
+    level_ratios = np.exp(np.quantile(np.log(ratios), (np.arange(num_ratios) + .5) / num_ratios))
+    return {
+        "sizes": [[round(float(size), 1)] for size in level_sizes],
+        "aspect_ratios": [[round(float(ratio), 3) for ratio in level_ratios]] * num_levels,
+    }
+
+
+def anchor_shapes(anchors):
+    """
+        Lists the anchor shapes of the configuration in the
+        same way as AnchorGenerator creates them.
+
+        Args:
+            anchors (dict): Sizes and aspect ratios per level
+
+        Returns:
+            (A, 2) array of anchor widths and heights
+    """
+    shapes = []
+    for sizes, ratios in zip(anchors["sizes"], anchors["aspect_ratios"]):
+        h_ratios = np.sqrt(np.asarray(ratios, dtype=np.float64))
+        for size in sizes:
+            shapes.append(np.stack([size / h_ratios, size * h_ratios], axis=1))
+    return np.concatenate(shapes)
+
+
+def anchor_fitness(wh, anchors):
+    """
+        Measures how well the anchors cover the boxes.
+
+        Args:
+            wh (ndarray): (N, 2) box widths and heights
+            anchors (dict): Sizes and aspect ratios per level
+
+        Returns:
+            Tuple of the mean best IoU of the boxes and the share
+            of the boxes reaching IoU 0.7 with an anchor, the
+            positive threshold of the RPN
+    """
+    best = wh_iou(wh, anchor_shapes(anchors)).max(axis=1)
+    return float(best.mean()), float((best >= .7).mean())
+
+
+def create_anchor_generator(anchors):
+    """
+        Creates the anchor generator of the configuration.
+
+        Args:
+            anchors (dict): Sizes and aspect ratios per level
+
+        Returns:
+            Torchvision AnchorGenerator
+    """
+    from torchvision.models.detection.anchor_utils import AnchorGenerator
+
+    return AnchorGenerator(
+        sizes=tuple(tuple(sizes) for sizes in anchors["sizes"]),
+        aspect_ratios=tuple(tuple(ratios) for ratios in anchors["aspect_ratios"])
+    )
+
+
+def save_anchors(anchors, path=ANCHORS_PATH):
+    """
+        Writes the anchor configuration to a JSON file.
+
+        Args:
+            anchors (dict): Sizes and aspect ratios per level
+            path (str): Path to the file
+    """
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as file:
+        json.dump(anchors, file, indent=4)
+    os.replace(temporary_path, path)
+
+
+def load_anchors(path=ANCHORS_PATH):
+    """
+        Reads the anchor configuration saved by this module.
+
+        Args:
+            path (str): Path to the file
+
+        Returns:
+            Dictionary of the sizes and the aspect ratios, or
+            None if there is no file
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fits the anchors to the annotated boxes")
+    parser.add_argument("--levels", type=int, default=5, help="Number of FPN levels")
+    parser.add_argument("--ratios", type=int, default=3, help="Aspect ratios per level")
+    parser.add_argument("--output", default=ANCHORS_PATH, help="Path to the anchor configuration")
+    args = parser.parse_args()
+
+    wh = load_boxes()
+    print(f"{len(wh)} boxes")
+    print_histograms(wh)
+
+    anchors = propose_anchors(wh, args.levels, args.ratios)
+    for name, config in (("Default", DEFAULT_ANCHORS), ("Proposed", anchors)):
+        mean_iou, recall = anchor_fitness(wh, config)
+        print(f"{name} anchors: sizes {[sizes[0] for sizes in config['sizes']]}, "
+              f"aspect ratios {config['aspect_ratios'][0]}, mean best IoU {mean_iou:.3f}, "
+              f"boxes with IoU >= 0.7 {recall:.1%}")
+    save_anchors(anchors, args.output)
+    print(f"Saved {args.output}")
@@ -0,0 +1,192 @@
+"""
+    This module contains the periodic checkpoints of
+    `train_rcnn`.
+
+    A checkpoint holds the model, the optimizer, the
+    position in the training and the random number
+    generator states. The states are copied when the
+    checkpoint is taken and written in a background
+    thread, so the training only waits for the copy.
+"""
+
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import torch
+
+CHECKPOINT_FOLDER = "checkpoints"
+
+
+def snapshot(state):
+    """
+        Copies every tensor of a nested state to CPU memory,
+        so the training can continue to change the originals.
+
+        Args:
+            state: Nested dicts, lists and tuples of tensors
+                and other values, e.g. a state_dict
+
+        Returns:
+            Copy of the state
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def get_rng_state():
+    """
+        Collects the states of all random number generators.
+
+        Returns:
+            Dictionary of the generator states
+    """
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """
+        Restores the states of all random number generators.
+
+        Args:
+            state (dict): States given by get_rng_state
+    """
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class CheckpointManager:
+    """
+        Writes checkpoints in background and keeps the
+        last ones of them.
+
+        Attributes:
+            folder (Path): Folder of the checkpoint files
+            keep (int): How many latest checkpoints to keep,
+                at least 1 so the training can be resumed
+    """
+
+    def __init__(self, folder=CHECKPOINT_FOLDER, keep=3):
+        if keep < 1:
+            raise ValueError(f"At least one checkpoint has to be kept, got keep={keep}")
+        self.folder = Path(folder)
+        self.keep = keep
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="CheckpointWriter")
+        self._pending = None
+
+    def paths(self):
+        """
+            Lists the checkpoint files from oldest to newest.
+
+            Returns:
+                List of checkpoint paths
+        """
+        if not self.folder.is_dir():
+            return []
+        return sorted(self.folder.glob("checkpoint-*.pt"))
+
+    def clear(self):
+        """
+            Deletes the checkpoints of an earlier run, so a new
+            run neither prunes its own checkpoints nor resumes
+            from the other run. The checkpoints are ordered by
+            the epoch and the step, which restart in a new run.
+        """
+        self.wait()
+        for path in self.paths():
+            path.unlink(missing_ok=True)
+
+    def save(self, model, optimizer, epoch, step):
+        """
+            Takes a checkpoint and writes it in background.
+            Waits for the previous write first, so at most
+            one copy of the states is in memory.
+
+            Args:
+                model (Module): Trained model
+                optimizer (Optimizer): Optimizer of the model
+                epoch (int): Current epoch
+                step (int): Steps done in the epoch
+        """
+        self.wait()
+        state = {
+            "model": snapshot(model.state_dict()),
+            "optimizer": snapshot(optimizer.state_dict()),
+            "epoch": epoch,
+            "step": step,
+            "rng": get_rng_state(),
+        }
+        path = Path(self.folder, f"checkpoint-{epoch:04d}-{step:08d}.pt")
+        self._pending = self._executor.submit(self._write, state, path)
+
+    def wait(self):
+        """
+            Waits for the background write and raises its error.
+        """
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self):
+        """
+            Finishes the background write and stops the thread.
+        """
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown()
+
+    def load_latest(self, map_location=None):
+        """
+            Loads the newest checkpoint which can be read,
+            skipping damaged files.
+
+            Args:
+                map_location: Device to load the tensors to
+
+            Returns:
+                Checkpoint dictionary or None if there is none
+        """
+        self.wait()
+        for path in reversed(self.paths()):
+            try:
+                # The checkpoints contain the RNG states which are
+                # not plain tensors. They are written by us only.
+                state = torch.load(path, map_location=map_location, weights_only=False)
+            except Exception as error:
+                print(f"Skipping unreadable checkpoint {path}: {error}")
+                continue
+            if {"model", "optimizer", "epoch", "step", "rng"} <= state.keys():
+                return state
+        return None
+
+    def _write(self, state, path):
+        os.makedirs(self.folder, exist_ok=True)
+        # Write to a temporary file and rename, so a crash
+        # never leaves a partial checkpoint
+        temporary_path = path.with_suffix(".tmp")
+        with open(temporary_path, "wb") as file:
+            torch.save(state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+
+        for old_path in self.paths()[:-self.keep]:
+            old_path.unlink(missing_ok=True)
@@ -1,13 +1,21 @@
-import os
-import glob
-from typing import Any, Callable, List, Optional, Tuple
-import xml.etree.ElementTree as ET
+import io
+import warnings
+from typing import Any, Callable, Iterator, List, Optional, Tuple
 
+import numpy as np
+import torch
 from PIL import Image
+from torch.utils.data import IterableDataset
 from torchvision.datasets import VisionDataset
+from torchvision.datasets.vision import StandardTransform
 
+from src.annotation_index import AnnotationIndex
 from src.config import *
-from src.utils import parse_xml
+from src.image_cache import DEFAULT_MAX_SIZE, HEIGHT, WIDTH, ImageCache
+from src.manifest import Manifest
+from src.shards import decode_record, iterate_shard, read_shard_index
+from src.vocabulary import Vocabulary
+from src.utils import parse_annotation_xml
 
 
 class CustomDataset(VisionDataset):
@@ -15,7 +23,15 @@ class CustomDataset(VisionDataset):
 
     Attributes:
         images (List[str]): The list contains all the image paths.
-        targets (List[str]): The list contains all the annotation file paths.
+        targets (List[str]): The list contains all the annotation file paths, paired with the images by the file name
+            stem.
+        unannotated (List[str]): The list contains the image paths without an annotation file, which are skipped.
+        manifest (Manifest): The persisted manifest used to pair the images and the annotations.
+        index (Optional[AnnotationIndex]): The compiled annotation index, used instead of parsing the annotation
+            files when the dataset is created with compiled=True.
+        cache (Optional[ImageCache]): The cache of decoded images, used instead of decoding the images when the
+            dataset is created with cached=True.
+        vocabulary (Optional[Vocabulary]): The vocabulary translating the labels into class ids.
 
     """
 
@@ -25,6 +41,10 @@ class CustomDataset(VisionDataset):
             transform: Optional[Callable] = None,
             target_transform: Optional[Callable] = None,
             transforms: Optional[Callable] = None,
+            compiled: bool = False,
+            cached: bool = False,
+            max_size: Optional[int] = DEFAULT_MAX_SIZE,
+            vocabulary: Optional[Vocabulary] = None,
     ):
         """ Initialize the CustomDataset instance
 
@@ -33,16 +53,41 @@ class CustomDataset(VisionDataset):
             transform (Optional[Callable]): The callable for transforming the images.
             target_transform (Optional[Callable]): The callable for transforming the targets.
             transforms (Optional[Callable]): The callable for transforming both the images and targets.
+            compiled (bool): Whether to read the targets from the compiled annotation index instead of parsing the
+                annotation files. The index is rebuilt if any annotation file changed. The targets are then
+                dictionaries with the 'boxes' array and the 'labels' names, otherwise the nested dictionaries of
+                parse_xml.
+            cached (bool): Whether to decode the images once into the image cache and read them from there. The cache
+                is rebuilt if any image changed. The images are then (H, W, 3) uint8 arrays and the boxes are scaled
+                to the cached resolution. Requires compiled=True.
+            max_size (Optional[int]): The resolution cap of the longer side of the cached images, or None to cache
+                the images in their original resolution.
+            vocabulary (Optional[Vocabulary]): The vocabulary translating the labels into class ids. The targets are
+                then dictionaries with the float32 'boxes' and the int64 'labels' arrays, which can be wrapped into
+                tensors directly. Every label is checked when the dataset is created. Requires compiled=True.
         """
         super().__init__(root_dir, transforms, transform, target_transform)
 
-        self.images = []
-        for extension in IMAGE_EXTENSIONS:
-            self.images.extend(glob.glob(os.path.join(IMAGE_DIR, extension)))
+        # Pair the images and the annotations by the file name stem
+        self.manifest = Manifest(IMAGE_DIR, ANNOTATION_DIR).scan()
+        self.images = [str(image_path) for image_path, _ in self.manifest.pairs]
+        self.targets = [str(annotation_path) for _, annotation_path in self.manifest.pairs]
+        self.unannotated = [str(image_path) for image_path in self.manifest.unannotated]
 
-        self.targets = glob.glob(os.path.join(ANNOTATION_DIR, '*.xml'))
+        if self.unannotated:
+            warnings.warn(f'Skipped {len(self.unannotated)} images without annotations, see CustomDataset.unannotated')
 
-        assert len(self.images) == len(self.targets)
+        self.index = AnnotationIndex.load(ANNOTATION_DIR) if compiled else None
+
+        if cached and not compiled:
+            raise ValueError('The image cache requires a compiled dataset')
+        self.cache = ImageCache.load(self.images, IMAGE_CACHE_DIR, max_size) if cached else None
+
+        if vocabulary is not None and not compiled:
+            raise ValueError('The vocabulary requires a compiled dataset')
+        self.vocabulary = vocabulary
+        # Translates the label ids of the index into the class ids, raises KeyError here for unknown labels
+        self._lookup = vocabulary.encode(self.index.classes) if vocabulary is not None else None
 
     def __len__(self) -> int:
         """ The overwrite method __len__.
@@ -68,6 +113,29 @@ class CustomDataset(VisionDataset):
         """
         return self.targets
 
+    def image_sizes(self) -> np.ndarray:
+        """ Get the sizes of all the images without decoding them.
+
+        The sizes are read from the image cache or the compiled annotation index if available, otherwise from the
+        image file headers.
+
+        Returns:
+            sizes (np.ndarray): The (N, 2) int array of the (width, height) of the images.
+        """
+        if self.cache is not None:
+            return self.cache.table[:, [WIDTH, HEIGHT]]
+
+        sizes = np.zeros((len(self), 2), dtype=np.int64)
+        if self.index is not None:
+            rows = [self.index.row(Path(annotation).stem) for annotation in self.annotations]
+            sizes[:] = self.index.arrays['sizes'][rows]
+
+        # Fall back to the image headers for the annotations without a size
+        for index in np.flatnonzero((sizes <= 0).any(axis=1)):
+            with Image.open(self.images[index]) as img:
+                sizes[index] = img.size
+        return sizes
+
     def __getitem__(self, index: int) -> Tuple[Any, Any]:
         """ The overwrite method __getitem__
 
@@ -85,10 +153,175 @@ class CustomDataset(VisionDataset):
         Returns:
             images, labels (Tuple[Any, Any]): The images and labels of the dataset.
         """
-        img = Image.open(self.images[index]).convert("RGB")
-        target = parse_xml(ET.parse(self.annotations[index]).getroot())
+        if self.index is not None:
+            target = self.index.get_target(Path(self.annotations[index]).stem, self._lookup)
+        else:
+            target = parse_annotation_xml(self.annotations[index])
+
+        if self.cache is not None:
+            img = self.cache[index]
+            scale_x, scale_y = self.cache.scale(index)
+            target['boxes'] = target['boxes'] * np.array([scale_x, scale_y, scale_x, scale_y], dtype=np.float32)
+        else:
+            img = Image.open(self.images[index]).convert("RGB")
 
         if self.transforms is not None:
             img, target = self.transforms(img, target)
 
         return img, target
+
+
+class ShardDataset(IterableDataset):
+    """ The streaming dataset reading the tar shards written by `src.shards.export_shards`.
+
+    Every DataLoader worker of every distributed rank reads its own subset of the shards sequentially. The order of the
+    shards is shuffled every epoch and the samples are shuffled within a buffer, so the reads stay sequential while the
+    batches are mixed.
+
+    Attributes:
+        shard_dir (Path): The directory containing the shards.
+        shards (List[Dict[str, Any]]): The names and the sample counts of the shards.
+        shuffle (bool): Whether to shuffle the shards and the samples.
+        buffer_size (int): The number of samples in the shuffle buffer.
+        seed (int): The seed of the shuffling, shared by all the workers.
+        epoch (int): The epoch used in the shuffling seed.
+        vocabulary (Optional[Vocabulary]): The vocabulary translating the labels into class ids.
+        rank (int): The distributed rank reading the dataset, taken from the initialized process group.
+        world_size (int): The number of distributed ranks.
+    """
+
+    def __init__(
+            self,
+            shard_dir: str = SHARD_DIR,
+            transform: Optional[Callable] = None,
+            target_transform: Optional[Callable] = None,
+            transforms: Optional[Callable] = None,
+            shuffle: bool = True,
+            buffer_size: int = 1000,
+            seed: int = 0,
+            vocabulary: Optional[Vocabulary] = None,
+    ):
+        """ Initialize the ShardDataset instance
+
+        Args:
+            shard_dir (str): The directory containing the shards.
+            transform (Optional[Callable]): The callable for transforming the images.
+            target_transform (Optional[Callable]): The callable for transforming the targets.
+            transforms (Optional[Callable]): The callable for transforming both the images and targets.
+            shuffle (bool): Whether to shuffle the shards and the samples.
+            buffer_size (int): The number of samples in the shuffle buffer.
+            seed (int): The seed of the shuffling, shared by all the workers.
+            vocabulary (Optional[Vocabulary]): The vocabulary translating the labels into class ids. The targets are
+                then dictionaries with the float32 'boxes' and the int64 'labels' arrays.
+        """
+        super().__init__()
+
+        self.shard_dir = Path(shard_dir)
+        self.shards = read_shard_index(shard_dir)
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.epoch = 0
+        self.vocabulary = vocabulary
+        # The DataLoader workers do not join the process group, so the rank is read here
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        self.rank = torch.distributed.get_rank() if distributed else 0
+        self.world_size = torch.distributed.get_world_size() if distributed else 1
+
+        # The same transform handling as VisionDataset
+        if transforms is not None and (transform is not None or target_transform is not None):
+            raise ValueError("Only transforms or transform/target_transform can be passed as argument")
+        if transform is not None or target_transform is not None:
+            transforms = StandardTransform(transform, target_transform)
+        self.transforms = transforms
+
+        # Counts the iterations of this copy of the dataset, so the persistent workers shuffle every epoch
+        self._iterations = 0
+
+    def __len__(self) -> int:
+        """ The number of samples in all the shards, also when every distributed rank reads only a part of them.
+
+        Returns:
+            length (int): The length of the dataset.
+        """
+        return sum(shard['count'] for shard in self.shards)
+
+    def set_epoch(self, epoch: int) -> None:
+        """ Set the epoch used in the shuffling seed. Required for a new order every epoch when the DataLoader
+        workers are not persistent.
+
+        Args:
+            epoch (int): The epoch.
+
+        Returns:
+            None
+        """
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[Tuple[Any, Any]]:
+        """ Iterate the samples of the shards of this worker.
+
+        Yields:
+            images, labels (Tuple[Any, Any]): The images and labels of the dataset.
+        """
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+
+        epoch_seed = self.seed + self.epoch + self._iterations
+        self._iterations += 1
+
+        # All the workers of all the ranks shuffle the shards the same way and take their share of them
+        shard_names = [shard['name'] for shard in self.shards]
+        if self.shuffle:
+            shard_names = [shard_names[i] for i in np.random.default_rng(epoch_seed).permutation(len(shard_names))]
+        shard_names = shard_names[self.rank * num_workers + worker_id::self.world_size * num_workers]
+
+        samples = (
+            sample
+            for shard_name in shard_names
+            for sample in iterate_shard(Path(self.shard_dir, shard_name))
+        )
+        if self.shuffle:
+            rng = np.random.default_rng([epoch_seed, self.rank, worker_id])
+            samples = _shuffle_buffer(samples, self.buffer_size, rng)
+
+        for image_name, image_bytes, record in samples:
+            img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+            record = decode_record(record)
+            if self.vocabulary is not None:
+                target = {
+                    'boxes': np.asarray(record['boxes'], dtype=np.float32).reshape(-1, 4),
+                    'labels': self.vocabulary.encode(record['labels']),
+                }
+            else:
+                target = {'boxes': np.asarray(record['boxes'], dtype=np.int32).reshape(-1, 4), 'labels': record['labels']}
+
+            if self.transforms is not None:
+                img, target = self.transforms(img, target)
+
+            yield img, target
+
+
+def _shuffle_buffer(samples: Iterator[Any], buffer_size: int, rng: np.random.Generator) -> Iterator[Any]:
+    """ Shuffle a stream of samples with a bounded buffer. Every new sample replaces a random sample of the full
+    buffer, which is yielded.
+
+    Args:
+        samples (Iterator[Any]): The samples.
+        buffer_size (int): The number of samples in the buffer.
+        rng (np.random.Generator): The random number generator.
+
+    Yields:
+        sample (Any): The samples in the shuffled order.
+    """
+    buffer = []
+    for sample in samples:
+        if len(buffer) < buffer_size:
+            buffer.append(sample)
+            continue
+        index = rng.integers(len(buffer))
+        yield buffer[index]
+        buffer[index] = sample
+
+    rng.shuffle(buffer)
+    yield from buffer
@@ -0,0 +1,248 @@
+"""
+    This module contains the distributed data parallel
+    training of `train_rcnn` over the gloo backend.
+
+    Every rank is a process training the same model on its
+    own slice of the dataset. The gradients are averaged
+    between the ranks by DistributedDataParallel. On one
+    machine the ranks are pinned to separate CPUs, so the
+    ranks of a multi-socket machine do not compete for the
+    same cores.
+
+    One machine with 4 ranks:
+
+        python distributed.py --nproc 4
+
+    Two nodes with 4 ranks each, run on every node:
+
+        python distributed.py --nproc 4 --nnodes 2 --node-rank <0 or 1> --master-addr <address of node 0>
+
+    The module can also be started with torchrun, which
+    sets the ranks in the environment:
+
+        torchrun --nnodes 2 --nproc-per-node 4 --rdzv-endpoint <address> distributed.py
+"""
+
+import argparse
+import os
+from contextlib import contextmanager
+
+import torch
+import torch.distributed as dist
+
+BACKEND = "gloo"
+
+
+def is_distributed():
+    """
+        Tells whether the process is a rank of a
+        distributed training.
+
+        Returns:
+            True if the process group is initialized
+    """
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    """
+        Returns:
+            Rank of the process, 0 if not distributed
+    """
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_local_rank():
+    """
+        Returns:
+            Rank of the process on its node, set by run or
+            torchrun, 0 if not distributed
+    """
+    return int(os.environ.get("LOCAL_RANK", 0)) if is_distributed() else 0
+
+
+def get_world_size():
+    """
+        Returns:
+            Number of ranks, 1 if not distributed
+    """
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """
+        The main process writes the model and the
+        checkpoints.
+
+        Returns:
+            True for rank 0 or when not distributed
+    """
+    return get_rank() == 0
+
+
+def unwrap(model):
+    """
+        Returns:
+            The model inside DistributedDataParallel
+            or the model itself
+    """
+    if isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        return model.module
+    return model
+
+
+@contextmanager
+def main_process_first():
+    """
+        Context manager running the enclosed code in the
+        first rank of every node before the other ranks,
+        e.g. to compile the annotation index and the image
+        cache once per node and let the other ranks of the
+        node load them.
+    """
+    first = get_local_rank() == 0
+    if is_distributed() and not first:
+        dist.barrier()
+    try:
+        yield
+    finally:
+        # Released on an error too, so the other ranks
+        # fail on their own instead of waiting forever
+        if is_distributed() and first:
+            dist.barrier()
+
+
+def bind_cpus(local_rank, local_world_size):
+    """
+        Pins the rank to its own contiguous block of the
+        available CPUs and sizes the intra-op thread pool
+        to the half of the block which the default
+        DataLoader workers leave. The CPUs of a socket are
+        usually numbered contiguously, so the ranks do not
+        cross the sockets.
+
+        Args:
+            local_rank (int): Rank of the process on this node
+            local_world_size (int): Number of ranks on this node
+
+        Returns:
+            List of the CPUs of the rank
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    block = max(1, len(cpus) // local_world_size)
+    start = (local_rank * block) % len(cpus)
+    cpus = cpus[start:start + block]
+
+    # Not available on every platform, e.g. macOS
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(max(1, len(cpus) - len(cpus) // 2))
+    return cpus
+
+
+def run(local_rank, train_fn, nproc, nnodes, node_rank, master_addr, master_port, bind):
+    """
+        Runs one rank started by launch.
+
+        Args:
+            local_rank (int): Rank of the process on this node
+            train_fn (callable): Picklable function without
+                arguments which runs the training
+            nproc (int): Number of ranks per node
+            nnodes (int): Number of nodes
+            node_rank (int): Index of this node
+            master_addr (str): Address of the node 0
+            master_port (int): Free port on the node 0
+            bind (bool): Whether to pin the ranks to CPUs
+    """
+    # Read by get_local_rank, the same as under torchrun
+    os.environ["LOCAL_RANK"] = str(local_rank)
+    dist.init_process_group(
+        BACKEND,
+        init_method=f"tcp://{master_addr}:{master_port}",
+        rank=node_rank * nproc + local_rank,
+        world_size=nnodes * nproc
+    )
+    try:
+        if bind:
+            bind_cpus(local_rank, nproc)
+        train_fn()
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(train_fn, nproc=1, nnodes=1, node_rank=0, master_addr="127.0.0.1", master_port=29500, bind=True):
+    """
+        Starts the ranks of this node and waits for them.
+        Every node of a multi-node training runs this with
+        its own node_rank.
+
+        Args:
+            train_fn (callable): Picklable function without
+                arguments which runs the training, e.g. builds
+                the dataset and the model and calls train_rcnn
+            nproc (int): Number of ranks per node
+            nnodes (int): Number of nodes
+            node_rank (int): Index of this node
+            master_addr (str): Address of the node 0
+            master_port (int): Free port on the node 0
+            bind (bool): Whether to pin the ranks to CPUs
+    """
+    torch.multiprocessing.spawn(
+        run,
+        args=(train_fn, nproc, nnodes, node_rank, master_addr, master_port, bind),
+        nprocs=nproc
+    )
+
+
+def train():
+    """
+        Trains the model of rcnn.py on the dataset in
+        the rank which calls this.
+    """
+    import torchvision as tv
+
+    from anchors import load_anchors
+    from dataset import CustomDataset
+    from rcnn import check_annotations, faster_rcnn, get_vocabulary, target_transform, train_rcnn
+
+    # The first rank of every node compiles the index and
+    # the cache which the other ranks of the node then load
+    with main_process_first():
+        check_annotations()
+        vocabulary = get_vocabulary()
+        dataset = CustomDataset(
+            root_dir='./data',
+            transform=tv.transforms.ToTensor(),
+            target_transform=target_transform,
+            compiled=True,
+            cached=True,
+            vocabulary=vocabulary
+        )
+    model = faster_rcnn(len(vocabulary), anchors=load_anchors())
+    train_rcnn(dataset, model, batch_size=4)
+
+
+if __name__ == "__main__":
+    if "RANK" in os.environ:
+        # Started by torchrun, which gives the ranks in the environment
+        dist.init_process_group(BACKEND)
+        try:
+            bind_cpus(int(os.environ["LOCAL_RANK"]), int(os.environ["LOCAL_WORLD_SIZE"]))
+            train()
+        finally:
+            dist.destroy_process_group()
+    else:
+        parser = argparse.ArgumentParser(description="Distributed training of the Faster RCNN model")
+        parser.add_argument("--nproc", type=int, default=1, help="Number of ranks per node")
+        parser.add_argument("--nnodes", type=int, default=1, help="Number of nodes")
+        parser.add_argument("--node-rank", type=int, default=0, help="Index of this node")
+        parser.add_argument("--master-addr", default="127.0.0.1", help="Address of the node 0")
+        parser.add_argument("--master-port", type=int, default=29500, help="Free port on the node 0")
+        parser.add_argument("--no-bind", action="store_true", help="Do not pin the ranks to CPUs")
+        args = parser.parse_args()
+        launch(train, args.nproc, args.nnodes, args.node_rank, args.master_addr, args.master_port,
+               not args.no_bind)
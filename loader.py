@@ -0,0 +1,223 @@
+"""
+    This module contains the configurable data pipeline
+    used by `train_rcnn`.
+
+    The DataLoader workers decode the images in parallel
+    processes and a background thread moves the next batch
+    to the device while the current step is computed.
+"""
+
+import os
+import queue
+import threading
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Optional, Sequence
+
+import torch
+
+
+def default_num_workers():
+    """
+        Default worker count: half of the CPUs the process
+        may run on, e.g. the block of a rank pinned by
+        `distributed.bind_cpus`, and no more than the CPUs
+        left by the intra-op threads of the model.
+
+        Returns:
+            Number of DataLoader workers
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 2
+    return max(1, min(cpus // 2, cpus - torch.get_num_threads()))
+
+
+@dataclass
+class LoaderConfig:
+    """
+        Configuration of the training data pipeline.
+
+        Attributes:
+            num_workers (int): Number of DataLoader worker processes
+            persistent_workers (bool): Keep the workers alive between
+                epochs instead of starting them again
+            prefetch_factor (int): Batches loaded ahead by every worker
+            cpu_affinity (Sequence[int]): CPUs the workers are pinned to
+                in round-robin order, or None to not pin them
+            device_prefetch (int): Batches moved to the device ahead by
+                the background thread, 0 to load them in the training loop
+    """
+    num_workers: int = field(default_factory=default_num_workers)
+    persistent_workers: bool = True
+    prefetch_factor: int = 2
+    cpu_affinity: Optional[Sequence[int]] = None
+    device_prefetch: int = 1
+
+
+class WorkerAffinity:
+    """
+        DataLoader worker_init_fn pinning every worker to
+        one of the given CPUs in round-robin order.
+
+        Attributes:
+            cpus (list): CPUs to pin the workers to
+    """
+
+    def __init__(self, cpus):
+        self.cpus = list(cpus)
+
+    def __call__(self, worker_id):
+        # Not available on every platform, e.g. macOS
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, {self.cpus[worker_id % len(self.cpus)]})
+
+
+def create_dataloader(dataset, config, collate_fn, device, **batching):
+    """
+        Creates DataLoader configured by the loader configuration.
+
+        Args:
+            dataset (Dataset): Dataset to load
+            config (LoaderConfig): Loader configuration
+            collate_fn (callable): Function collating the batches
+            device (device): Device the batches are used on
+            batching: batch_size/shuffle or batch_sampler keywords
+
+        Returns:
+            Torch DataLoader
+    """
+    options = {}
+    if config.num_workers > 0:
+        options["persistent_workers"] = config.persistent_workers
+        options["prefetch_factor"] = config.prefetch_factor
+        if config.cpu_affinity:
+            options["worker_init_fn"] = WorkerAffinity(config.cpu_affinity)
+
+    return torch.utils.data.DataLoader(
+        dataset=dataset,
+        pin_memory="cuda" in device.type,
+        num_workers=config.num_workers,
+        collate_fn=collate_fn,
+        **batching,
+        **options
+    )
+
+
+def to_device(batch, device):
+    """
+        Moves batch of (images, targets) to the device.
+
+        Args:
+            batch (tuple): Collated ((img,...), (target,...))
+            device (device): Target device
+
+        Returns:
+            Tuple of image list and target list on the device
+    """
+    img, targets = batch
+    non_blocking = "cuda" in device.type
+    img = [item.to(device, non_blocking=non_blocking) for item in img]
+    targets = [
+        {key: value.to(device, non_blocking=non_blocking) for key, value in target.items()}
+        for target in targets
+    ]
+    return img, targets
+
+
+class DevicePrefetcher:
+    """
+        Iterates batches of the loader moved to the device.
+        A background thread prepares the next batches while
+        the training loop runs the current step.
+
+        Attributes:
+            loader (iterable): Iterable of collated batches
+            device (device): Device to move the batches to
+            depth (int): Batches prepared ahead, 0 to prepare
+                them in the calling thread
+            wait_time (float): Seconds the last iteration
+                waited for the batches
+            last_wait (float): Seconds waited for the last batch
+            last_copy (float): Seconds the last batch took to
+                move to the device
+    """
+
+    def __init__(self, loader, device, depth=1):
+        self.loader = loader
+        self.device = device
+        self.depth = depth
+        self.wait_time = .0
+        self.last_wait = .0
+        self.last_copy = .0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.wait_time = .0
+        if self.depth < 1:
+            yield from self._iter_sync()
+            return
+
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        # Marks the end of the batches
+        done = object()
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    start = perf_counter()
+                    item = (to_device(batch, self.device), perf_counter() - start)
+                    while not stop.is_set():
+                        try:
+                            batches.put(item, timeout=.1)
+                            break
+                        except queue.Full:
+                            continue
+                    if stop.is_set():
+                        return
+                item = done
+            except BaseException as error:  # Re-raised in the training loop
+                item = error
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=.1)
+                    return
+                except queue.Full:
+                    continue
+
+        thread = threading.Thread(target=produce, name="DevicePrefetcher", daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = perf_counter()
+                item = batches.get()
+                self.last_wait = perf_counter() - start
+                self.wait_time += self.last_wait
+                if item is done:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                batch, self.last_copy = item
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+    def _iter_sync(self):
+        iterator = iter(self.loader)
+        while True:
+            start = perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            loaded = perf_counter()
+            batch = to_device(batch, self.device)
+            self.last_copy = perf_counter() - loaded
+            self.last_wait = perf_counter() - start
+            self.wait_time += self.last_wait
+            yield batch
@@ -0,0 +1,306 @@
+"""
+    This module contains the detection metrics of
+    `evaluate_dataset`.
+
+    The predictions of every image are matched to the ground
+    truth boxes of the same class with NumPy IoU matrices,
+    at all the IoU thresholds at once. Only the scores and the
+    match flags of the detections are kept, so the evaluation
+    streams over the dataset without keeping the images or
+    the boxes. The per-class average precision is computed in
+    COCO style (101-point interpolation, IoU thresholds from
+    0.5 to 0.95) or VOC style (area under the precision
+    envelope at IoU 0.5).
+
+    The JSON report has a stable layout, so the reports of
+    two runs can be diffed, or compared with:
+
+        python metrics.py old.json new.json
+"""
+
+import json
+import os
+import sys
+from collections import defaultdict
+
+import numpy as np
+
+STYLES = ("coco", "voc")
+COCO_IOU_THRESHOLDS = tuple(np.round(np.linspace(.5, .95, 10), 2))
+VOC_IOU_THRESHOLDS = (.5,)
+# The decimals of the values in the report, so the reports
+# of the same predictions are identical
+REPORT_DECIMALS = 6
+
+
+def box_iou(boxes, other_boxes):
+    """
+        Computes the IoU of every pair of the boxes.
+
+        Args:
+            boxes (ndarray): (N, 4) array of (x1, y1, x2, y2)
+            other_boxes (ndarray): (M, 4) array of (x1, y1, x2, y2)
+
+        Returns:
+            (N, M) array of IoUs
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    other_boxes = np.asarray(other_boxes, dtype=np.float64).reshape(-1, 4)
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    other_area = (other_boxes[:, 2] - other_boxes[:, 0]) * (other_boxes[:, 3] - other_boxes[:, 1])
+
+    top_left = np.maximum(boxes[:, None, :2], other_boxes[None, :, :2])
+    bottom_right = np.minimum(boxes[:, None, 2:], other_boxes[None, :, 2:])
+    intersection = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+    union = area[:, None] + other_area[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def match_detections(boxes, scores, gt_boxes, iou_thresholds):
+    """
+        Matches the detections of one class in one image to
+        the ground truth boxes greedily by the score, at every
+        IoU threshold. A detection matches the unmatched ground
+        truth box it overlaps most, if the IoU reaches the
+        threshold.
+
+        Args:
+            boxes (ndarray): (N, 4) detected boxes
+            scores (ndarray): (N,) detection scores
+            gt_boxes (ndarray): (M, 4) ground truth boxes
+            iou_thresholds (ndarray): (T,) IoU thresholds
+
+        Returns:
+            (N, T) boolean array of the true positives, in
+            the order of the given detections
+    """
+    true_positives = np.zeros((len(boxes), len(iou_thresholds)), dtype=bool)
+    if not len(boxes) or not len(gt_boxes):
+        return true_positives
+
+    iou = box_iou(boxes, gt_boxes)
+    # (T, M) ground truths still free at every threshold
+    free = np.ones((len(iou_thresholds), len(gt_boxes)), dtype=bool)
+    thresholds = np.arange(len(iou_thresholds))
+    for index in np.argsort(-scores, kind="stable"):
+        candidates = np.where(free, iou[index], -1)
+        best = candidates.argmax(axis=1)
+        matched = candidates[thresholds, best] >= iou_thresholds
+        free[thresholds[matched], best[matched]] = False
+        true_positives[index] = matched
+    return true_positives
+
+
+def average_precision(true_positives, scores, num_gt, style="coco"):
+    """
+        Computes the average precision of one class at every
+        IoU threshold.
+
+        Args:
+            true_positives (ndarray): (N, T) true positive flags
+                of all the detections of the class
+            scores (ndarray): (N,) detection scores
+            num_gt (int): Number of ground truth boxes
+            style (str): "coco" for the 101-point interpolation,
+                "voc" for the area under the precision envelope
+
+        Returns:
+            Tuple of (T,) arrays of the average precision and
+            the recall, NaN when there are no ground truths
+    """
+    num_thresholds = true_positives.shape[1]
+    if num_gt == 0:
+        return np.full(num_thresholds, np.nan), np.full(num_thresholds, np.nan)
+    if not len(scores):
+        return np.zeros(num_thresholds), np.zeros(num_thresholds)
+
+    order = np.argsort(-scores, kind="stable")
+    tp = np.cumsum(true_positives[order], axis=0)
+    fp = np.cumsum(~true_positives[order], axis=0)
+    recall = tp / num_gt
+    precision = tp / (tp + fp)
+    # Precision envelope, the best precision at any higher recall
+    envelope = np.maximum.accumulate(precision[::-1], axis=0)[::-1]
+
+    if style == "coco":
+        recall_points = np.linspace(0, 1, 101)
+        ap = np.empty(num_thresholds)
+        for t in range(num_thresholds):
+            # The first detection reaching every recall point
+            positions = np.searchsorted(recall[:, t], recall_points, side="left")
+            reached = positions < len(recall)
+            ap[t] = envelope[positions[reached], t].sum() / len(recall_points)
+    else:
+        previous_recall = np.vstack([np.zeros((1, num_thresholds)), recall[:-1]])
+        ap = ((recall - previous_recall) * envelope).sum(axis=0)
+    return ap, recall[-1]
+
+
+class DetectionEvaluator:
+    """
+        Accumulates the matches of the predictions image by
+        image and computes the average precisions at the end.
+
+        Attributes:
+            style (str): "coco" or "voc"
+            iou_thresholds (ndarray): IoU thresholds of the matching
+            class_names (list): Names of the class ids, or None
+                to name the classes by the ids
+            images (int): Number of evaluated images
+    """
+
+    def __init__(self, style="coco", iou_thresholds=None, class_names=None):
+        if style not in STYLES:
+            raise ValueError(f"Unknown style {style}, expected one of {STYLES}")
+        if iou_thresholds is None:
+            iou_thresholds = COCO_IOU_THRESHOLDS if style == "coco" else VOC_IOU_THRESHOLDS
+        self.style = style
+        self.iou_thresholds = np.asarray(iou_thresholds, dtype=np.float64)
+        self.class_names = class_names
+        self.images = 0
+        # Per class id the score and match flag arrays of the images
+        self._scores = defaultdict(list)
+        self._true_positives = defaultdict(list)
+        self._num_gt = defaultdict(int)
+
+    def add(self, boxes, labels, scores, gt_boxes, gt_labels):
+        """
+            Matches the predictions of one image.
+
+            Args:
+                boxes (ndarray): (N, 4) predicted boxes
+                labels (ndarray): (N,) predicted class ids
+                scores (ndarray): (N,) prediction scores
+                gt_boxes (ndarray): (M, 4) ground truth boxes
+                gt_labels (ndarray): (M,) ground truth class ids
+        """
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        labels = np.asarray(labels).reshape(-1)
+        scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+        gt_boxes = np.asarray(gt_boxes, dtype=np.float64).reshape(-1, 4)
+        gt_labels = np.asarray(gt_labels).reshape(-1)
+
+        for class_id in np.union1d(labels, gt_labels).tolist():
+            predicted = labels == class_id
+            ground_truth = gt_labels == class_id
+            self._num_gt[class_id] += int(ground_truth.sum())
+            if predicted.any():
+                self._scores[class_id].append(scores[predicted].astype(np.float32))
+                self._true_positives[class_id].append(
+                    match_detections(boxes[predicted], scores[predicted], gt_boxes[ground_truth], self.iou_thresholds)
+                )
+        self.images += 1
+
+    def class_name(self, class_id):
+        """
+            Returns:
+                Name of the class id in the report
+        """
+        if self.class_names is not None and 0 <= class_id < len(self.class_names):
+            return self.class_names[class_id]
+        return str(class_id)
+
+    def summary(self):
+        """
+            Computes the metrics of the images added so far.
+
+            Returns:
+                Dictionary of the report
+        """
+        thresholds = [f"{threshold:.2f}" for threshold in self.iou_thresholds]
+        classes = {}
+        class_ap = []
+        for class_id in sorted(self._num_gt.keys() | self._scores.keys()):
+            scores = np.concatenate(self._scores[class_id]) if self._scores[class_id] else np.zeros(0)
+            true_positives = (
+                np.concatenate(self._true_positives[class_id]) if self._true_positives[class_id]
+                else np.zeros((0, len(thresholds)), dtype=bool)
+            )
+            ap, recall = average_precision(true_positives, scores, self._num_gt[class_id], self.style)
+            classes[self.class_name(class_id)] = {
+                "id": class_id,
+                "ground_truths": self._num_gt[class_id],
+                "detections": len(scores),
+                "AP": _mean(ap),
+                "AP_per_threshold": dict(zip(thresholds, map(_value, ap))),
+                "recall_per_threshold": dict(zip(thresholds, map(_value, recall))),
+            }
+            # The classes without ground truths have no AP
+            if self._num_gt[class_id]:
+                class_ap.append(ap)
+
+        class_ap = np.array(class_ap).reshape(-1, len(thresholds))
+        map_per_threshold = class_ap.mean(axis=0) if len(class_ap) else np.full(len(thresholds), np.nan)
+        report = {
+            "style": self.style,
+            "iou_thresholds": [float(threshold) for threshold in self.iou_thresholds],
+            "images": self.images,
+            "mAP": _mean(map_per_threshold),
+            "mAP_per_threshold": dict(zip(thresholds, map(_value, map_per_threshold))),
+            "classes": classes,
+        }
+        return report
+
+    def write_report(self, path, **metadata):
+        """
+            Writes the summary to a JSON file with sorted keys
+            and rounded values, so the reports of two runs can
+            be diffed line by line.
+
+            Args:
+                path (str): Path to the JSON report
+                metadata: Extra values of the report, e.g. the
+                    model file and the precision
+
+            Returns:
+                Dictionary of the report
+        """
+        report = {**self.summary(), **metadata}
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+            file.write("\n")
+        os.replace(temporary_path, path)
+        return report
+
+
+def _value(value):
+    # NaN is not valid JSON
+    return None if np.isnan(value) else round(float(value), REPORT_DECIMALS)
+
+
+def _mean(values):
+    values = np.asarray(values, dtype=np.float64)
+    return None if np.isnan(values).all() else round(float(np.nanmean(values)), REPORT_DECIMALS)
+
+
+def compare_reports(old, new):
+    """
+        Prints the changes of the mean and per-class AP
+        between two reports.
+
+        Args:
+            old (dict): Report of the earlier run
+            new (dict): Report of the later run
+    """
+    def change(before, after):
+        if before is None or after is None:
+            return f"{before} -> {after}"
+        return f"{before:.4f} -> {after:.4f} ({after - before:+.4f})"
+
+    print(f"mAP: {change(old['mAP'], new['mAP'])}")
+    for threshold in sorted(old["mAP_per_threshold"].keys() & new["mAP_per_threshold"].keys()):
+        print(f"    AP@{threshold}: {change(old['mAP_per_threshold'][threshold], new['mAP_per_threshold'][threshold])}")
+    for name in sorted(old["classes"].keys() | new["classes"].keys()):
+        before = old["classes"].get(name, {}).get("AP")
+        after = new["classes"].get(name, {}).get("AP")
+        if before != after:
+            print(f"{name}: {change(before, after)}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python metrics.py old.json new.json")
+        sys.exit(1)
+    with open(sys.argv[1], encoding="utf-8") as old_file, open(sys.argv[2], encoding="utf-8") as new_file:
+        compare_reports(json.load(old_file), json.load(new_file))
@@ -0,0 +1,161 @@
+"""
+    This module contains the precision modes of the
+    training and the evaluation.
+
+    The "bf16" mode runs the forward pass under torch.autocast
+    with bfloat16 and keeps the backbone in channels_last
+    memory format, which uses the bfloat16 and AMX/AVX-512
+    kernels of modern CPUs. The "fp32" mode is the default.
+
+    Running the module benchmarks the modes on the dataset:
+
+        python precision.py
+"""
+
+import copy
+from contextlib import nullcontext
+from time import perf_counter
+
+import torch
+
+PRECISIONS = ("fp32", "bf16")
+
+
+def check_precision(precision):
+    """
+        Validates the precision mode name.
+
+        Args:
+            precision (str): "fp32" or "bf16"
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+
+
+def prepare_model(model, precision):
+    """
+        Converts the model to the memory format of the mode.
+        The weights stay in float32.
+
+        Args:
+            model (Module): Faster RCNN model
+            precision (str): "fp32" or "bf16"
+
+        Returns:
+            The model
+    """
+    check_precision(precision)
+    if precision == "bf16":
+        model.backbone.to(memory_format=torch.channels_last)
+    return model
+
+
+def autocast(precision, device):
+    """
+        Context manager running the enclosed forward pass
+        in the precision of the mode.
+
+        Args:
+            precision (str): "fp32" or "bf16"
+            device (device): Device of the model
+
+        Returns:
+            Autocast context manager
+    """
+    check_precision(precision)
+    if precision == "bf16":
+        return torch.autocast(device.type, dtype=torch.bfloat16)
+    return nullcontext()
+
+
+def benchmark(model, batches, steps=10, warmup=2, lr=1e-5):
+    """
+        Compares the training and inference throughput of
+        the precision modes on the same batches and weights,
+        and the losses of the modes on the first batch.
+
+        Args:
+            model (Module): Faster RCNN model on the CPU
+            batches (list): Collated (images, targets) batches,
+                reused in a cycle
+            steps (int): Timed steps per mode
+            warmup (int): Untimed steps per mode
+            lr (float): Learning rate of the training steps
+
+        Returns:
+            Dictionary of results per mode
+    """
+    device = torch.device("cpu")
+    results = {}
+
+    for precision in PRECISIONS:
+        mode_model = prepare_model(copy.deepcopy(model), precision)
+        optimizer = torch.optim.Adam(mode_model.parameters(), lr=lr)
+        images = 0
+
+        # Loss of the first batch with the same weights in every
+        # mode. The RPN and the ROI heads sample the proposals
+        # randomly in train mode, so they draw the same samples
+        mode_model.train()
+        with torch.no_grad(), autocast(precision, device), torch.random.fork_rng():
+            torch.manual_seed(0)
+            img, targets = batches[0]
+            first_loss = float(sum(mode_model(list(img), list(targets)).values()))
+
+        for step in range(warmup + steps):
+            if step == warmup:
+                start = perf_counter()
+                images = 0
+            img, targets = batches[step % len(batches)]
+            with autocast(precision, device):
+                losses = sum(mode_model(list(img), list(targets)).values())
+            optimizer.zero_grad()
+            losses.backward()
+            optimizer.step()
+            images += len(img)
+        train_speed = images / (perf_counter() - start)
+
+        mode_model.eval()
+        with torch.no_grad(), autocast(precision, device):
+            for step in range(warmup + steps):
+                if step == warmup:
+                    start = perf_counter()
+                    images = 0
+                img, _ = batches[step % len(batches)]
+                mode_model(list(img))
+                images += len(img)
+        eval_speed = images / (perf_counter() - start)
+
+        results[precision] = {"loss": first_loss, "train": train_speed, "eval": eval_speed}
+        print(f"{precision}: loss {first_loss:.4f}, train {train_speed:.2f} images/s, "
+              f"eval {eval_speed:.2f} images/s")
+
+    # bfloat16 has 8 bits of mantissa, so the losses should agree
+    # to about a percent
+    difference = abs(results["bf16"]["loss"] - results["fp32"]["loss"]) / max(abs(results["fp32"]["loss"]), 1e-12)
+    results["loss_difference"] = difference
+    print(f"Relative loss difference {difference:.2%} "
+          f"({'OK' if difference < .05 else 'CHECK: bf16 loss deviates from fp32'})")
+    print(f"Speedup train {results['bf16']['train'] / results['fp32']['train']:.2f}x, "
+          f"eval {results['bf16']['eval'] / results['fp32']['eval']:.2f}x")
+    return results
+
+
+if __name__ == "__main__":
+    import torchvision as tv
+
+    from anchors import load_anchors
+    from dataset import CustomDataset
+    from rcnn import collate, faster_rcnn, get_vocabulary, target_transform
+
+    vocabulary = get_vocabulary()
+    dataset = CustomDataset(
+        root_dir='./data',
+        transform=tv.transforms.ToTensor(),
+        target_transform=target_transform,
+        compiled=True,
+        vocabulary=vocabulary
+    )
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=2, collate_fn=collate)
+    batches = [batch for batch, _ in zip(dataloader, range(4))]
+    benchmark(faster_rcnn(len(vocabulary), anchors=load_anchors()), batches)
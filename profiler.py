@@ -0,0 +1,145 @@
+"""
+    This module contains the step-level instrumentation
+    of `train_rcnn`.
+
+    Every training step is split into data wait, host to
+    device copy, forward, backward and optimizer times,
+    which are written together with the loss components
+    to a JSONL log. Optionally a window of steps is
+    recorded with torch.profiler into a Chrome trace.
+"""
+
+import json
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter, time
+
+import torch
+
+# The timed phases of a step in the order they run
+PHASES = ("data", "copy", "forward", "backward", "optimizer")
+
+
+class StepProfiler:
+    """
+        Records the timing breakdown and the losses of
+        every training step.
+
+        Attributes:
+            log_path (str): JSONL file to append the steps to,
+                or None to only keep the epoch totals
+            trace_steps (tuple): (first, last) global steps
+                to record with torch.profiler, or None
+            trace_path (str): Chrome trace file of the window
+            totals (dict): Seconds per phase in the epoch
+    """
+
+    def __init__(self, log_path=None, trace_steps=None, trace_path="trace.json"):
+        self.log_path = log_path
+        self.trace_steps = trace_steps
+        self.trace_path = trace_path
+        self.totals = defaultdict(float)
+        self.global_step = 0
+        self.synchronize = False
+        self._times = {}
+        self._log = None
+        self._profile = None
+
+    def start(self, device):
+        """
+            Opens the log before the training.
+
+            Args:
+                device (device): Training device. CUDA is
+                    synchronized around the timed phases
+        """
+        self.synchronize = "cuda" in device.type
+        if self.log_path is not None:
+            self._log = open(self.log_path, "a", encoding="utf-8")
+
+    def close(self):
+        """
+            Closes the log and finishes an unfinished trace.
+        """
+        self._stop_trace()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def begin_step(self, data_time, copy_time):
+        """
+            Starts a step after its batch is loaded.
+
+            Args:
+                data_time (float): Seconds waited for the batch
+                copy_time (float): Seconds of the device copy
+        """
+        if self.trace_steps is not None and self.global_step == self.trace_steps[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.synchronize:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._profile = torch.profiler.profile(activities=activities)
+            self._profile.__enter__()
+
+        self._times = {"data": data_time, "copy": copy_time}
+
+    @contextmanager
+    def phase(self, name):
+        """
+            Times a phase of the step and labels it in the trace.
+
+            Args:
+                name (str): Phase name, one of PHASES
+        """
+        with torch.profiler.record_function(name):
+            start = perf_counter()
+            yield
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self._times[name] = perf_counter() - start
+
+    def end_step(self, epoch, step, loss_dict, images):
+        """
+            Finishes a step and writes it to the log.
+
+            Args:
+                epoch (int): Epoch of the step
+                step (int): Step within the epoch
+                loss_dict (dict): Loss components of the model
+                images (int): Images in the batch
+        """
+        for name, seconds in self._times.items():
+            self.totals[name] += seconds
+
+        if self._log is not None:
+            record = {
+                "time": time(),
+                "epoch": epoch,
+                "step": step,
+                "global_step": self.global_step,
+                "images": images,
+                **{f"{name}_time": self._times.get(name, .0) for name in PHASES},
+                **{name: float(value) for name, value in loss_dict.items()},
+            }
+            self._log.write(json.dumps(record) + "\n")
+
+        if self.trace_steps is not None and self.global_step == self.trace_steps[1]:
+            self._stop_trace()
+        self.global_step += 1
+
+    def epoch_summary(self):
+        """
+            Formats and resets the phase totals of the epoch.
+
+            Returns:
+                Summary string of seconds per phase
+        """
+        summary = ", ".join(f"{name} {self.totals[name]:.2f}s" for name in PHASES)
+        self.totals.clear()
+        return summary
+
+    def _stop_trace(self):
+        if self._profile is not None:
+            self._profile.__exit__(None, None, None)
+            self._profile.export_chrome_trace(self.trace_path)
+            self._profile = None
@@ -0,0 +1,235 @@
+"""
+    This module contains the int8 quantization of the
+    trained model for the inference on CPUs.
+
+    The "dynamic" mode quantizes the weights of the fully
+    connected box head, which needs no calibration. The
+    "static" mode also folds the batch norms of the
+    backbone into its convolutions and quantizes the whole
+    backbone, the ResNet and the FPN, with the activation
+    ranges calibrated on a subset of the dataset. The box
+    predictor stays in float32 in both modes.
+
+    Running the module exports the quantized model next to
+    the fp32 model and compares their accuracy and latency:
+
+        python quantization.py --mode static
+"""
+
+import argparse
+import copy
+from time import perf_counter
+
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from torchvision.ops import box_iou
+from torchvision.ops.misc import FrozenBatchNorm2d
+
+QUANTIZATIONS = ("fp32", "dynamic", "static")
+# The exported weights of the quantized models
+QUANTIZED_SAVEPATHS = {
+    "dynamic": "model_dynamic.pth",
+    "static": "model_static.pth",
+}
+
+
+def check_quantization(quantization):
+    """
+        Validates the quantization mode name.
+
+        Args:
+            quantization (str): "fp32", "dynamic" or "static"
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {quantization}, expected one of {QUANTIZATIONS}")
+
+
+def is_quantized(model):
+    """
+        Returns:
+            True if the model is returned by quantize
+    """
+    return getattr(model, "quantization", "fp32") != "fp32"
+
+
+def fold_batch_norms(module):
+    """
+        Folds every batch norm which follows a convolution into
+        the weights and the bias of the convolution and replaces
+        it with an identity, in place. The quantized convolutions
+        then run without float operations between them. The
+        pretrained backbones use FrozenBatchNorm2d, the others
+        BatchNorm2d, which must be in eval mode.
+
+        Args:
+            module (Module): Module containing the convolutions,
+                e.g. the ResNet body of the backbone
+    """
+    for child in module.children():
+        fold_batch_norms(child)
+
+    names = list(module._modules)
+    for conv_name, norm_name in zip(names, names[1:]):
+        conv, norm = module._modules[conv_name], module._modules[norm_name]
+        if isinstance(conv, torch.nn.Conv2d) and isinstance(norm, (FrozenBatchNorm2d, torch.nn.BatchNorm2d)):
+            weight = norm.weight if norm.weight is not None else torch.ones_like(norm.running_var)
+            norm_bias = norm.bias if norm.bias is not None else torch.zeros_like(norm.running_mean)
+            scale = weight * (norm.running_var + norm.eps).rsqrt()
+            bias = norm_bias - norm.running_mean * scale
+            if conv.bias is not None:
+                bias = bias + conv.bias * scale
+            conv.weight = torch.nn.Parameter(conv.weight.detach() * scale.reshape(-1, 1, 1, 1))
+            conv.bias = torch.nn.Parameter(bias.detach())
+            module._modules[norm_name] = torch.nn.Identity()
+
+
+def quantize(model, quantization, calibration=()):
+    """
+        Creates an int8 quantized copy of the model for
+        the inference on CPU.
+
+        Without calibration the static mode only creates the
+        structure of the quantized model, e.g. to load the
+        exported weights into.
+
+        Args:
+            model (Module): Trained Faster RCNN model
+            quantization (str): "dynamic" or "static"
+            calibration (iterable): Lists of image tensors run
+                through the model to calibrate the activation
+                ranges of the static mode
+
+        Returns:
+            Quantized model in eval mode
+    """
+    check_quantization(quantization)
+    model = copy.deepcopy(model).cpu().eval()
+    if quantization == "fp32":
+        return model
+
+    if quantization == "static":
+        fold_batch_norms(model.backbone.body)
+        example = torch.zeros(1, 3, 64, 64)
+        qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+        # The observers record the ranges of the normalized
+        # and batched images the backbone is given by the model
+        model.backbone = prepare_fx(model.backbone, qconfig_mapping, (example,))
+        with torch.no_grad():
+            for img in calibration:
+                model(list(img))
+        model.backbone = convert_fx(model.backbone)
+
+    model.roi_heads.box_head = quantize_dynamic(model.roi_heads.box_head, {torch.nn.Linear}, dtype=torch.qint8)
+    model.quantization = quantization
+    return model
+
+
+def calibration_images(dataset, size=32, batch_size=4, seed=0):
+    """
+        Samples the calibration images from the dataset.
+
+        Args:
+            dataset (Dataset): Dataset of (image tensor, target)
+            size (int): Number of calibration images
+            batch_size (int): Images per calibration batch
+            seed (int): Seed of the sampling
+
+        Returns:
+            List of image lists
+    """
+    generator = torch.Generator().manual_seed(seed)
+    indices = torch.randperm(len(dataset), generator=generator)[:size].tolist()
+    images = [dataset[index][0] for index in indices]
+    return [images[start:start + batch_size] for start in range(0, len(images), batch_size)]
+
+
+def compare(model, quantized_model, dataset, size=16, iou_threshold=.5, score_limit=.5):
+    """
+        Compares the latency and the accuracy of the fp32
+        and the quantized model on the same images, one image
+        at a time.
+
+        The accuracy is the recall of the ground truth boxes
+        by the detections of the same label, and the agreement
+        is the share of the fp32 detections which the
+        quantized model also detects.
+
+        Args:
+            model (Module): The fp32 model
+            quantized_model (Module): The quantized model
+            dataset (Dataset): Dataset of (image tensor, target)
+                with class id labels
+            size (int): Number of compared images
+            iou_threshold (float): IoU of a matching box
+            score_limit (float): Minimum score of a detection
+
+        Returns:
+            Dictionary of the results
+    """
+    def matched(boxes, labels, other_boxes, other_labels):
+        if not len(boxes) or not len(other_boxes):
+            return 0
+        iou = box_iou(boxes, other_boxes)
+        iou[labels[:, None] != other_labels[None, :]] = 0
+        return int((iou.max(dim=1).values >= iou_threshold).sum())
+
+    model = model.cpu().eval()
+    results = {name: {"time": .0, "found": 0} for name in ("fp32", "int8")}
+    ground_truths = detections = agreed = 0
+
+    with torch.no_grad():
+        for index in range(min(size, len(dataset))):
+            img, target = dataset[index]
+            outputs = {}
+            for name, mode_model in (("fp32", model), ("int8", quantized_model)):
+                start = perf_counter()
+                output = mode_model([img])[0]
+                results[name]["time"] += perf_counter() - start
+                keep = output["scores"] >= score_limit
+                outputs[name] = (output["boxes"][keep], output["labels"][keep])
+                results[name]["found"] += matched(target["boxes"], target["labels"], *outputs[name])
+            ground_truths += len(target["boxes"])
+            detections += len(outputs["fp32"][0])
+            agreed += matched(*outputs["fp32"], *outputs["int8"])
+
+    images = min(size, len(dataset))
+    threads = torch.get_num_threads()
+    for name, result in results.items():
+        result["recall"] = result["found"] / max(ground_truths, 1)
+        result["latency"] = result["time"] / max(images, 1)
+        result["images_per_core"] = images / result["time"] / threads
+        print(f"{name}: recall {result['recall']:.2%}, latency {result['latency'] * 1000:.0f} ms, "
+              f"{result['images_per_core']:.2f} images/s per core")
+    results["agreement"] = agreed / max(detections, 1)
+    print(f"Speedup {results['fp32']['latency'] / results['int8']['latency']:.2f}x, "
+          f"int8 agrees with {results['agreement']:.2%} of the fp32 detections")
+    return results
+
+
+if __name__ == "__main__":
+    import torchvision as tv
+
+    from anchors import load_anchors
+    from dataset import CustomDataset
+    from rcnn import faster_rcnn, get_vocabulary, target_transform
+
+    parser = argparse.ArgumentParser(description="Exports the int8 quantized model")
+    parser.add_argument("--mode", choices=QUANTIZATIONS[1:], default="static", help="Quantization mode")
+    parser.add_argument("--calibration", type=int, default=32, help="Number of calibration images")
+    parser.add_argument("--compare", type=int, default=16, help="Number of compared images")
+    args = parser.parse_args()
+
+    vocabulary = get_vocabulary()
+    dataset = CustomDataset(
+        root_dir='./data',
+        transform=tv.transforms.ToTensor(),
+        target_transform=target_transform,
+        compiled=True,
+        vocabulary=vocabulary
+    )
+    model = faster_rcnn(len(vocabulary), load=True, anchors=load_anchors())
+    quantized_model = quantize(model, args.mode, calibration_images(dataset, args.calibration))
+    torch.save(quantized_model.state_dict(), QUANTIZED_SAVEPATHS[args.mode])
+    print(f"Saved {QUANTIZED_SAVEPATHS[args.mode]}")
+    compare(model, quantized_model, dataset, args.compare)
@@ -11,24 +11,44 @@
         0.0.1 Runnable version
 """
 
+import functools
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from time import time
 
+import numpy as np
 import torch
 import torchvision as tv
-from PIL import ImageDraw
+from PIL import Image, ImageDraw
 
+from anchors import create_anchor_generator, load_anchors
+from checkpoint import CheckpointManager, set_rng_state
 from dataset import CustomDataset
+from distributed import get_rank, is_distributed, is_main_process, unwrap
+from loader import DevicePrefetcher, LoaderConfig, create_dataloader
+from metrics import DetectionEvaluator
+from precision import autocast, check_precision, prepare_model
+from profiler import StepProfiler
+from quantization import (QUANTIZED_SAVEPATHS, calibration_images, check_quantization, is_quantized,
+                          quantize)
+from sampler import GroupedBatchSampler, create_groups
+from src.config import MODEL_PATH
+from src.validator import DEGENERATE, INVERTED, validate_annotations
+from src.vocabulary import Vocabulary
 
 __authors__ = ("Otso Brummer",)
 __date__ = "23.3.2021"
 __version__ = "0.0.1"
 
-MODEL_SAVEPATH = "model.pth"
+# The same file the pre-annotator loads, whatever the working directory
+MODEL_SAVEPATH = MODEL_PATH
 EXPORT_FOLDER = "export"
+REPORT_PATH = "evaluation.json"
 
 
-def faster_rcnn(num_classes, load=False):
+def faster_rcnn(num_classes, load=False, quantization="fp32", anchors=None):
     """
         Creates torchvision fasterrcnn_resnet50_fpn
         model with number of classes given
@@ -36,15 +56,44 @@ def faster_rcnn(num_classes, load=False):
         Args:
             num_classes (int): Number of export classes
                 including background
+            load (bool): Load the trained weights. If the
+                training did not finish, the weights of the
+                latest good checkpoint are loaded
+            quantization (str): "fp32", or "dynamic"/"static"
+                for the int8 model exported by quantization.py,
+                which runs on CPU only
+            anchors (dict): Anchor sizes and aspect ratios per
+                FPN level fitted by anchors.py, or None for the
+                torchvision defaults. The trained weights only
+                work with the anchors they were trained with
         Returns:
             Torchvision Faster RCNN model
     """
+    check_quantization(quantization)
+    options = {}
+    if anchors is not None:
+        options["rpn_anchor_generator"] = create_anchor_generator(anchors)
     model = tv.models.detection.fasterrcnn_resnet50_fpn(
-        num_classes=num_classes
+        num_classes=num_classes,
+        **options
     )
 
-    if load:
-        model.load_state_dict(torch.load(MODEL_SAVEPATH))
+    if quantization != "fp32":
+        model = quantize(model, quantization)
+        if load:
+            # The packed int8 weights are not plain tensors
+            model.load_state_dict(torch.load(QUANTIZED_SAVEPATHS[quantization], weights_only=False))
+    elif load:
+        if os.path.isfile(MODEL_SAVEPATH):
+            model.load_state_dict(torch.load(MODEL_SAVEPATH))
+        else:
+            checkpoints = CheckpointManager()
+            state = checkpoints.load_latest("cpu")
+            checkpoints.close()
+            if state is None:
+                raise FileNotFoundError(f"No {MODEL_SAVEPATH} or checkpoints to load")
+            print(f"Loading checkpoint of epoch {state['epoch']} step {state['step']}")
+            model.load_state_dict(state["model"])
     return model
 
 
@@ -74,7 +123,32 @@ def collate(batch):
     return tuple(zip(*batch))
 
 
-def train_rcnn(dataset, model, epochs=10, lr=1e-5):
+def create_batch_sampler(dataset, batch_size, sampler=None):
+    """
+        Creates batch sampler which shuffles the dataset and
+        batches images of similar aspect ratio together, so
+        that little compute is wasted on padding.
+
+        Args:
+            dataset (Dataset): Dataset with image_sizes method
+            batch_size (int): Size of the batches
+            sampler (Sampler): Sampler of the indices, e.g. the
+                DistributedSampler of a rank. Defaults to
+                shuffling the whole dataset
+
+        Returns:
+            GroupedBatchSampler over the dataset
+    """
+    return GroupedBatchSampler(
+        sampler if sampler is not None else torch.utils.data.RandomSampler(dataset),
+        create_groups(dataset.image_sizes()),
+        batch_size
+    )
+
+
+def train_rcnn(dataset, model, epochs=10, lr=1e-5, batch_size=1, loader_config=None,
+               profiler=None, checkpoints=None, checkpoint_every=None, resume=False,
+               precision="fp32"):
     """
         Train rcnn with provided dataset and save to
         defined model path.
@@ -84,67 +158,187 @@ def train_rcnn(dataset, model, epochs=10, lr=1e-5):
             model (Module): RCNN torch module
             epochs (int): How many epochs to run
             lr (float): Learning rate to be used
+            batch_size (int): How many images per step. Batches
+                are grouped by aspect ratio if the dataset
+                has image_sizes method
+            loader_config (LoaderConfig): Data pipeline
+                configuration, defaults to LoaderConfig()
+            profiler (StepProfiler): Step instrumentation, give
+                log_path to write every step to a JSONL log
+            checkpoints (CheckpointManager): Checkpoint writer,
+                defaults to CheckpointManager()
+            checkpoint_every (int): Steps between checkpoints,
+                None to take them only at the end of epochs
+            resume (bool): Continue from the latest checkpoint.
+                An interrupted epoch runs its remaining number
+                of steps on a new shuffle. Otherwise the
+                checkpoints of an earlier run are deleted
+            precision (str): "fp32", or "bf16" for bfloat16
+                autocast and channels_last backbone
     """
+    check_precision(precision)
     device = create_device()
+    if loader_config is None:
+        loader_config = LoaderConfig()
+    if profiler is None:
+        profiler = StepProfiler()
+    if checkpoints is None:
+        checkpoints = CheckpointManager()
+    # In the distributed training every rank samples its own slice
+    sampler = None
+    if is_distributed() and not isinstance(dataset, torch.utils.data.IterableDataset):
+        sampler = torch.utils.data.DistributedSampler(dataset, shuffle=True)
+    # Group the batches by the image shapes if possible
+    if isinstance(dataset, torch.utils.data.IterableDataset):
+        # Streaming datasets shuffle and split themselves
+        batching = {"batch_size": batch_size}
+    elif batch_size > 1 and hasattr(dataset, "image_sizes"):
+        batching = {"batch_sampler": create_batch_sampler(dataset, batch_size, sampler)}
+    elif sampler is not None:
+        batching = {"batch_size": batch_size, "sampler": sampler}
+    else:
+        batching = {"batch_size": batch_size, "shuffle": True}
     # DataLoader class handles parallelization
     # in torch
-    dataloader = torch.utils.data.DataLoader(
-        dataset=dataset,
-        batch_size=1,
-        shuffle=True,
-        pin_memory="cuda" in device.type,
-        num_workers=1,
-        collate_fn=collate
-    )
+    dataloader = create_dataloader(dataset, loader_config, collate, device, **batching)
+    # The next batches are moved to the device in background
+    # while the current step runs
+    batches = DevicePrefetcher(dataloader, device, loader_config.device_prefetch)
 
-    model = model.to(device)
+    model = prepare_model(model.to(device), precision)
     # Optimizer tries to
     # change kernel values to optinum
     optimizer = torch.optim.Adam(
         model.parameters(),
         lr=lr
     )
+    # Position to continue the training from
+    start_epoch, start_step = 0, 0
+    if resume:
+        state = checkpoints.load_latest("cpu")
+        if state is not None:
+            model.load_state_dict(state["model"])
+            optimizer.load_state_dict(state["optimizer"])
+            set_rng_state(state["rng"])
+            start_epoch, start_step = state["epoch"], state["step"]
+            print(f"Resuming from epoch {start_epoch + 1} step {start_step}")
+    elif is_main_process():
+        checkpoints.clear()
+    if is_distributed():
+        # Averages the gradients between the ranks. The weights
+        # of the rank 0 are copied to the other ranks here
+        model = torch.nn.parallel.DistributedDataParallel(model)
+        # Only the main process writes the checkpoints
+        if not is_main_process():
+            checkpoints.close()
+            checkpoints = None
     # Start time used in prints
     start = time()
 
     print(f"Starting training with dataset sized {len(dataset)}")
+    profiler.start(device)
+
+    try:
+        for epoch in range(start_epoch, epochs):
+            if sampler is not None:
+                # Shuffles the slices differently every epoch
+                sampler.set_epoch(epoch)
+            elif hasattr(dataset, "set_epoch"):
+                # Streaming datasets shuffle their shards by the
+                # epoch, also in workers which are not persistent
+                dataset.set_epoch(epoch)
+            train_epoch(model, optimizer, batches, profiler, checkpoints, checkpoint_every,
+                        epoch, start_step if epoch == start_epoch else 0, start, precision)
+    finally:
+        profiler.close()
+        # Finish the last checkpoint even if the training crashed
+        if checkpoints is not None:
+            checkpoints.close()
+
+    if is_main_process():
+        torch.save(unwrap(model).state_dict(), MODEL_SAVEPATH)
+
+
+def train_epoch(model, optimizer, batches, profiler, checkpoints, checkpoint_every,
+                epoch, first_step, start, precision="fp32"):
+    """
+        Runs one epoch of train_rcnn.
 
-    for epoch in range(epochs):
-        epoch_loss = .0
-
-        for index, (img, targets) in enumerate(dataloader):
-            # The img and targets are list of values
-            # Here we move them to used device
-            img = [item.to(device) for item in img]
-            for target in targets:
-                for key in target:
-                    target[key] = target[key].to(device)
-
-            optimizer.zero_grad()
-
-            output = model(img, targets)
-
-            # Sum of
-            # loss_classifier
-            # loss_box_reg
-            # loss_objective
-            # loss_rpn_box_reg
-            losses = sum(output.values())
+        Args:
+            model (Module): RCNN torch module on the device,
+                possibly wrapped in DistributedDataParallel
+            optimizer (Optimizer): Optimizer of the model
+            batches (DevicePrefetcher): Batches on the device
+            profiler (StepProfiler): Step instrumentation
+            checkpoints (CheckpointManager): Checkpoint writer,
+                None in the ranks which do not write them
+            checkpoint_every (int): Steps between checkpoints
+            epoch (int): Index of the epoch
+            first_step (int): Steps of the epoch done before
+                resuming, these are skipped
+            start (float): Training start time used in prints
+            precision (str): "fp32" or "bf16"
+    """
+    epoch_loss = .0
+    epoch_images = 0
+    epoch_start = time()
+    steps = len(batches) - first_step
+    # The ranks may get a different number of batches. Join
+    # lets the ranks which finish first wait for the others
+    join = model.join() if isinstance(model, torch.nn.parallel.DistributedDataParallel) else nullcontext()
+
+    # The img and targets are list of values
+    # already moved to used device
+    with join:
+        for index, (img, targets) in enumerate(batches):
+            if index >= steps:
+                break
+            step = first_step + index
+            profiler.begin_step(batches.last_wait, batches.last_copy)
+
+            with profiler.phase("forward"), autocast(precision, batches.device):
+                output = model(img, targets)
+
+                # Sum of
+                # loss_classifier
+                # loss_box_reg
+                # loss_objective
+                # loss_rpn_box_reg
+                losses = sum(output.values())
+
+            with profiler.phase("backward"):
+                optimizer.zero_grad()
+                losses.backward()
+
+            with profiler.phase("optimizer"):
+                optimizer.step()
 
-            losses.backward()
-            optimizer.step()
             epoch_loss += float(losses.item())
+            epoch_images += len(img)
+            profiler.end_step(epoch, step, output, len(img))
+
+            if checkpoints is not None and checkpoint_every and (step + 1) % checkpoint_every == 0:
+                checkpoints.save(unwrap(model), optimizer, epoch, step + 1)
 
             # TODO: You can remove this if you like
             # This is a heavy model so break the training early
             # if index > 10:
             #     break
-        minutes = int((time() - start) // 60)
-        seconds = (time() - start) % 60
-        print(
-            f"Epoch {epoch + 1}: Elapsed {minutes:2d}:{seconds:2.2f}, loss {epoch_loss:.2f}")
-
-    torch.save(model.state_dict(), MODEL_SAVEPATH)
+    # The next epoch starts from its first step
+    if checkpoints is not None:
+        checkpoints.save(unwrap(model), optimizer, epoch + 1, 0)
+
+    minutes = int((time() - start) // 60)
+    seconds = (time() - start) % 60
+    epoch_time = time() - epoch_start
+    images_per_second = epoch_images / epoch_time
+    # Every rank reports its own throughput
+    rank = f"Rank {get_rank()}: " if is_distributed() else ""
+    print(
+        f"{rank}Epoch {epoch + 1}: Elapsed {minutes:2d}:{seconds:2.2f}, loss {epoch_loss:.2f}, "
+        f"{images_per_second:.2f} images/s, "
+        f"data wait {batches.wait_time:.2f}s ({batches.wait_time / epoch_time:.0%})")
+    print(f"    {profiler.epoch_summary()}")
 
 
 # The drawing constants
@@ -155,71 +349,231 @@ BLUE = (0, 0, 255)
 SCORE_LIMIT = 0.5
 
 
-def evaluate_dataset(dataset, model):
+def draw_evaluation(path, img, boxes, labels, scores, gt_boxes, gt_labels):
+    """
+        Draws model guesses and ground truths on image and
+        saves it. Runs in the export worker processes.
+
+        Args:
+            path (str): Path to save the image to, the format
+                is given by the suffix
+            img (ndarray): (H, W, 3) uint8 image
+            boxes (ndarray): Guessed boxes above score limit
+            labels (ndarray): Guessed labels
+            scores (ndarray): Guess scores
+            gt_boxes (ndarray): Ground truth boxes
+            gt_labels (ndarray): Ground truth labels
+    """
+    pil = Image.fromarray(img)
+    # PIL drawer
+    draw = ImageDraw.Draw(pil)
+    # Iterate all guesses and draw them to image
+    for guess_box, label, score in zip(boxes, labels, scores):
+        draw.rectangle(
+            tuple(map(int, guess_box)),
+            outline=BLUE
+        )
+        draw.text((guess_box[0], guess_box[1]),
+                  f"{int(label)} {float(score):.2f}")
+    # Print also the ground truths to the image
+    for gt, label in zip(gt_boxes, gt_labels):
+        draw.rectangle(
+            tuple(map(int, gt)),
+            outline=GREEN
+        )
+        draw.text((gt[0], gt[1]), f"{int(label)}")
+
+    if path.endswith(".png"):
+        # Fastest zlib level, the files are only for viewing
+        pil.save(path, compress_level=1)
+    else:
+        pil.save(path, quality=90)
+
+
+def evaluate_dataset(dataset, model, batch_size=4, num_workers=None,
+                     draw=True, image_format="png", max_pending=16,
+                     precision="fp32", quantization="fp32", calibration_size=32,
+                     ap_style="coco", iou_thresholds=None, class_names=None,
+                     report_path=REPORT_PATH):
     """
         Exports model evaluations and ground truths
-        on given dataset to evaluation folder
+        on given dataset to evaluation folder and writes
+        the average precisions to a JSON report
+
+        The images are evaluated in batches and drawn and
+        saved in a process pool, so the inference does not
+        wait on the image encoding.
 
         Args:
             dataset (Dataset): Torch dataset to be evaluated
             model (Module): Torch module to use
+            batch_size (int): How many images per inference
+            num_workers (int): Size of the export process pool,
+                defaults to the number of CPUs
+            draw (bool): Whether to draw and export the images
+            image_format (str): "png" or "jpeg"
+            max_pending (int): How many exported images may
+                wait in the pool before inference blocks
+            precision (str): "fp32", or "bf16" for bfloat16
+                autocast and channels_last backbone
+            quantization (str): "fp32", or "dynamic"/"static" to
+                evaluate an int8 quantized copy of the fp32 model
+                on CPU. A model given by faster_rcnn with the
+                quantization is used as is
+            calibration_size (int): Images of the dataset used to
+                calibrate the static quantization
+            ap_style (str): "coco" or "voc" average precision
+            iou_thresholds (list): IoU thresholds of the average
+                precision, defaults to those of the style
+            class_names (list): Names of the class ids in the
+                report, e.g. the classes of the vocabulary
+            report_path (str): Path to the JSON report, or None
+                to not write it
+
+        Returns:
+            Dictionary of the report
     """
+    if image_format not in ("png", "jpeg"):
+        raise ValueError(f"Unknown image format {image_format}")
+    check_quantization(quantization)
+    if quantization != "fp32" and not is_quantized(model):
+        model = quantize(model, quantization, calibration_images(dataset, calibration_size))
+    if is_quantized(model) and precision != "fp32":
+        raise ValueError("The int8 quantized model runs in fp32 precision only")
+
     print("Evaluating images")
     # Move to production mode
     model.eval()
+    prepare_model(model, precision)
+    device = next(model.parameters()).device
 
     os.makedirs(EXPORT_FOLDER, exist_ok=True)
-    # Pil transformation function
-    to_pil = tv.transforms.ToPILImage()
+
+    # The dataset is read in order so the exported
+    # image names follow the dataset indices
+    dataloader = torch.utils.data.DataLoader(
+        dataset=dataset,
+        batch_size=batch_size,
+        collate_fn=collate
+    )
+    executor = ProcessPoolExecutor(num_workers) if draw else None
+    pending = deque()
+    index = 0
+    evaluator = DetectionEvaluator(ap_style, iou_thresholds, class_names)
+    inference_time = metrics_time = .0
 
     # Disable autograd. Makes code faster
-    with torch.no_grad():
-        for index, (img, target) in enumerate(dataset):
-            # The model expects and returns a list
-            response = model([img])[0]
-            # Transform to normal image
-            pil = to_pil(img)
-            # PIL drawer
-            draw = ImageDraw.Draw(pil)
-            # Iterate all guesses and draw them to image
-            for guess_box, label, score in zip(response["boxes"], response["labels"], response["scores"]):
-                if score < SCORE_LIMIT:
-                    continue
-
-                draw.rectangle(
-                    tuple(map(int, guess_box)),
-                    outline=BLUE
-                )
-                draw.text((guess_box[0], guess_box[1]),
-                          f"{int(label)} {float(score):.2f}")
-            # Print also the ground truths to the image
-            for gt, label in zip(target["boxes"], target["labels"]):
-                draw.rectangle(
-                    tuple(map(int, gt)),
-                    outline=GREEN
-                )
-                draw.text((gt[0], gt[1]), f"{int(label)}")
-
-            pil.save(f"{EXPORT_FOLDER}/image{index}.png")
-            # TODO: There are a lot of images. You can change this if you like.
-            # if index > 10:
-            #     break
+    try:
+        with torch.no_grad():
+            for img, targets in dataloader:
+                # The model expects and returns a list
+                start = time()
+                with autocast(precision, device):
+                    responses = model(list(img))
+                inference_time += time() - start
+
+                start = time()
+                for target, response in zip(targets, responses):
+                    evaluator.add(
+                        response["boxes"].float().cpu().numpy(),
+                        response["labels"].cpu().numpy(),
+                        response["scores"].float().cpu().numpy(),
+                        target["boxes"].cpu().numpy(),
+                        target["labels"].cpu().numpy()
+                    )
+                metrics_time += time() - start
+
+                for item, target, response in zip(img, targets, responses):
+                    if draw:
+                        keep = response["scores"] >= SCORE_LIMIT
+                        # Bound the memory used by the images in the pool
+                        while len(pending) >= max_pending:
+                            pending.popleft().result()
+                        pending.append(executor.submit(
+                            draw_evaluation,
+                            f"{EXPORT_FOLDER}/image{index}.{image_format}",
+                            # Transform to normal image
+                            item.mul(255).clamp(0, 255).byte().permute(1, 2, 0).cpu().numpy(),
+                            response["boxes"][keep].float().cpu().numpy(),
+                            response["labels"][keep].cpu().numpy(),
+                            response["scores"][keep].float().cpu().numpy(),
+                            target["boxes"].cpu().numpy(),
+                            target["labels"].cpu().numpy()
+                        ))
+                    index += 1
+                # TODO: There are a lot of images. You can change this if you like.
+                # if index > 10:
+                #     break
+
+            # Raise errors of the remaining exports
+            while pending:
+                pending.popleft().result()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    start = time()
+    if report_path is not None:
+        report = evaluator.write_report(report_path, precision=precision, quantization=quantization)
+    else:
+        report = evaluator.summary()
+    metrics_time += time() - start
+    print(f"mAP {report['mAP']} ({ap_style}) on {report['images']} images, "
+          f"metrics took {metrics_time:.2f}s, inference {inference_time:.2f}s")
+    return report
+
+
+def check_annotations():
+    """
+        Checks every box of the annotations before the
+        training with src/validator.py, which takes
+        seconds for a million boxes. The problems are
+        printed, and the labels are compared with the
+        vocabulary before the new labels are added to it.
+
+        Raises:
+            ValueError: If boxes are inverted or have no
+                area, on which the training would fail
+    """
+    report = validate_annotations()
+    if len(report):
+        counts = ", ".join(f"{count} {problem}" for problem, count in report.counts().items() if count)
+        print(f"Annotation problems: {counts}")
+    broken = report.affected(INVERTED | DEGENERATE)
+    if broken:
+        raise ValueError(f"{len(broken)} annotation files have inverted or degenerate boxes, "
+                         f"fix them with python -m src.validator fix")
 
 
 # Rest of the module handles usage of the VOCDection torchvision
 # dataset and might be useful when creating your own dataset
-# TODO: Change amount of classes in your dataset here
-# The background has label 0 and is one of the classes
-CLASS_DICT = {
-        "background": 0,
-        "plane": 1,
-        "train": 2,
-        "keyboard": 3,
-        "monitor": 4,
-        "human": 5,
-        "cat": 6,
-        "duck": 7
-    }
+# The classes are collected from the annotations to
+# data/classes.json. The background has label 0 and is
+# one of the classes
+@functools.lru_cache(maxsize=None)
+def get_vocabulary():
+    """
+        Loads the class vocabulary once per process,
+        adding the new labels of the annotations
+
+        Returns:
+            Vocabulary of the annotation labels
+    """
+    return Vocabulary.load()
+
+
+@functools.lru_cache(maxsize=None)
+def read_vocabulary():
+    """
+        Reads the class vocabulary persisted by
+        get_vocabulary once per process, without adding
+        labels, so the DataLoader workers never compile the
+        annotation index or write data/classes.json
+
+        Returns:
+            Persisted vocabulary
+    """
+    return Vocabulary.read()
 
 
 def target_transform(target):
@@ -229,12 +583,37 @@ def target_transform(target):
         torchvision dataset class
 
         Args:
-            target (dict): Dictionary as given by VOCDetections dataset
+            target (dict): Dictionary as given by VOCDetections dataset,
+                or the compact target of a compiled dataset,
+                or the arrays of a dataset with a vocabulary.
+                The labels are encoded with the vocabulary
+                of get_vocabulary, which is called before
 
         Returns:
             Dictionary with keys 'boxes' and 'labels'
             and their respective boxes
     """
+    # Datasets with a vocabulary give tensor-ready arrays
+    if "boxes" in target and isinstance(target["labels"], np.ndarray):
+        return {
+            "boxes": torch.from_numpy(target["boxes"]).reshape(-1, 4),
+            "labels": torch.from_numpy(target["labels"]),
+        }
+
+    vocabulary = read_vocabulary()
+
+    # Compiled datasets already give the boxes as an array
+    if "boxes" in target:
+        return {
+            "boxes": torch.as_tensor(
+                target["boxes"],
+                dtype=torch.float32
+            ).reshape(-1, 4),
+            "labels": torch.from_numpy(
+                vocabulary.encode(target["labels"])
+            ),
+        }
+
     # Seek relevant objects from XML
     objs = target["annotation"]["object"]
     # Collect all data to lists
@@ -257,7 +636,7 @@ def target_transform(target):
         )
 
         label_name = obj["name"]
-        label = CLASS_DICT[label_name]
+        label = vocabulary[label_name]
         labels.append(label)
 
     # Transform to dataset target element
@@ -274,16 +653,23 @@ def target_transform(target):
 
 
 if __name__ == "__main__":
+    check_annotations()
+    vocabulary = get_vocabulary()
     # TODO: Remove and add your own dataset
     dataset = CustomDataset(
         root_dir='./data',
         transform=tv.transforms.ToTensor(),
-        target_transform=target_transform
+        target_transform=target_transform,
+        compiled=True,
+        cached=True,
+        vocabulary=vocabulary
     )
-    model = faster_rcnn(len(CLASS_DICT))
-    train_rcnn(dataset, model)
+    # The anchors fitted by anchors.py, if any
+    anchors = load_anchors()
+    model = faster_rcnn(len(vocabulary), anchors=anchors)
+    train_rcnn(dataset, model, batch_size=4)
     print("Training done")
     # Test load
-    model = faster_rcnn(len(CLASS_DICT), load=True)
-    # Export images
-    evaluate_dataset(dataset, model)
+    model = faster_rcnn(len(vocabulary), load=True, anchors=anchors)
+    # Export images and the report
+    evaluate_dataset(dataset, model, class_names=vocabulary.classes)
@@ -0,0 +1,99 @@
+"""
+    This module contains the batch sampler which groups
+    images of similar shape to the same batches.
+
+    The detection models pad all the images of a batch to
+    the largest one, so mixing portrait and landscape images
+    wastes most of the batched compute on padding.
+"""
+
+from collections import defaultdict
+from typing import Iterator, List
+
+import numpy as np
+import torch
+
+
+def create_groups(sizes, aspect_ratio_bins=3, size_bins=1):
+    """
+        Assigns every image to a group by its aspect ratio
+        and size, in the same way as the torchvision detection
+        reference scripts.
+
+        Faster R-CNN resizes the images to a common scale
+        itself, so by default only the aspect ratio is used.
+
+        Args:
+            sizes (array): (N, 2) array of (width, height)
+            aspect_ratio_bins (int): Number of aspect ratio bins
+                on both sides of the square aspect ratio
+            size_bins (int): Number of bins for the
+                logarithm of the image area
+
+        Returns:
+            Array of N group ids
+    """
+    sizes = np.asarray(sizes, dtype=np.float64).reshape(-1, 2)
+    if not len(sizes):
+        return np.zeros(0, dtype=np.int64)
+    sizes = np.maximum(sizes, 1)
+
+    # The bins are spaced logarithmically from 1:2 to 2:1
+    bins = 2 ** np.linspace(-1, 1, 2 * aspect_ratio_bins + 1)
+    aspect_ratio_groups = np.digitize(sizes[:, 0] / sizes[:, 1], bins)
+
+    log_areas = np.log2(sizes.prod(axis=1))
+    if size_bins > 1 and log_areas.max() > log_areas.min():
+        size_edges = np.linspace(log_areas.min(), log_areas.max(), size_bins + 1)[1:-1]
+        size_groups = np.digitize(log_areas, size_edges)
+    else:
+        size_groups = np.zeros(len(sizes), dtype=np.int64)
+
+    return aspect_ratio_groups * size_bins + size_groups
+
+
+class GroupedBatchSampler(torch.utils.data.Sampler):
+    """
+        Wraps another sampler to yield batches whose
+        indices all belong to the same group.
+
+        Every group collects the indices in the order of the
+        wrapped sampler and a batch is yielded when it is full.
+        The incomplete batches are yielded at the end, so
+        every index is sampled once per epoch.
+
+        Attributes:
+            sampler (Sampler): Sampler of the dataset indices
+            group_ids (array): Group id of every dataset index
+            batch_size (int): Size of the batches
+    """
+
+    def __init__(self, sampler, group_ids, batch_size):
+        super().__init__()
+        if batch_size < 1:
+            raise ValueError(f"batch_size should be positive, got {batch_size}")
+        self.sampler = sampler
+        self.group_ids = np.asarray(group_ids)
+        self.batch_size = batch_size
+
+    def __iter__(self) -> Iterator[List[int]]:
+        buffers = defaultdict(list)
+        for index in self.sampler:
+            buffer = buffers[self.group_ids[index]]
+            buffer.append(index)
+            if len(buffer) == self.batch_size:
+                yield buffer[:]
+                buffer.clear()
+
+        for buffer in buffers.values():
+            if buffer:
+                yield buffer
+
+    def __len__(self):
+        group_ids = self.group_ids
+        # A sampler of a subset, e.g. the DistributedSampler of a rank,
+        # only batches its own indices. The order does not matter here
+        if len(self.sampler) != len(group_ids):
+            group_ids = group_ids[np.fromiter(self.sampler, dtype=np.int64)]
+        _, counts = np.unique(group_ids, return_counts=True)
+        return int(sum(-(-counts // self.batch_size)))
@@ -2,15 +2,18 @@ import sys
 
 try:
     from PyQt6.QtWidgets import QMainWindow, QApplication, QWidget, QHBoxLayout, QGraphicsScene, QStatusBar, QVBoxLayout
+    from PyQt6.QtGui import QCloseEvent
 except ImportError:
     raise ImportError("Requires PyQt6")
 
+from src.autosave import AutoSaver
 from src.file_list import FileList
 from src.menu_bar import MenuBar
 from src.file_view import FileView
 from src.filter_widget import FilterWidget
 from src.canvas import Canvas
 from src.graphics_view import CustomGraphicsView
+from src.pre_annotator import PreAnnotator
 import src.config
 
 
@@ -25,6 +28,8 @@ class UI(QMainWindow):
         scene (QGraphicsScene): The graphics scene of the UI.
         view (CustomGraphicsView): The custom graphics view instance.
         filter_widget (FilterWidget): The filter widget instace.
+        pre_annotator (PreAnnotator): The background pre-annotation with the trained model.
+        autosaver (AutoSaver): The background saving of the annotations.
     """
 
     def __init__(self) -> None:
@@ -35,6 +40,13 @@ class UI(QMainWindow):
 
         self._config()
 
+        # Pre-annotation, used by the file list and the canvas
+        self.pre_annotator = PreAnnotator(self)
+
+        # Saving of the annotations, used by the file list and the canvas
+        self.autosaver = AutoSaver(self)
+        self.canvas = None
+
         # Set central widget
         self.central_widget = QWidget()
         self.setCentralWidget(self.central_widget)
@@ -62,6 +74,23 @@ class UI(QMainWindow):
         self.layout2.addWidget(self.view)
         self.layout2.addWidget(self.filter_widget)
 
+    def closeEvent(self, event: QCloseEvent) -> None:
+        """ Save the unsaved annotations and stop watching the directories and the pre-annotation workers when the
+        window is closed.
+
+        Args:
+            event (QCloseEvent): The close event.
+
+        Returns:
+            None
+        """
+        if self.canvas is not None:
+            self.autosaver.save(self.canvas.image)
+        self.autosaver.stop()
+        self.file_view.file_list.watcher.stop()
+        self.pre_annotator.stop()
+        super().closeEvent(event)
+
     def _config(self) -> None:
         """ Add configurations to the main window
 
@@ -0,0 +1,298 @@
+import hashlib
+import json
+import os
+import struct
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from src.config import *
+
+# The file starts with the magic bytes and the length of the JSON header, every array is aligned to this many bytes
+MAGIC = b'PAIDX001'
+ALIGNMENT = 64
+
+
+def annotation_signature(annotation_dir: str = ANNOTATION_DIR) -> str:
+    """ Compute a signature of the annotation directory from the file names, sizes and modification times.
+
+    Args:
+        annotation_dir (str): The directory containing the .xml annotation files.
+
+    Returns:
+        signature (str): The hexadecimal digest which changes whenever any annotation file is added, removed or
+            modified.
+    """
+    entries = []
+    with os.scandir(annotation_dir) as iterator:
+        for entry in iterator:
+            if entry.name.endswith('.xml') and entry.is_file():
+                stat = entry.stat()
+                entries.append(f'{entry.name}:{stat.st_mtime_ns}:{stat.st_size}')
+
+    digest = hashlib.sha1()
+    for entry in sorted(entries):
+        digest.update(entry.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def read_annotation(path: str) -> Tuple[Tuple[int, int], List[str], List[Tuple[int, int, int, int]]]:
+    """ Read the image size, the labels and the bounding boxes of an annotation file.
+
+    Args:
+        path (str): The path to the .xml annotation file.
+
+    Returns:
+        Tuple[size, labels, bounding_boxes]
+    """
+    root = ET.parse(path).getroot()
+
+    size = root.find('size')
+    width = int(size.findtext('width', 0)) if size is not None else 0
+    height = int(size.findtext('height', 0)) if size is not None else 0
+
+    labels = []
+    bounding_boxes = []
+    for obj in root.iter('object'):
+        bounding_box = obj.find('bndbox')
+        labels.append(obj.findtext('name'))
+        bounding_boxes.append((
+            int(bounding_box.findtext('xmin')),
+            int(bounding_box.findtext('ymin')),
+            int(bounding_box.findtext('xmax')),
+            int(bounding_box.findtext('ymax')),
+        ))
+
+    return (width, height), labels, bounding_boxes
+
+
+class AnnotationIndex:
+    """ A compiled, memory-mapped index of all the annotations in a directory.
+
+    The annotations are stored column-wise in a single file as flat arrays. The boxes and the label ids of the image
+    at row i are found in the slice offsets[i]:offsets[i + 1]. The arrays are memory-mapped lazily in every process,
+    so the index can be shared with the DataLoader workers without parsing or copying.
+
+    Attributes:
+        path (Path): The path to the compiled index file.
+        signature (str): The signature of the annotation directory the index was compiled from.
+        names (List[str]): The file name stems of the annotation files, one per row.
+        classes (List[str]): The label names, indexed by the label ids.
+    """
+
+    def __init__(self, path: str = ANNOTATION_INDEX_PATH):
+        """ Open the index file and read its header. The arrays are mapped on the first access.
+
+        Args:
+            path (str): The path to the compiled index file.
+        """
+        self.path = Path(path)
+
+        with open(self.path, 'rb') as file:
+            magic = file.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError(f'{self.path} is not an annotation index')
+            header_length, = struct.unpack('<Q', file.read(8))
+            header = json.loads(file.read(header_length))
+
+        self.signature = header['signature']
+        self.names = header['names']
+        self.classes = header['classes']
+        self._layout = header['arrays']
+        self._rows = {name: row for row, name in enumerate(self.names)}
+        self._arrays = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """ Drop the memory maps when pickled, e.g. when sent to a DataLoader worker, so they are re-mapped there
+        instead of being copied.
+        """
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._rows
+
+    @property
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """ Get the memory-mapped arrays 'boxes', 'labels', 'offsets' and 'sizes'.
+
+        The arrays are mapped copy-on-write, so they can be wrapped into tensors but changes never reach the file.
+
+        Returns:
+            arrays (Dict[str, np.ndarray]): The arrays by name.
+        """
+        if self._arrays is None:
+            self._arrays = {
+                name: np.memmap(
+                    self.path, dtype=layout['dtype'], mode='c', offset=layout['offset'], shape=tuple(layout['shape'])
+                ) if np.prod(layout['shape']) else np.empty(layout['shape'], dtype=layout['dtype'])
+                for name, layout in self._layout.items()
+            }
+        return self._arrays
+
+    def row(self, name: str) -> int:
+        """ Get the row of the given annotation file name stem.
+
+        Args:
+            name (str): The file name stem, e.g. 'image' for 'image.xml'.
+
+        Returns:
+            row (int): The row in the index.
+        """
+        return self._rows[name]
+
+    def get(self, name: str) -> Tuple[np.ndarray, np.ndarray]:
+        """ Get the bounding boxes and label ids of an image without parsing.
+
+        Args:
+            name (str): The file name stem, e.g. 'image' for 'image.xml'.
+
+        Returns:
+            Tuple[boxes, labels]: The (N, 4) int32 array of [xmin, ymin, xmax, ymax] and the (N,) int32 label ids.
+        """
+        arrays = self.arrays
+        row = self._rows[name]
+        start, end = arrays['offsets'][row], arrays['offsets'][row + 1]
+        return arrays['boxes'][start:end], arrays['labels'][start:end]
+
+    def get_target(self, name: str, lookup: Optional[np.ndarray] = None) -> Dict[str, Any]:
+        """ Get the target of an image in the compact form used by the dataset.
+
+        Args:
+            name (str): The file name stem, e.g. 'image' for 'image.xml'.
+            lookup (Optional[np.ndarray]): The table translating the label ids of the index into class ids, e.g.
+                `vocabulary.encode(index.classes)`.
+
+        Returns:
+            target (Dict[str, Any]): The dictionary with the 'boxes' array and the 'labels' names, or with the float32
+                'boxes' and the int64 'labels' class id arrays ready to be wrapped into tensors if lookup is given.
+        """
+        boxes, labels = self.get(name)
+        if lookup is not None:
+            return {'boxes': boxes.astype(np.float32), 'labels': lookup[labels]}
+        return {'boxes': boxes, 'labels': [self.classes[label] for label in labels]}
+
+    def is_stale(self, annotation_dir: str = ANNOTATION_DIR) -> bool:
+        """ Check whether any annotation file was added, removed or modified after the index was compiled.
+
+        Args:
+            annotation_dir (str): The directory containing the .xml annotation files.
+
+        Returns:
+            bool: True if the index has to be rebuilt, False otherwise
+        """
+        return self.signature != annotation_signature(annotation_dir)
+
+    @classmethod
+    def compile(
+            cls,
+            annotation_dir: str = ANNOTATION_DIR,
+            path: str = ANNOTATION_INDEX_PATH,
+            signature: Optional[str] = None,
+            num_workers: Optional[int] = None,
+    ) -> 'AnnotationIndex':
+        """ Parse every annotation file of the directory once and write the columnar index file.
+
+        The files are parsed in parallel by `src.bulk_loader.load_annotations`. The file is written to a temporary path
+        first and renamed, so readers never see a partial index.
+
+        Args:
+            annotation_dir (str): The directory containing the .xml annotation files.
+            path (str): The path to write the compiled index file to.
+            signature (Optional[str]): The precomputed signature of the annotation directory.
+            num_workers (Optional[int]): The number of parsing processes, the number of CPUs by default.
+
+        Returns:
+            index (AnnotationIndex): The compiled index.
+
+        Raises:
+            ValueError: If any annotation file cannot be parsed.
+        """
+        from src.bulk_loader import load_annotations
+
+        if signature is None:
+            signature = annotation_signature(annotation_dir)
+
+        annotations = load_annotations(annotation_dir, num_workers)
+        if annotations.errors:
+            file_name, error = next(iter(annotations.errors.items()))
+            raise ValueError(f'Failed to parse {len(annotations.errors)} annotation files, e.g. {file_name}: {error}')
+
+        names = annotations.names
+        classes = annotations.classes
+        arrays = annotations.arrays
+
+        # The offsets are relative to the start of the file, so the header length has to be known first. The header
+        # is padded to a fixed upper bound of the offset digits to make its length independent of the offsets.
+        layout = {name: {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': 0}
+                  for name, array in arrays.items()}
+        header = {'signature': signature, 'names': names, 'classes': list(classes), 'arrays': layout}
+        header_length = len(json.dumps(header).encode('utf-8')) + len(layout) * 20
+
+        position = _align(len(MAGIC) + 8 + header_length)
+        for name, array in arrays.items():
+            layout[name]['offset'] = position
+            position = _align(position + array.nbytes)
+
+        header_bytes = json.dumps(header).encode('utf-8').ljust(header_length)
+
+        path = Path(path)
+        temporary_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with open(temporary_path, 'wb') as file:
+            file.write(MAGIC)
+            file.write(struct.pack('<Q', header_length))
+            file.write(header_bytes)
+            for name, array in arrays.items():
+                file.seek(layout[name]['offset'])
+                file.write(array.tobytes())
+            file.truncate(position)
+        os.replace(temporary_path, path)
+
+        return cls(path)
+
+    @classmethod
+    def load(cls, annotation_dir: str = ANNOTATION_DIR, path: str = ANNOTATION_INDEX_PATH) -> 'AnnotationIndex':
+        """ Open the compiled index, compiling it first if it does not exist or is out of date.
+
+        Args:
+            annotation_dir (str): The directory containing the .xml annotation files.
+            path (str): The path to the compiled index file.
+
+        Returns:
+            index (AnnotationIndex): The up-to-date index.
+        """
+        signature = annotation_signature(annotation_dir)
+
+        if Path(path).is_file():
+            try:
+                index = cls(path)
+            except (ValueError, KeyError, struct.error, json.JSONDecodeError):
+                index = None
+            if index is not None and index.signature == signature:
+                return index
+
+        return cls.compile(annotation_dir, path, signature)
+
+
+def _align(position: int) -> int:
+    """ Round the position up to the next multiple of ALIGNMENT.
+
+    Args:
+        position (int): The byte position.
+
+    Returns:
+        position (int): The aligned byte position.
+    """
+    return -(-position // ALIGNMENT) * ALIGNMENT
+
+
+if __name__ == '__main__':
+    index = AnnotationIndex.compile()
+    print(f'Compiled {len(index)} annotations with {len(index.classes)} classes to {index.path}')
@@ -0,0 +1,566 @@
+import os
+import sqlite3
+import sys
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+import xml.etree.ElementTree as ET
+
+from src.config import *
+from src.writer import Writer, write_annotation
+
+# The labels, the bounding boxes and the label colors of an image, as stored in the Image attributes
+Annotation = Tuple[List[str], List[Tuple[int, int, int, int]], Dict[str, str]]
+
+# The children of the annotation and object elements which have their own columns, the others are kept as XML
+IMAGE_TAGS = {'folder', 'filename', 'path', 'size', 'object', 'color_dict'}
+OBJECT_TAGS = {'name', 'bndbox'}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    folder TEXT NOT NULL DEFAULT '',
+    filename TEXT NOT NULL DEFAULT '',
+    path TEXT NOT NULL DEFAULT '',
+    width INTEGER NOT NULL DEFAULT 0,
+    height INTEGER NOT NULL DEFAULT 0,
+    depth INTEGER NOT NULL DEFAULT 3,
+    extra TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS labels (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS objects (
+    id INTEGER PRIMARY KEY,
+    image_id INTEGER NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    label_id INTEGER NOT NULL REFERENCES labels (id),
+    xmin INTEGER NOT NULL,
+    ymin INTEGER NOT NULL,
+    xmax INTEGER NOT NULL,
+    ymax INTEGER NOT NULL,
+    extra TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS colors (
+    image_id INTEGER NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    element INTEGER NOT NULL,
+    label TEXT NOT NULL,
+    color TEXT NOT NULL,
+    PRIMARY KEY (image_id, position)
+);
+CREATE INDEX IF NOT EXISTS objects_image ON objects (image_id, position);
+CREATE INDEX IF NOT EXISTS objects_label ON objects (label_id);
+'''
+
+
+def image_name(image_path: str) -> str:
+    """ Get the key of an image in the stores, the file name stem like the name of its .xml annotation file.
+
+    Args:
+        image_path (str): The path to the image.
+
+    Returns:
+        name (str): The file name stem.
+    """
+    return Path(image_path).stem
+
+
+class XmlStore:
+    """ The default annotation backend, one VOC .xml file per image in the annotation directory.
+
+    Attributes:
+        annotation_dir (Path): The directory containing the .xml annotation files.
+    """
+
+    def __init__(self, annotation_dir: str = ANNOTATION_DIR):
+        self.annotation_dir = Path(annotation_dir)
+
+    def annotation_path(self, image_path: str) -> Path:
+        """ Get the path to the annotation file of an image.
+
+        Args:
+            image_path (str): The path to the image.
+
+        Returns:
+            annotation_path (Path): The path to the .xml file, which may not exist.
+        """
+        return Path(self.annotation_dir, f'{image_name(image_path)}.xml')
+
+    def has_annotation(self, image_path: str) -> bool:
+        return self.annotation_path(image_path).is_file()
+
+    def load(self, image_path: str) -> Optional[Annotation]:
+        """ Read the annotation of an image.
+
+        Args:
+            image_path (str): The path to the image.
+
+        Returns:
+            annotation (Optional[Annotation]): The labels, bounding boxes and label colors, or None if the image is
+                not annotated.
+        """
+        # src.utils requires PyQt6, which the command line import and export do without
+        from src.utils import load_annotation_file
+
+        annotation_path = self.annotation_path(image_path)
+        if not annotation_path.is_file():
+            return None
+        return load_annotation_file(annotation_path)
+
+    def save(
+            self,
+            image_path: str,
+            width: int,
+            height: int,
+            labels: List[str],
+            bounding_boxes: List[Tuple[int, int, int, int]],
+            label_color_dict: Dict[str, str],
+            fsync: bool = False,
+    ) -> str:
+        """ Write the annotation of an image, replacing the previous one.
+
+        Args:
+            image_path (str): The path to the image.
+            width (int): The width of the image.
+            height (int): The height of the image.
+            labels (List[str]): The label names.
+            bounding_boxes (List[Tuple[int, int, int, int]]): The bounding boxes as (x1, y1, x2, y2).
+            label_color_dict (Dict[str, str]): The colors of the labels.
+            fsync (bool): Whether to flush the annotation to the disk before returning.
+
+        Returns:
+            location (str): Where the annotation was saved.
+        """
+        annotation_path = self.annotation_path(image_path)
+        return write_annotation(
+            str(annotation_path), image_path, width, height, labels, bounding_boxes, label_color_dict, fsync=fsync
+        )
+
+
+class SqliteStore:
+    """ The optional annotation backend, all the annotations in one SQLite database in WAL mode.
+
+    Saving an image replaces its rows in a single transaction, and the counts per label and the annotated images are
+    answered from the indexes instead of reading every annotation. Every thread uses its own connection, and the WAL
+    journal lets the readers run while an image is saved.
+
+    Attributes:
+        path (Path): The path to the database file.
+    """
+
+    def __init__(self, path: str = ANNOTATION_DB_PATH):
+        self.path = Path(path)
+        self._local = threading.local()
+        with self.connection() as connection:
+            connection.executescript(SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        """ Get the connection of the calling thread, opening it on the first call.
+
+        Returns:
+            connection (sqlite3.Connection): The connection, usable as a context manager committing a transaction.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # In WAL mode a commit is durable after the next checkpoint and never corrupts the database
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('PRAGMA foreign_keys=ON')
+            self._local.connection = connection
+        return connection
+
+    def close(self) -> None:
+        """ Close the connection of the calling thread.
+
+        Returns:
+            None
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def has_annotation(self, image_path: str) -> bool:
+        row = self.connection().execute('SELECT 1 FROM images WHERE name = ?', (image_name(image_path),)).fetchone()
+        return row is not None
+
+    def load(self, image_path: str) -> Optional[Annotation]:
+        """ Read the annotation of an image.
+
+        Args:
+            image_path (str): The path to the image.
+
+        Returns:
+            annotation (Optional[Annotation]): The labels, bounding boxes and label colors, or None if the image is
+                not annotated.
+        """
+        connection = self.connection()
+        row = connection.execute('SELECT id FROM images WHERE name = ?', (image_name(image_path),)).fetchone()
+        if row is None:
+            return None
+
+        objects = connection.execute(
+            'SELECT labels.name, xmin, ymin, xmax, ymax FROM objects JOIN labels ON labels.id = objects.label_id '
+            'WHERE image_id = ? ORDER BY position', row
+        ).fetchall()
+        colors = connection.execute('SELECT label, color FROM colors WHERE image_id = ? ORDER BY position', row)
+        return [label for label, *_ in objects], [tuple(box) for _, *box in objects], dict(colors)
+
+    def save(
+            self,
+            image_path: str,
+            width: int,
+            height: int,
+            labels: List[str],
+            bounding_boxes: List[Tuple[int, int, int, int]],
+            label_color_dict: Dict[str, str],
+            fsync: bool = False,
+    ) -> str:
+        """ Write the annotation of an image in one transaction, replacing the previous one.
+
+        Args:
+            image_path (str): The path to the image.
+            width (int): The width of the image.
+            height (int): The height of the image.
+            labels (List[str]): The label names.
+            bounding_boxes (List[Tuple[int, int, int, int]]): The bounding boxes as (x1, y1, x2, y2).
+            label_color_dict (Dict[str, str]): The colors of the labels.
+            fsync (bool): Whether to flush the transaction to the disk before returning, not only at the next
+                checkpoint.
+
+        Returns:
+            location (str): Where the annotation was saved.
+        """
+        record = {
+            'name': image_name(image_path),
+            'folder': Path(image_path).parent.name,
+            'filename': Path(image_path).name,
+            'path': str(image_path),
+            'width': width,
+            'height': height,
+            'depth': 3,
+            'objects': [(label, tuple(box), '') for label, box in zip(labels, bounding_boxes)],
+            'colors': [(element, label, color) for element, (label, color) in enumerate(label_color_dict.items())],
+        }
+        connection = self.connection()
+        if fsync:
+            connection.execute('PRAGMA synchronous=FULL')
+        try:
+            with connection:
+                self._write(connection, record, keep_extra=True)
+        finally:
+            if fsync:
+                connection.execute('PRAGMA synchronous=NORMAL')
+        return str(self.path)
+
+    def _write(self, connection: sqlite3.Connection, record: Dict, keep_extra: bool = False) -> None:
+        """ Replace the rows of an image within the open transaction.
+
+        Args:
+            connection (sqlite3.Connection): The connection in a transaction.
+            record (Dict): The image columns, the 'objects' as (label, box, extra) and the 'colors' as
+                (element, label, color).
+            keep_extra (bool): Whether to keep the stored extra elements of the image, and of every object whose
+                position, label and box are unchanged, instead of the record's.
+
+        Returns:
+            None
+        """
+        columns = ('name', 'folder', 'filename', 'path', 'width', 'height', 'depth', 'extra')
+        updated = ', '.join(f'{column} = excluded.{column}' for column in columns[1:-1 if keep_extra else None])
+        image_id, = connection.execute(
+            f'INSERT INTO images ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))}) '
+            f'ON CONFLICT (name) DO UPDATE SET {updated} RETURNING id',
+            [record.get(column, '') for column in columns]
+        ).fetchone()
+        objects = record['objects']
+        if keep_extra:
+            # e.g. the <difficult> of the imported objects, which the annotator does not edit
+            stored = {
+                (position, label, tuple(box)): extra
+                for position, label, *box, extra in connection.execute(
+                    'SELECT position, labels.name, xmin, ymin, xmax, ymax, objects.extra FROM objects '
+                    'JOIN labels ON labels.id = objects.label_id WHERE image_id = ? AND objects.extra != \'\'',
+                    (image_id,)
+                )
+            }
+            objects = [
+                (label, box, extra or stored.get((position, label, tuple(box)), ''))
+                for position, (label, box, extra) in enumerate(objects)
+            ]
+        connection.execute('DELETE FROM objects WHERE image_id = ?', (image_id,))
+        connection.execute('DELETE FROM colors WHERE image_id = ?', (image_id,))
+
+        label_ids = self._label_ids(connection, [label for label, _, _ in objects])
+        connection.executemany(
+            'INSERT INTO objects (image_id, position, label_id, xmin, ymin, xmax, ymax, extra) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(image_id, position, label_ids[label], *box, extra)
+             for position, (label, box, extra) in enumerate(objects)]
+        )
+        connection.executemany(
+            'INSERT INTO colors (image_id, position, element, label, color) VALUES (?, ?, ?, ?, ?)',
+            [(image_id, position, *color) for position, color in enumerate(record['colors'])]
+        )
+
+    @staticmethod
+    def _label_ids(connection: sqlite3.Connection, labels: Iterable[str]) -> Dict[str, int]:
+        """ Get the ids of the labels, adding the new ones.
+
+        Args:
+            connection (sqlite3.Connection): The connection in a transaction.
+            labels (Iterable[str]): The label names.
+
+        Returns:
+            label_ids (Dict[str, int]): The ids by the label name.
+        """
+        names = sorted(set(labels))
+        connection.executemany('INSERT OR IGNORE INTO labels (name) VALUES (?)', [(name,) for name in names])
+        label_ids = {}
+        for start in range(0, len(names), 500):
+            chunk = names[start:start + 500]
+            label_ids.update(connection.execute(
+                f'SELECT name, id FROM labels WHERE name IN ({", ".join("?" * len(chunk))})', chunk
+            ))
+        return label_ids
+
+    def delete(self, image_path: str) -> None:
+        """ Remove the annotation of an image.
+
+        Args:
+            image_path (str): The path to the image.
+
+        Returns:
+            None
+        """
+        with self.connection() as connection:
+            connection.execute('DELETE FROM images WHERE name = ?', (image_name(image_path),))
+
+    def label_counts(self) -> Dict[str, int]:
+        """ Count the boxes of every label.
+
+        Returns:
+            counts (Dict[str, int]): The number of boxes by the label name.
+        """
+        return dict(self.connection().execute(
+            'SELECT labels.name, COUNT(objects.id) FROM labels LEFT JOIN objects ON objects.label_id = labels.id '
+            'GROUP BY labels.id ORDER BY labels.name'
+        ))
+
+    def count_boxes(self, label: str) -> int:
+        """ Count the boxes of a label.
+
+        Args:
+            label (str): The label name.
+
+        Returns:
+            count (int): The number of boxes.
+        """
+        return self.connection().execute(
+            'SELECT COUNT(*) FROM objects JOIN labels ON labels.id = objects.label_id WHERE labels.name = ?', (label,)
+        ).fetchone()[0]
+
+    def images_with_label(self, label: str) -> List[str]:
+        """ Find the images with a box of the label.
+
+        Args:
+            label (str): The label name.
+
+        Returns:
+            names (List[str]): The sorted file name stems of the images.
+        """
+        return [name for name, in self.connection().execute(
+            'SELECT DISTINCT images.name FROM objects JOIN labels ON labels.id = objects.label_id '
+            'JOIN images ON images.id = objects.image_id WHERE labels.name = ? ORDER BY images.name', (label,)
+        )]
+
+    def unannotated(self, image_paths: Iterable[str]) -> List[str]:
+        """ Find the images without an annotation.
+
+        Args:
+            image_paths (Iterable[str]): The paths to the images.
+
+        Returns:
+            image_paths (List[str]): The given paths of the images which are not in the database.
+        """
+        annotated = {name for name, in self.connection().execute('SELECT name FROM images')}
+        return [image_path for image_path in image_paths if image_name(image_path) not in annotated]
+
+    def import_voc(self, annotation_dir: str = ANNOTATION_DIR) -> Tuple[int, Dict[str, str]]:
+        """ Import every VOC .xml file of a directory in one transaction, replacing the stored images of the same name.
+
+        Besides the columns, the elements of the files which are not written by the annotator, e.g. 'pose' or
+        'difficult' of other tools, are stored as XML and written back by export_voc.
+
+        Args:
+            annotation_dir (str): The directory containing the .xml annotation files.
+
+        Returns:
+            Tuple[count, errors]: The number of imported files and the error messages of the files which could not
+                be parsed, by the file name.
+        """
+        count = 0
+        errors = {}
+        with self.connection() as connection:
+            for file_name in sorted(os.listdir(annotation_dir)):
+                if not file_name.endswith('.xml'):
+                    continue
+                try:
+                    record = read_voc(os.path.join(annotation_dir, file_name))
+                except (ET.ParseError, AttributeError, TypeError, ValueError) as error:
+                    errors[file_name] = f'{type(error).__name__}: {error}'
+                    continue
+                self._write(connection, record)
+                count += 1
+        return count, errors
+
+    def export_voc(self, output_dir: str = ANNOTATION_DIR) -> int:
+        """ Write every stored image as a VOC .xml file.
+
+        Args:
+            output_dir (str): The directory to write the .xml files to.
+
+        Returns:
+            count (int): The number of written files.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        connection = self.connection()
+        images = connection.execute(
+            'SELECT id, name, folder, filename, path, width, height, depth, extra FROM images ORDER BY name'
+        ).fetchall()
+        for image_id, name, folder, filename, path, width, height, depth, extra in images:
+            objects = connection.execute(
+                'SELECT labels.name, xmin, ymin, xmax, ymax, extra FROM objects '
+                'JOIN labels ON labels.id = objects.label_id WHERE image_id = ? ORDER BY position', (image_id,)
+            ).fetchall()
+            colors = connection.execute(
+                'SELECT element, label, color FROM colors WHERE image_id = ? ORDER BY position', (image_id,)
+            ).fetchall()
+            write_voc(Path(output_dir, f'{name}.xml'), {
+                'folder': folder, 'filename': filename, 'path': path, 'width': width, 'height': height,
+                'depth': depth, 'extra': extra,
+                'objects': [(label, tuple(box), object_extra) for label, *box, object_extra in objects],
+                'colors': colors,
+            })
+        return len(images)
+
+
+def read_voc(path: str) -> Dict:
+    """ Read every element of a VOC .xml file into the record stored by SqliteStore.
+
+    Args:
+        path (str): The path to the .xml file.
+
+    Returns:
+        record (Dict): The image columns, the 'objects' as (label, box, extra XML) and the 'colors' as
+            (element, label, color).
+    """
+    root = ET.parse(path).getroot()
+    size = root.find('size')
+    record = {
+        'name': Path(path).stem,
+        'folder': root.findtext('folder', ''),
+        'filename': root.findtext('filename', ''),
+        'path': root.findtext('path', ''),
+        'width': int(size.findtext('width', 0)) if size is not None else 0,
+        'height': int(size.findtext('height', 0)) if size is not None else 0,
+        'depth': int(size.findtext('depth', 3)) if size is not None else 3,
+        'extra': _extra(root, IMAGE_TAGS),
+        'objects': [],
+        'colors': [],
+    }
+    for obj in root.iter('object'):
+        bounding_box = obj.find('bndbox')
+        box = tuple(int(bounding_box.findtext(tag)) for tag in ('xmin', 'ymin', 'xmax', 'ymax'))
+        record['objects'].append((obj.findtext('name', ''), box, _extra(obj, OBJECT_TAGS)))
+    for element, color_dict in enumerate(root.iter('color_dict')):
+        record['colors'].extend((element, label, color) for label, color in color_dict.attrib.items())
+    return record
+
+
+def write_voc(path: str, record: Dict) -> None:
+    """ Write a record read by read_voc as a VOC .xml file in the layout of Writer.
+
+    Args:
+        path (str): The path to the .xml file.
+        record (Dict): The record.
+
+    Returns:
+        None
+    """
+    writer = Writer(Path(record['folder'], record['filename']), record['width'], record['height'], record['depth'])
+    writer.path.text = record['path']
+    for label, (x1, y1, x2, y2), extra in record['objects']:
+        writer.add_object(label, x1, y1, x2, y2)
+        writer.annotation[-1].extend(_parse_extra(extra))
+
+    elements = {}
+    for element, label, color in record['colors']:
+        if element not in elements:
+            elements[element] = ET.SubElement(writer.annotation, 'color_dict')
+        elements[element].set(label, color)
+
+    writer.annotation.extend(_parse_extra(record['extra']))
+    writer.save(path)
+
+
+def _extra(element: ET.Element, tags: set) -> str:
+    # The other children of the element as XML, without the indentation which Writer adds again
+    children = [child for child in element if child.tag not in tags]
+    for child in children:
+        for node in child.iter():
+            if node.text is not None and not node.text.strip():
+                node.text = None
+            if node.tail is not None and not node.tail.strip():
+                node.tail = None
+    return ''.join(ET.tostring(child, encoding='unicode') for child in children)
+
+
+def _parse_extra(extra: str) -> List[ET.Element]:
+    return list(ET.fromstring(f'<extra>{extra}</extra>')) if extra else []
+
+
+_stores = {}
+
+
+def get_store(backend: str = ANNOTATION_BACKEND):
+    """ Get the shared store of the annotation backend.
+
+    Args:
+        backend (str): 'xml' for one .xml file per image in ANNOTATION_DIR, 'sqlite' for the database at
+            ANNOTATION_DB_PATH.
+
+    Returns:
+        store (Union[XmlStore, SqliteStore]): The store.
+    """
+    if backend not in _stores:
+        if backend == 'xml':
+            _stores[backend] = XmlStore()
+        elif backend == 'sqlite':
+            _stores[backend] = SqliteStore()
+        else:
+            raise ValueError(f'Unknown annotation backend {backend}, expected xml or sqlite')
+    return _stores[backend]
+
+
+if __name__ == '__main__':
+    commands = ('import', 'export', 'stats')
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        print(f'Usage: python -m src.annotation_store {"|".join(commands)} [annotation directory]')
+        sys.exit(1)
+
+    store = SqliteStore()
+    if sys.argv[1] == 'import':
+        count, errors = store.import_voc(*sys.argv[2:3])
+        print(f'Imported {count} annotations into {store.path}')
+        for file_name, error in errors.items():
+            print(f'Failed to parse {file_name}: {error}')
+    elif sys.argv[1] == 'export':
+        print(f'Exported {store.export_voc(*sys.argv[2:3])} annotations from {store.path}')
+    else:
+        for label, count in store.label_counts().items():
+            print(f'{label}: {count}')
@@ -0,0 +1,283 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+
+try:
+    from PyQt6.QtCore import QObject, QTimer, pyqtSignal
+    from PyQt6.QtWidgets import QMainWindow
+except ImportError:
+    raise ImportError("Requires PyQt6")
+
+from src.annotation_store import get_store
+from src.config import *
+from src.image import Image
+from src.journal import Journal
+
+
+class AutoSaver(QObject):
+    """ Saves the annotations of the image on the canvas in background shortly after they change.
+
+    Every edit is appended to the journal right away, so it survives a crash, and restarts a single-shot timer, so a
+    burst of edits is folded into the annotation backend once when the annotator pauses. The journal is compacted by a
+    single worker thread, so the GUI thread never waits on writing the annotations. An image whose annotations have not
+    changed since they were loaded or saved is not written again. The results are delivered to the GUI thread with the
+    Qt signals. The edits left in the journal by a crash are recovered when the instance is created.
+
+    Attributes:
+        main_window (Optional[QMainWindow]): The parent main window showing the messages, or None.
+        store (XmlStore | SqliteStore): The annotation backend the annotations are written to.
+        journal (Journal): The journal of the edits.
+        delay (int): The milliseconds without a change after which the annotations are saved.
+    """
+
+    # The signals carry the image, the written version and the save path or the error message
+    saved = pyqtSignal(object, int, str)
+    failed = pyqtSignal(object, int, str)
+
+    def __init__(
+            self,
+            main_window: Optional[QMainWindow] = None,
+            store: object = None,
+            journal: Optional[Journal] = None,
+            delay: int = AUTOSAVE_DELAY,
+    ):
+        """ Initialize the instance and fold the edits left in the journal into the annotation backend.
+
+        Args:
+            main_window (Optional[QMainWindow]): The parent main window showing the messages, or None.
+            store (XmlStore | SqliteStore): The annotation backend, the configured backend by default.
+            journal (Optional[Journal]): The journal of the edits, the journal in ANNOTATION_DIR by default.
+            delay (int): The milliseconds without a change after which the annotations are saved.
+        """
+        super().__init__()
+
+        self.main_window = main_window
+        self.store = store if store is not None else get_store()
+        self.journal = journal if journal is not None else Journal()
+        self.delay = delay
+
+        recovered = self.journal.compact(self.store)
+        if recovered and self.main_window is not None:
+            self.main_window.statusBar().showMessage(f'Recovered the unsaved edits of {len(recovered)} images.', 5000)
+
+        self._image = None
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='AutoSaver')
+        # The last write submitted for every image path, and the image and the version it writes
+        self._futures: Dict[str, Future] = {}
+        self._versions: Dict[str, Tuple[Image, int]] = {}
+        self._lock = threading.Lock()
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._on_timeout)
+
+        self.saved.connect(self._on_saved)
+        self.failed.connect(self._on_failed)
+
+    def record(self, image: Image, operation: str, **fields: object) -> None:
+        """ Append an edit of the image to the journal and save the image after the delay.
+
+        Args:
+            image (Image): The edited image, whose boxes are already changed.
+            operation (str): 'insert', 'undo' or 'reset'.
+            **fields (object): The 'label', 'box' and 'color' of an inserted box or the 'label' of an undone box.
+
+        Returns:
+            None
+        """
+        self.journal.append({
+            'op': operation,
+            'image': image.get_path(),
+            'size': [image.width(), image.height()],
+            'count': len(image.get_label()),
+            **fields,
+        })
+        self.schedule(image)
+
+    def schedule(self, image: Image) -> None:
+        """ Save the image after the delay, unless it changes again meanwhile.
+
+        Args:
+            image (Image): The changed image.
+
+        Returns:
+            None
+        """
+        if self._image is not None and self._image is not image:
+            self.save(self._image)
+        self._image = image
+        self._timer.start(self.delay)
+
+    def save(self, image: Image, force: bool = False) -> Optional[Future]:
+        """ Write the annotations of the image in background now. The edits in the journal are compacted, or the
+        annotations are written as they are if the image is only saved on purpose.
+
+        Args:
+            image (Image): The image to save.
+            force (bool): Whether to write the annotations even if they have not changed, e.g. to save an image
+                without any annotation on purpose.
+
+        Returns:
+            future (Optional[Future]): The write resolving to the save path, or None if there is nothing to save.
+        """
+        if image is self._image:
+            self._timer.stop()
+            self._image = None
+
+        version, labels, bounding_boxes, label_color_dict = image.snapshot()
+        image_path = image.get_path()
+        with self._lock:
+            # The version may already be in a write which has not finished yet
+            if not (image.is_dirty() or force) or self._versions.get(image_path) == (image, version):
+                return None
+            self._versions[image_path] = (image, version)
+
+        if image.is_dirty():
+            future = self._executor.submit(self._write, image, version, self._compact, image_path)
+        else:
+            future = self._executor.submit(
+                self._write, image, version,
+                self.store.save, image_path, image.width(), image.height(), labels, bounding_boxes, label_color_dict
+            )
+        with self._lock:
+            self._futures[image_path] = future
+        future.add_done_callback(lambda future: self._on_done(future, image, version))
+        return future
+
+    def wait(self, image_path: str) -> None:
+        """ Wait for the write of an image submitted last, e.g. before loading its annotations again.
+
+        Args:
+            image_path (str): The path to the image.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            future = self._futures.get(image_path)
+        if future is not None:
+            # The errors are reported by the failed signal
+            future.exception()
+
+    def flush(self, wait: bool = True) -> None:
+        """ Save the scheduled image without waiting for the delay.
+
+        Args:
+            wait (bool): Whether to wait until all the submitted writes are done.
+
+        Returns:
+            None
+        """
+        if self._image is not None:
+            self.save(self._image)
+        if wait:
+            with self._lock:
+                futures = list(self._futures.values())
+            for future in futures:
+                future.exception()
+
+    def stop(self) -> None:
+        """ Save the scheduled image and wait for all the writes, e.g. when the program is closed.
+
+        Returns:
+            None
+        """
+        self.flush()
+        self._executor.shutdown(wait=True)
+        self.journal.close()
+
+    def _write(self, image: Image, version: int, write: Callable[..., str], *args: object) -> str:
+        """ Write the annotations and mark the image saved before the write is done, so the image is no longer dirty
+        once `wait` or `flush` returns. Runs in the worker thread.
+
+        Args:
+            image (Image): The saved image.
+            version (int): The written version of the annotations.
+            write (Callable[..., str]): The function writing the annotations and returning the save path.
+            *args (object): The arguments of the function.
+
+        Returns:
+            location (str): The save path returned by the function.
+        """
+        image_path = image.get_path()
+        location = None
+        try:
+            location = write(*args)
+        finally:
+            with self._lock:
+                if self._versions.get(image_path) == (image, version):
+                    del self._versions[image_path]
+                # After an error the image stays unsaved, so it is saved again by the next change or save
+                if location is not None:
+                    image.mark_saved(version)
+        return location
+
+    def _compact(self, image_path: str) -> str:
+        """ Fold the journal into the annotation backend. Runs in the worker thread.
+
+        Args:
+            image_path (str): The path to the image the compaction was started for.
+
+        Returns:
+            location (str): Where the annotation of the image was saved, empty if an earlier compaction saved it.
+        """
+        return self.journal.compact(self.store).get(image_path, '')
+
+    def _on_timeout(self) -> None:
+        """ Save the scheduled image after the delay.
+
+        Returns:
+            None
+        """
+        if self._image is not None:
+            self.save(self._image)
+
+    def _on_done(self, future: Future, image: Image, version: int) -> None:
+        """ Forward the result to the GUI thread. Runs in the worker thread.
+
+        Args:
+            future (Future): The finished write.
+            image (Image): The saved image.
+            version (int): The written version of the annotations.
+
+        Returns:
+            None
+        """
+        image_path = image.get_path()
+        with self._lock:
+            if self._futures.get(image_path) is future:
+                del self._futures[image_path]
+
+        error = future.exception()
+        if error is None:
+            self.saved.emit(image, version, str(future.result()))
+        else:
+            self.failed.emit(image, version, str(error))
+
+    def _on_saved(self, image: Image, version: int, save_path: str) -> None:
+        """ Report the save in the status bar.
+
+        Args:
+            image (Image): The saved image.
+            version (int): The written version of the annotations.
+            save_path (str): The path to the written .xml file or the database, empty if it was written earlier.
+
+        Returns:
+            None
+        """
+        if self.main_window is not None and save_path:
+            self.main_window.statusBar().showMessage(f'Saved to {save_path}.', 3000)
+
+    def _on_failed(self, image: Image, version: int, message: str) -> None:
+        """ Report the failed save in the status bar. The image stays unsaved, so it is saved again later.
+
+        Args:
+            image (Image): The image which was not saved.
+            version (int): The version of the annotations which was not written.
+            message (str): The error message.
+
+        Returns:
+            None
+        """
+        if self.main_window is not None:
+            self.main_window.statusBar().showMessage(f'Failed to save {image.get_path()}: {message}', 5000)
@@ -0,0 +1,222 @@
+import os
+import sys
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from src.annotation_index import read_annotation
+from src.config import *
+from src.parallel import chunked, merge_errors, ordered_map, worker_count
+
+# The number of files parsed by a worker per task
+CHUNK_SIZE = 512
+
+
+class AnnotationSet(Mapping):
+    """ All the annotations of a directory in flat arrays, mapping the file name stems to their boxes and label ids.
+
+    The layout matches the compiled annotation index: the boxes and the label ids of the image at row i are found in
+    the slice offsets[i]:offsets[i + 1].
+
+    Attributes:
+        names (List[str]): The file name stems of the parsed annotation files, one per row.
+        classes (List[str]): The label names, indexed by the label ids, in the order of their first appearance.
+        boxes (np.ndarray): The (N, 4) int32 array of [xmin, ymin, xmax, ymax] of all the files.
+        labels (np.ndarray): The (N,) int32 label ids of all the files.
+        offsets (np.ndarray): The (F + 1,) int64 start of the boxes of every file.
+        sizes (np.ndarray): The (F, 2) int32 (width, height) of every file.
+        errors (Dict[str, str]): The error messages of the files which could not be parsed, by the file name.
+    """
+
+    def __init__(
+            self,
+            names: List[str],
+            classes: List[str],
+            boxes: np.ndarray,
+            labels: np.ndarray,
+            offsets: np.ndarray,
+            sizes: np.ndarray,
+            errors: Dict[str, str],
+    ):
+        self.names = names
+        self.classes = classes
+        self.boxes = boxes
+        self.labels = labels
+        self.offsets = offsets
+        self.sizes = sizes
+        self.errors = errors
+        self._rows = {name: row for row, name in enumerate(names)}
+
+    def __getitem__(self, name: str) -> Tuple[np.ndarray, np.ndarray]:
+        """ Get the bounding boxes and the label ids of an image.
+
+        Args:
+            name (str): The file name stem, e.g. 'image' for 'image.xml'.
+
+        Returns:
+            Tuple[boxes, labels]: Views of the (N, 4) boxes and the (N,) label ids.
+        """
+        row = self._rows[name]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self.boxes[start:end], self.labels[start:end]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @property
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """ Get the arrays 'boxes', 'labels', 'offsets' and 'sizes' in the layout of the annotation index.
+
+        Returns:
+            arrays (Dict[str, np.ndarray]): The arrays by name.
+        """
+        return {'boxes': self.boxes, 'labels': self.labels, 'offsets': self.offsets, 'sizes': self.sizes}
+
+    def label_names(self, name: str) -> List[str]:
+        """ Get the label names of an image.
+
+        Args:
+            name (str): The file name stem.
+
+        Returns:
+            labels (List[str]): The label names of the boxes.
+        """
+        return [self.classes[label] for label in self[name][1]]
+
+    def class_counts(self) -> Dict[str, int]:
+        """ Count the boxes of every label.
+
+        Returns:
+            counts (Dict[str, int]): The number of boxes by the label name.
+        """
+        counts = np.bincount(self.labels, minlength=len(self.classes))
+        return dict(zip(self.classes, counts.tolist()))
+
+
+def _parse_chunk(annotation_dir: str, file_names: List[str]) -> Dict[str, Any]:
+    """ Parse a chunk of annotation files in a worker.
+
+    The labels are returned as ids into the classes of the chunk, so only small arrays are sent back to the parent.
+
+    Args:
+        annotation_dir (str): The directory containing the .xml annotation files.
+        file_names (List[str]): The file names of the chunk.
+
+    Returns:
+        chunk (Dict[str, Any]): The names, classes, arrays and errors of the chunk.
+    """
+    names = []
+    classes = {}
+    sizes = []
+    counts = []
+    boxes = []
+    labels = []
+    errors = {}
+
+    for file_name in file_names:
+        try:
+            size, file_labels, file_boxes = read_annotation(os.path.join(annotation_dir, file_name))
+        except (ET.ParseError, OSError, AttributeError, TypeError, ValueError) as error:
+            errors[file_name] = f'{type(error).__name__}: {error}'
+            continue
+        names.append(Path(file_name).stem)
+        sizes.append(size)
+        counts.append(len(file_boxes))
+        boxes.extend(file_boxes)
+        labels.extend(classes.setdefault(label, len(classes)) for label in file_labels)
+
+    return {
+        'names': names,
+        'classes': list(classes),
+        'sizes': np.asarray(sizes, dtype=np.int32).reshape(-1, 2),
+        'counts': np.asarray(counts, dtype=np.int64),
+        'boxes': np.asarray(boxes, dtype=np.int32).reshape(-1, 4),
+        'labels': np.asarray(labels, dtype=np.int32),
+        'errors': errors,
+    }
+
+
+def _merge_chunks(chunks: List[Dict[str, Any]]) -> AnnotationSet:
+    """ Concatenate the parsed chunks in order, translating the label ids of every chunk into the common classes.
+
+    Args:
+        chunks (List[Dict[str, Any]]): The chunks returned by `_parse_chunk`, in the order of the files.
+
+    Returns:
+        annotations (AnnotationSet): The merged annotations.
+    """
+    classes = {}
+    labels = []
+    for chunk in chunks:
+        lookup = np.array([classes.setdefault(label, len(classes)) for label in chunk['classes']], dtype=np.int32)
+        labels.append(lookup[chunk['labels']] if len(lookup) else chunk['labels'])
+
+    counts = np.concatenate([np.zeros(1, dtype=np.int64)] + [chunk['counts'] for chunk in chunks])
+    errors = merge_errors(chunk['errors'] for chunk in chunks)
+
+    return AnnotationSet(
+        names=[name for chunk in chunks for name in chunk['names']],
+        classes=list(classes),
+        boxes=np.concatenate([np.zeros((0, 4), dtype=np.int32)] + [chunk['boxes'] for chunk in chunks]),
+        labels=np.concatenate([np.zeros(0, dtype=np.int32)] + labels),
+        offsets=np.cumsum(counts),
+        sizes=np.concatenate([np.zeros((0, 2), dtype=np.int32)] + [chunk['sizes'] for chunk in chunks]),
+        errors=errors,
+    )
+
+
+def load_annotations(
+        annotation_dir: str = ANNOTATION_DIR,
+        num_workers: Optional[int] = None,
+        chunk_size: int = CHUNK_SIZE,
+        progress: Optional[Callable[[int, int], None]] = None,
+) -> AnnotationSet:
+    """ Load every annotation file of a directory at once, in chunks parsed by a process pool.
+
+    The files which cannot be parsed are skipped and reported in `AnnotationSet.errors` instead of stopping the load.
+    A directory of a single chunk, or num_workers=0, is parsed in the calling process, as starting the workers would
+    take longer than parsing.
+
+    Args:
+        annotation_dir (str): The directory containing the .xml annotation files.
+        num_workers (Optional[int]): The number of worker processes, the number of CPUs by default.
+        chunk_size (int): The number of files parsed by a worker per task.
+        progress (Optional[Callable[[int, int], None]]): The callback called with the number of parsed files and the
+            total number of files after every chunk.
+
+    Returns:
+        annotations (AnnotationSet): The annotations of the files sorted by the file name.
+    """
+    file_names = sorted(file_name for file_name in os.listdir(annotation_dir) if file_name.endswith('.xml'))
+    file_chunks = chunked(file_names, chunk_size)
+    arguments = ((str(annotation_dir), file_chunk) for file_chunk in file_chunks)
+
+    done = 0
+
+    def report(chunk: Dict[str, Any]) -> None:
+        nonlocal done
+        done += len(chunk['names']) + len(chunk['errors'])
+        if progress is not None:
+            progress(done, len(file_names))
+
+    chunks = list(ordered_map(_parse_chunk, arguments, worker_count(num_workers, len(file_chunks)), report))
+    return _merge_chunks(chunks)
+
+
+if __name__ == '__main__':
+    def print_progress(done: int, total: int) -> None:
+        print(f'\rParsed {done}/{total} annotation files', end='', flush=True)
+
+    annotations = load_annotations(*sys.argv[1:2], progress=print_progress)
+    print()
+    print(f'{len(annotations)} annotations with {len(annotations.boxes)} boxes')
+    for label, count in sorted(annotations.class_counts().items(), key=lambda item: -item[1]):
+        print(f'    {label}: {count}')
+    for file_name, error in annotations.errors.items():
+        print(f'Failed to parse {file_name}: {error}')
@@ -1,5 +1,6 @@
 import sys
-from typing import Union
+import zlib
+from typing import List, Tuple, Union
 
 try:
     from PyQt6.QtGui import QPaintEvent, QPainter, QPen, QColorConstants, QEnterEvent, QMouseEvent, QColor, QAction
@@ -9,10 +10,22 @@ except ImportError:
     raise ImportError("Requires PyQt6")
 
 from src.image import Image
-from src.writer import Writer
 from src.config import *
 
 
+def label_color(label: str) -> str:
+    """ Get a color for a label without asking the user, e.g. for the accepted suggestions. The same label always gets
+    the same color.
+
+    Args:
+        label (str): The label name.
+
+    Returns:
+        color (str): The hex color string.
+    """
+    return QColor.fromHsv(zlib.crc32(label.encode()) % 360, 200, 255).name()
+
+
 class Canvas(QWidget):
     """ The canvas to draw annotations on.
 
@@ -45,6 +58,8 @@ class Canvas(QWidget):
 
         # Class variable
         self.main_window = main_window
+        # The last changes of the image may still be written in background
+        self.main_window.autosaver.wait(image_path)
         self.image = Image(image_path)
         self.drawing = False
         self.idle = True
@@ -59,6 +74,9 @@ class Canvas(QWidget):
         if self.image.load_annotation():
             self.main_window.filter_widget.add_labels_from_dict(self.image.get_color_dict())
 
+        # Add the suggestions of the pre-annotation received so far
+        self.image.set_suggestions(self.main_window.pre_annotator.suggestions.get(image_path, []))
+
         # Set configurations
         self.setFixedSize(self.image.width(), self.image.height())
         self.setStyleSheet("background-color: transparent;")
@@ -93,6 +111,13 @@ class Canvas(QWidget):
                 self.draw_rectangle(p, bounding, color, fill=False)
                 self.draw_text(p, label, x1, y1, x2, y2)
 
+        # Display the suggestions with dashed lines until they are accepted or rejected
+        for label, (x1, y1, x2, y2), score in self.image.suggestions:
+            color = self.image.label_color_dict.get(label, label_color(label))
+            p.setPen(QPen(QColor(color), 2, Qt.PenStyle.DashLine))
+            p.drawRect(QRect(x1, y1, x2 - x1, y2 - y1))
+            self.draw_text(p, f'{label} {score:.2f}', x1, y1, x2, y2)
+
         # Display drawing
         if not self.VIEW_MODE:
 
@@ -153,6 +178,14 @@ class Canvas(QWidget):
         if self.idle and not self.VIEW_MODE:
             if event.button() == Qt.MouseButton.LeftButton:
                 self.start_point = event.pos()
+        elif self.VIEW_MODE:
+            # Left click accepts and right click rejects a suggestion
+            index = self.image.find_suggestion(event.pos())
+            if index is not None:
+                if event.button() == Qt.MouseButton.LeftButton:
+                    self.accept_suggestion(index)
+                elif event.button() == Qt.MouseButton.RightButton:
+                    self.reject_suggestion(index)
 
     def mouseMoveEvent(self, event: QMouseEvent) -> None:
         """ Handle the event when the user move the mouse.
@@ -245,8 +278,64 @@ class Canvas(QWidget):
                 self.image.visible[label] = True
             self.image.add_label(label)
             self.image.add_bounding_box(self.start_point, self.end_point)
+            self.changed('insert', label=label, box=self.image.get_bounding_box()[-1],
+                         color=self.image.label_color_dict[label])
         self.idle = True
 
+    def set_suggestions(self, suggestions: List[Tuple[str, Tuple[int, int, int, int], float]]) -> None:
+        """ Display the suggestions of the pre-annotation on the image.
+
+        Args:
+            suggestions (List[Tuple[str, Tuple[int, int, int, int], float]]): The labels, bounding boxes and scores.
+
+        Returns:
+            None
+        """
+        self.image.set_suggestions(suggestions)
+        self.update()
+
+    def accept_suggestion(self, index: int) -> None:
+        """ Turn the suggestion into an annotation. A new label gets its color without asking the user.
+
+        Args:
+            index (int): The index of the suggestion.
+
+        Returns:
+            None
+        """
+        label, (x1, y1, x2, y2), _ = self.image.pop_suggestion(index)
+        if label not in self.image.label_color_dict.keys():
+            self.image.label_color_dict[label] = label_color(label)
+        if label not in set(self.image.get_label()):
+            self.main_window.filter_widget.add_label(label, QColor(self.image.label_color_dict[label]))
+            self.image.visible[label] = True
+        self.image.add_label(label)
+        self.image.add_bounding_box(QPoint(x1, y1), QPoint(x2, y2))
+        self.changed('insert', label=label, box=self.image.get_bounding_box()[-1],
+                     color=self.image.label_color_dict[label])
+        self._update_suggestions()
+
+    def reject_suggestion(self, index: int) -> None:
+        """ Remove the suggestion.
+
+        Args:
+            index (int): The index of the suggestion.
+
+        Returns:
+            None
+        """
+        self.image.pop_suggestion(index)
+        self._update_suggestions()
+
+    def _update_suggestions(self) -> None:
+        """ Keep the remaining suggestions when the image is selected again and repaint the canvas.
+
+        Returns:
+            None
+        """
+        self.main_window.pre_annotator.update(self.image.get_path(), self.image.suggestions)
+        self.update()
+
     def draw_text(self, p, text, x1, y1, x2, y2):
         """ Display the label in the bottom-left corner of the bounding box.
 
@@ -340,6 +429,7 @@ class Canvas(QWidget):
                 self.image.label_color_dict.pop(label)
                 self.main_window.filter_widget.undo(label)
                 self.image.visible.pop(label)
+            self.changed('undo', label=label)
             self.update()
             self.main_window.statusBar().showMessage("Performed undo.", 3000)
 
@@ -357,29 +447,63 @@ class Canvas(QWidget):
             self.image.label_color_dict.clear()
             self.image.visible.clear()
             self.main_window.filter_widget.reset()
+            self.changed('reset')
             self.update()
             self.main_window.statusBar().showMessage("Performed reset.", 3000)
 
+    def accept_suggestions(self) -> None:
+        """ Accept suggestions action.
+
+        Turn all the suggestions into annotations.
+
+        Returns:
+            None
+        """
+        if self.image.suggestions:
+            count = len(self.image.suggestions)
+            while self.image.suggestions:
+                self.accept_suggestion(0)
+            self.main_window.statusBar().showMessage(f"Accepted {count} suggestions.", 3000)
+
+    def reject_suggestions(self) -> None:
+        """ Reject suggestions action.
+
+        Remove all the suggestions.
+
+        Returns:
+            None
+        """
+        if self.image.suggestions:
+            self.image.suggestions.clear()
+            self._update_suggestions()
+            self.main_window.statusBar().showMessage("Rejected the suggestions.", 3000)
+
     def save(self) -> None:
         """ Save action.
 
-        Save the drawn bounding boxes as annotations into a .xml file.
+        Save the drawn bounding boxes as annotations into a .xml file, or into the database with the sqlite backend,
+        without waiting for the autosave. The file is written in background and the status bar shows where to. An
+        image without any annotation is saved too, but an unchanged annotation is not written again.
 
         Returns:
             None
         """
-        writer = Writer(self.image.get_path(), self.image.width(), self.image.height())
-
-        for label, bounding_box in zip(self.image.get_label(), self.image.get_bounding_box()):
-            x1, y1, x2, y2 = bounding_box
-            writer.add_object(label, x1, y1, x2, y2)
+        if self.main_window.autosaver.save(self.image, force=not self.image.stored) is None:
+            self.main_window.statusBar().showMessage("No changes to save.", 3000)
 
-        for label, color in self.image.get_color_dict().items():
-            writer.add_label_color_dict(label, color)
+    def changed(self, operation: str, **fields: object) -> None:
+        """ Mark the annotations of the image changed, record the edit in the journal and save the annotations in
+        background after a pause.
 
-        save_path = writer.save()
+        Args:
+            operation (str): 'insert', 'undo' or 'reset'.
+            **fields (object): The 'label', 'box' and 'color' of an inserted box or the 'label' of an undone box.
 
-        self.main_window.statusBar().showMessage(f"Performed save. Saved to {save_path}.", 5000)
+        Returns:
+            None
+        """
+        self.image.mark_dirty()
+        self.main_window.autosaver.record(self.image, operation, **fields)
 
     def print_labels(self) -> None:
         """ Display annotations action.
@@ -448,9 +572,19 @@ class Canvas(QWidget):
         change_to_view_action.setShortcut('Ctrl+V')
         change_to_view_action.triggered.connect(self.change_to_view)
 
+        accept_suggestions_action = QAction('Accept suggestions', self)
+        accept_suggestions_action.setShortcut('Ctrl+A')
+        accept_suggestions_action.triggered.connect(self.accept_suggestions)
+
+        reject_suggestions_action = QAction('Reject suggestions', self)
+        reject_suggestions_action.setShortcut('Ctrl+X')
+        reject_suggestions_action.triggered.connect(self.reject_suggestions)
+
         self.addAction(undo_action)
         self.addAction(reset_action)
         self.addAction(save_action)
         self.addAction(print_labels_action)
         self.addAction(change_to_draw_action)
         self.addAction(change_to_view_action)
+        self.addAction(accept_suggestions_action)
+        self.addAction(reject_suggestions_action)
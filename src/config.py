@@ -6,3 +6,18 @@ DATA_DIR = Path(BASE_DIR, 'data')
 IMAGE_DIR = Path(DATA_DIR, 'images')
 ANNOTATION_DIR = Path(DATA_DIR, 'annotations')
 SRC_DIR = Path(BASE_DIR, 'src')
+ANNOTATION_INDEX_PATH = Path(DATA_DIR, 'annotations.idx')
+MANIFEST_PATH = Path(DATA_DIR, 'manifest.json')
+IMAGE_CACHE_DIR = Path(DATA_DIR, 'cache')
+SHARD_DIR = Path(DATA_DIR, 'shards')
+VOCABULARY_PATH = Path(DATA_DIR, 'classes.json')
+MODEL_PATH = Path(BASE_DIR, 'model.pth')
+SUGGESTION_DIR = Path(DATA_DIR, 'suggestions')
+ANNOTATION_DB_PATH = Path(DATA_DIR, 'annotations.db')
+JOURNAL_PATH = Path(ANNOTATION_DIR, 'journal.jsonl')
+# Where the annotations are saved, 'xml' for one .xml file per image or 'sqlite' for the database
+ANNOTATION_BACKEND = 'xml'
+# The milliseconds without a change after which the annotations of the image on the canvas are saved
+AUTOSAVE_DELAY = 1000
+# The milliseconds the changes of the watched directories are coalesced for before the file list is updated
+WATCH_DELAY = 250
@@ -0,0 +1,233 @@
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from src.annotation_index import AnnotationIndex
+from src.config import *
+from src.manifest import Manifest
+from src.parallel import chunk_ranges, ordered_map, worker_count
+from src.vocabulary import Vocabulary
+
+# The number of images formatted or written by a worker per task
+CHUNK_SIZE = 1024
+
+
+def _prepare(
+        index: Optional[AnnotationIndex],
+        vocabulary: Optional[Vocabulary],
+        image_names: Optional[Dict[str, str]],
+) -> Tuple[AnnotationIndex, Vocabulary, Dict[str, str]]:
+    """ Fill in the defaults of the exporters.
+
+    Returns:
+        Tuple[index, vocabulary, image_names]
+    """
+    if index is None:
+        index = AnnotationIndex.load()
+    if vocabulary is None:
+        vocabulary = Vocabulary.load()
+    if image_names is None:
+        image_names = Manifest().scan().images
+    return index, vocabulary, image_names
+
+
+def _coco_annotations(index: AnnotationIndex, lookup: np.ndarray, start: int, end: int, rows: np.ndarray) -> str:
+    """ Format the COCO annotations of a range of rows. Runs in a worker.
+
+    The annotation id is the position of the box in the index plus one and the image id is the row plus one, so the
+    chunks are formatted independently.
+
+    Args:
+        index (AnnotationIndex): The annotation index, memory-mapped again in the worker.
+        lookup (np.ndarray): The category ids of the label ids of the index.
+        start (int): The first row.
+        end (int): The end of the rows.
+        rows (np.ndarray): The exported rows of the range.
+
+    Returns:
+        text (str): The JSON objects of the annotations separated by commas, empty if there are none.
+    """
+    arrays = index.arrays
+    offsets = arrays['offsets']
+    box_start, box_end = offsets[start], offsets[end]
+    boxes = arrays['boxes'][box_start:box_end].astype(np.int64)
+    categories = lookup[arrays['labels'][box_start:box_end]]
+    image_ids = np.repeat(np.arange(start, end) + 1, np.diff(offsets[start:end + 1]))
+    # The boxes of the images without an image file are dropped
+    keep = np.isin(image_ids - 1, rows)
+
+    top_left = np.minimum(boxes[:, :2], boxes[:, 2:])
+    size = np.abs(boxes[:, 2:] - boxes[:, :2])
+    return ',\n'.join(
+        f'{{"id": {box_id}, "image_id": {image_id}, "category_id": {category}, "bbox": [{x}, {y}, {w}, {h}], '
+        f'"area": {w * h}, "iscrowd": 0}}'
+        for box_id, image_id, category, (x, y), (w, h) in zip(
+            (np.arange(box_start, box_end) + 1)[keep].tolist(), image_ids[keep].tolist(), categories[keep].tolist(),
+            top_left[keep].tolist(), size[keep].tolist()
+        )
+    )
+
+
+def export_coco(
+        output_path: str,
+        index: Optional[AnnotationIndex] = None,
+        vocabulary: Optional[Vocabulary] = None,
+        image_names: Optional[Dict[str, str]] = None,
+        num_workers: Optional[int] = None,
+        chunk_size: int = CHUNK_SIZE,
+) -> Dict[str, int]:
+    """ Write the annotations as one COCO detection JSON file.
+
+    The file is streamed from the memory-mapped annotation index: the images and then the annotations are written chunk
+    by chunk, and the annotation chunks are formatted in parallel, so the memory use does not grow with the number of
+    boxes. The category ids are the class ids of the vocabulary, which start at 1 as the id 0 is the background. The
+    file is written to a temporary path first and renamed.
+
+    Args:
+        output_path (str): The path to the JSON file.
+        index (Optional[AnnotationIndex]): The annotation index, by default the index of the annotation directory.
+        vocabulary (Optional[Vocabulary]): The vocabulary of the category ids, by default the vocabulary of the data
+            directory.
+        image_names (Optional[Dict[str, str]]): The image file names by the file name stem, by default the images of
+            the manifest. The annotations without an image are skipped.
+        num_workers (Optional[int]): The number of worker processes, the number of CPUs by default.
+        chunk_size (int): The number of images per task.
+
+    Returns:
+        counts (Dict[str, int]): The number of exported 'images' and 'annotations' and of the 'skipped' annotation
+            files without an image.
+    """
+    index, vocabulary, image_names = _prepare(index, vocabulary, image_names)
+    lookup = vocabulary.encode(index.classes)
+    rows = np.array([row for row, name in enumerate(index.names) if name in image_names], dtype=np.int64)
+    sizes = index.arrays['sizes']
+    chunks = chunk_ranges(len(index), chunk_size)
+
+    output_path = Path(output_path)
+    temporary_path = output_path.with_name(f'{output_path.name}.{os.getpid()}.tmp')
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        categories = [{'id': class_id, 'name': label} for class_id, label in enumerate(vocabulary.classes) if class_id]
+        file.write(f'{{"info": {{}}, "licenses": [], "categories": {json.dumps(categories)},\n"images": [\n')
+
+        separator = ''
+        for row in rows.tolist():
+            width, height = sizes[row].tolist()
+            image = {'id': row + 1, 'file_name': image_names[index.names[row]], 'width': width, 'height': height}
+            file.write(separator + json.dumps(image))
+            separator = ',\n'
+
+        file.write('\n],\n"annotations": [\n')
+        separator = ''
+        arguments = ((index, lookup, start, end, rows[(rows >= start) & (rows < end)]) for start, end in chunks)
+        for text in ordered_map(_coco_annotations, arguments, worker_count(num_workers, len(chunks))):
+            if text:
+                file.write(separator + text)
+                separator = ',\n'
+        file.write('\n]}\n')
+    os.replace(temporary_path, output_path)
+
+    offsets = index.arrays['offsets']
+    num_annotations = int((offsets[rows + 1] - offsets[rows]).sum()) if len(rows) else 0
+    return {'images': len(rows), 'annotations': num_annotations, 'skipped': len(index) - len(rows)}
+
+
+def _yolo_labels(
+        index: AnnotationIndex,
+        lookup: np.ndarray,
+        rows: List[int],
+        label_names: List[str],
+        output_dir: str,
+) -> int:
+    """ Write the YOLO label files of some rows. Runs in a worker.
+
+    Args:
+        index (AnnotationIndex): The annotation index, memory-mapped again in the worker.
+        lookup (np.ndarray): The YOLO class ids of the label ids of the index.
+        rows (List[int]): The rows to write.
+        label_names (List[str]): The file names of the label files of the rows.
+        output_dir (str): The directory to write the label files to.
+
+    Returns:
+        count (int): The number of written boxes.
+    """
+    count = 0
+    for row, label_name in zip(rows, label_names):
+        boxes, labels = index.get(index.names[row])
+        size = np.maximum(index.arrays['sizes'][row], 1).astype(np.float64)
+        boxes = boxes.astype(np.float64)
+
+        top_left = np.clip(np.minimum(boxes[:, :2], boxes[:, 2:]) / size, 0, 1)
+        bottom_right = np.clip(np.maximum(boxes[:, :2], boxes[:, 2:]) / size, 0, 1)
+        centers = (top_left + bottom_right) / 2
+        extents = bottom_right - top_left
+        lines = ''.join(
+            f'{class_id} {x:.6f} {y:.6f} {w:.6f} {h:.6f}\n'
+            for class_id, (x, y), (w, h) in zip(lookup[labels].tolist(), centers.tolist(), extents.tolist())
+        )
+        with open(os.path.join(output_dir, label_name), 'w', encoding='utf-8') as file:
+            file.write(lines)
+        count += len(boxes)
+    return count
+
+
+def export_yolo(
+        output_dir: str,
+        index: Optional[AnnotationIndex] = None,
+        vocabulary: Optional[Vocabulary] = None,
+        image_names: Optional[Dict[str, str]] = None,
+        num_workers: Optional[int] = None,
+        chunk_size: int = CHUNK_SIZE,
+) -> Dict[str, int]:
+    """ Write the annotations as YOLO label files, one .txt file per image named after the image.
+
+    Every line is the class id and the box center, width and height divided by the image size. The class ids are the
+    class ids of the vocabulary minus one, as YOLO has no background class, and their names are written to
+    classes.txt. The label files are written by the workers in parallel.
+
+    Args:
+        output_dir (str): The directory to write the label files to.
+        index (Optional[AnnotationIndex]): The annotation index, by default the index of the annotation directory.
+        vocabulary (Optional[Vocabulary]): The vocabulary of the class ids, by default the vocabulary of the data
+            directory.
+        image_names (Optional[Dict[str, str]]): The image file names by the file name stem, by default the images of
+            the manifest. The annotations without an image are skipped.
+        num_workers (Optional[int]): The number of worker processes, the number of CPUs by default.
+        chunk_size (int): The number of images per task.
+
+    Returns:
+        counts (Dict[str, int]): The number of exported 'images' and 'annotations' and of the 'skipped' annotation
+            files without an image.
+    """
+    index, vocabulary, image_names = _prepare(index, vocabulary, image_names)
+    lookup = vocabulary.encode(index.classes) - 1
+    rows = [row for row, name in enumerate(index.names) if name in image_names]
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'classes.txt'), 'w', encoding='utf-8') as file:
+        file.write(''.join(f'{label}\n' for label in vocabulary.classes[1:]))
+
+    chunks = chunk_ranges(len(rows), chunk_size)
+    arguments = (
+        (
+            index, lookup, rows[start:end],
+            [f'{Path(image_names[index.names[row]]).stem}.txt' for row in rows[start:end]], str(output_dir)
+        )
+        for start, end in chunks
+    )
+    num_annotations = sum(ordered_map(_yolo_labels, arguments, worker_count(num_workers, len(chunks))))
+    return {'images': len(rows), 'annotations': num_annotations, 'skipped': len(index) - len(rows)}
+
+
+if __name__ == '__main__':
+    formats = {'coco': export_coco, 'yolo': export_yolo}
+    if len(sys.argv) != 3 or sys.argv[1] not in formats:
+        print('Usage: python -m src.exporters coco <output .json file> | yolo <output directory>')
+        sys.exit(1)
+
+    counts = formats[sys.argv[1]](sys.argv[2])
+    print(f'Exported {counts["images"]} images with {counts["annotations"]} annotations to {sys.argv[2]}, '
+          f'skipped {counts["skipped"]} annotation files without an image')
@@ -1,22 +1,30 @@
+import fnmatch
 import glob
 import os
 from pathlib import Path
+from typing import Dict, Optional
 
 try:
     from PyQt6.QtWidgets import QListWidget, QGridLayout, QMainWindow, QGraphicsScene
 except ImportError:
     raise ImportError("Requires PyQt6")
 
+from src.annotation_store import get_store
 from src.canvas import Canvas
-from src.config import IMAGE_EXTENSIONS
+from src.config import ANNOTATION_DIR, IMAGE_EXTENSIONS
+from src.watcher import DirectoryWatcher
 
 
 class FileList(QListWidget):
     """ A custom list widget to select images
 
+    The list follows the opened directory: the images added, removed or renamed by other programs are applied to the
+    list as they happen, and the image on the canvas is loaded again when its annotation is changed by another program.
+
     Attributes:
         main_window (QMainWindow): The parent main window of the widget
         directory_path (str): The string represents the opened directory containing the images
+        watcher (DirectoryWatcher): The watcher of the opened directory and the annotation directory
     """
     def __init__(self, main_window: QMainWindow):
         """ Initialize the instance given the main_window
@@ -29,6 +37,11 @@ class FileList(QListWidget):
         self.main_window = main_window
         self.scene = self.main_window.scene
         self.directory_path = None
+        # The list items by the image file names
+        self._items = {}
+
+        self.watcher = DirectoryWatcher(self)
+        self.watcher.changed.connect(self._on_changed)
 
     def update_sub_view(self, directory_path=None):
         """ List all the images of the formats '.jpg', '.jpeg', '.png' (these can be modified in the src/config.py)
@@ -38,6 +51,20 @@ class FileList(QListWidget):
             directory_path (str): A string represents the opened directory containing the images
         """
 
+        # The dialog was cancelled
+        if not directory_path:
+            return
+
+        # Watch the new directory instead of the previous one, whose images leave the list
+        if self.directory_path is not None:
+            self.watcher.unwatch(self.directory_path)
+            self.itemSelectionChanged.disconnect(self._select_item)
+            self.clear()
+            self._items.clear()
+        self.watcher.watch(directory_path)
+        if os.path.isdir(ANNOTATION_DIR):
+            self.watcher.watch(ANNOTATION_DIR)
+
         # Set attribute
         self.directory_path = directory_path
 
@@ -49,6 +76,10 @@ class FileList(QListWidget):
         # Add the images to the widget
         for index, image_file_path in enumerate(image_file_paths):
             self.insertItem(index, Path(image_file_path).name)
+            self._items[Path(image_file_path).name] = self.item(index)
+
+        # Suggest the bounding boxes in background if the pre-annotation is on
+        self.main_window.pre_annotator.set_images(image_file_paths)
 
         # Add action when the selected item changes
         self.itemSelectionChanged.connect(self._select_item)
@@ -62,6 +93,13 @@ class FileList(QListWidget):
 
         # Define the selected item
         item = self.currentItem()
+        if item is None:
+            return
+
+        # Save the changes of the previous image in background
+        previous = getattr(self.main_window, 'canvas', None)
+        if previous is not None:
+            self.main_window.autosaver.save(previous.image)
 
         # Clean the scene and the filter_widget
         self.scene.clear()
@@ -72,3 +110,83 @@ class FileList(QListWidget):
         self.main_window.canvas = canvas
         self.main_window.scene.addWidget(canvas)
         self.main_window.view.update_view()
+
+    def _on_changed(self, directory: str, changes: Optional[Dict[str, bool]]) -> None:
+        """ Apply the coalesced changes of a watched directory.
+
+        Args:
+            directory (str): The changed directory.
+            changes (Optional[Dict[str, bool]]): The changed file names, True if the file exists or was modified and
+                False if it was removed, or None if the changes are unknown.
+
+        Returns:
+            None
+        """
+        if directory == os.path.abspath(ANNOTATION_DIR):
+            self._on_annotations_changed(changes)
+        elif self.directory_path is not None and directory == os.path.abspath(self.directory_path):
+            if changes is None:
+                # Events were dropped, the directory is compared with the list once
+                names = set(os.listdir(directory))
+                changes = {name: name in names for name in names | self._items.keys()}
+            self._apply_changes(changes)
+
+    def _apply_changes(self, changes: Dict[str, bool]) -> None:
+        """ Add the new images to the end of the list and remove the deleted ones. A renamed image is removed and added.
+
+        Args:
+            changes (Dict[str, bool]): The changed file names, True if the file exists and False if it was removed.
+
+        Returns:
+            None
+        """
+        current = self.currentItem()
+        removed_current = False
+
+        # The selection changes once after the whole batch instead of after every removal
+        self.blockSignals(True)
+        self.setUpdatesEnabled(False)
+        try:
+            for name, exists in changes.items():
+                if not any(fnmatch.fnmatch(name, pattern) for pattern in IMAGE_EXTENSIONS):
+                    continue
+                if exists and name not in self._items:
+                    self.addItem(name)
+                    self._items[name] = self.item(self.count() - 1)
+                elif not exists and name in self._items:
+                    item = self._items.pop(name)
+                    removed_current = removed_current or item is current
+                    self.takeItem(self.row(item))
+        finally:
+            self.setUpdatesEnabled(True)
+            self.blockSignals(False)
+
+        if removed_current:
+            self._select_item()
+
+    def _on_annotations_changed(self, changes: Optional[Dict[str, bool]]) -> None:
+        """ Load the image on the canvas again if its annotation file was changed by another program. The unsaved
+        edits of the annotator are kept, they are saved over the file.
+
+        Args:
+            changes (Optional[Dict[str, bool]]): The changed file names of the annotation directory, or None if the
+                changes are unknown.
+
+        Returns:
+            None
+        """
+        canvas = getattr(self.main_window, 'canvas', None)
+        if canvas is None or canvas.image.is_dirty():
+            return
+        image_path = canvas.image.get_path()
+        if changes is not None and f'{Path(image_path).stem}.xml' not in changes:
+            return
+
+        # The file may have been written by the autosave
+        self.main_window.autosaver.wait(image_path)
+        annotation = get_store().load(image_path) or ([], [], {})
+        if annotation == (canvas.image.get_label(), canvas.image.get_bounding_box(), canvas.image.get_color_dict()):
+            return
+
+        self._select_item()
+        self.main_window.statusBar().showMessage(f'Reloaded the annotations of {Path(image_path).name}.', 3000)
@@ -1,5 +1,4 @@
-from typing import List, Tuple, Dict
-import xml.etree.ElementTree as ET
+from typing import List, Tuple, Dict, Optional
 
 try:
     from PyQt6.QtGui import QPixmap, QColor
@@ -8,7 +7,7 @@ except ImportError:
     raise ImportError("Requires PyQt6")
 
 from src.config import *
-from src.utils import parse_xml, parse_annotation_dict
+from src.annotation_store import get_store
 
 
 class Image(QPixmap):
@@ -21,6 +20,11 @@ class Image(QPixmap):
         bounding_boxes (List[Tuple[int, int, int, int]]): A list of int contains the bounding boxes.
         label_color_dict (Dict[str, str]): A dictionary contains the labels as keys and colors as hex strings
             to store which colors correspond to a given label.
+        suggestions (List[Tuple[str, Tuple[int, int, int, int], float]]): The labels, bounding boxes and scores
+            suggested by the trained model, which are not annotations until accepted.
+        version (int): The number of changes made to the annotations, incremented by `mark_dirty`.
+        saved_version (int): The version of the annotations last written to the annotation backend.
+        stored (bool): Whether the annotation backend has an annotation of the image.
     """
 
     def __init__(self, image_path: str) -> object:
@@ -37,6 +41,10 @@ class Image(QPixmap):
         self.bounding_boxes = []
         self.label_color_dict = {}
         self.visible = {}
+        self.suggestions = []
+        self.version = 0
+        self.saved_version = 0
+        self.stored = False
 
     def get_path(self) -> str:
         """ Get the path of the image.
@@ -81,12 +89,89 @@ class Image(QPixmap):
 
     def add_bounding_box(self, start_point: QPoint, end_point: QPoint) -> None:
         """ Turn start_point and end_point into a tuple of [xmin, ymin, xmax, ymax] then
-        add to the bounding boxes attribute.
+        add to the bounding boxes attribute. The box may be drawn in any direction.
 
         Returns:
             None
         """
-        self.bounding_boxes.append((start_point.x(), start_point.y(), end_point.x(), end_point.y()))
+        self.bounding_boxes.append((
+            min(start_point.x(), end_point.x()), min(start_point.y(), end_point.y()),
+            max(start_point.x(), end_point.x()), max(start_point.y(), end_point.y())
+        ))
+
+    def mark_dirty(self) -> None:
+        """ Record a change of the labels, bounding boxes or colors, so the annotations are saved again.
+
+        Returns:
+            None
+        """
+        self.version += 1
+
+    def mark_saved(self, version: int) -> None:
+        """ Record that the annotations of the given version were written. A save of an older version, which finished
+        after a newer one, does not make the image look saved.
+
+        Args:
+            version (int): The version of the written annotations.
+
+        Returns:
+            None
+        """
+        self.saved_version = max(self.saved_version, version)
+        self.stored = True
+
+    def is_dirty(self) -> bool:
+        """ Return a boolean indicating if the annotations have changed since they were last saved.
+
+        Returns:
+            bool: True if there are unsaved changes else False
+        """
+        return self.version != self.saved_version
+
+    def snapshot(self) -> Tuple[int, List[str], List[Tuple[int, int, int, int]], Dict[str, str]]:
+        """ Copy the annotations, so they can be written in another thread while the user keeps drawing.
+
+        Returns:
+            Tuple[version, labels, bounding_boxes, label_color_dict]
+        """
+        return self.version, list(self.labels), list(self.bounding_boxes), dict(self.label_color_dict)
+
+    def set_suggestions(self, suggestions: List[Tuple[str, Tuple[int, int, int, int], float]]) -> None:
+        """ Replace the suggested bounding boxes of the image.
+
+        Args:
+            suggestions (List[Tuple[str, Tuple[int, int, int, int], float]]): The labels, bounding boxes and scores.
+
+        Returns:
+            None
+        """
+        self.suggestions = list(suggestions)
+
+    def find_suggestion(self, point: QPoint) -> Optional[int]:
+        """ Find the suggested bounding box containing the point. The last one is drawn on top, so it is found first.
+
+        Args:
+            point (QPoint): The point on the image.
+
+        Returns:
+            index (Optional[int]): The index of the suggestion, or None if no suggestion contains the point.
+        """
+        for index in reversed(range(len(self.suggestions))):
+            x1, y1, x2, y2 = self.suggestions[index][1]
+            if min(x1, x2) <= point.x() <= max(x1, x2) and min(y1, y2) <= point.y() <= max(y1, y2):
+                return index
+        return None
+
+    def pop_suggestion(self, index: int) -> Tuple[str, Tuple[int, int, int, int], float]:
+        """ Remove the suggestion from the suggestions list.
+
+        Args:
+            index (int): The index of the suggestion.
+
+        Returns:
+            suggestion (Tuple[str, Tuple[int, int, int, int], float]): The label, bounding box and score.
+        """
+        return self.suggestions.pop(index)
 
     def is_existed_annotation(self) -> bool:
         """ Return a boolean indicating if the image has the corresponding annotation file.
@@ -102,14 +187,18 @@ class Image(QPixmap):
         return False
 
     def load_annotation(self) -> bool:
-        """ Check if there is an annotation file, and if it exists add them into the class attributes.
+        """ Check if there is an annotation in the annotation backend, and if it exists add them into the class
+        attributes.
 
         Returns:
             bool: True for success, False otherwise
         """
-        if self.is_existed_annotation():
-            result_dict = parse_xml(ET.parse(self.annotation_path).getroot())
-            self.labels, self.bounding_boxes, self.label_color_dict = parse_annotation_dict(result_dict)
+        annotation = get_store().load(self.image_path)
+        if annotation is not None:
+            # Points annotation_path to the .xml file with the xml backend
+            self.is_existed_annotation()
+            self.labels, self.bounding_boxes, self.label_color_dict = annotation
             self.visible = {label: True for label in self.label_color_dict.keys()}
+            self.stored = True
             return True
         return False
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+from src.config import *
+
+# Every image in a shard starts at a multiple of this many bytes
+ALIGNMENT = 64
+# The default resolution cap. Faster R-CNN resizes its inputs to at most 1333 pixels anyway.
+DEFAULT_MAX_SIZE = 1333
+
+# The columns of the table of the decoded images
+SHARD, OFFSET, HEIGHT, WIDTH, ORIGINAL_HEIGHT, ORIGINAL_WIDTH = range(6)
+
+
+def _decode(image_path: str, max_size: Optional[int]) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """ Decode an image to RGB and downscale it so that its longer side is at most max_size.
+
+    Args:
+        image_path (str): The path to the image.
+        max_size (Optional[int]): The resolution cap, or None to keep the original resolution.
+
+    Returns:
+        Tuple[array, original_size]: The (H, W, 3) uint8 array and the original (height, width).
+    """
+    with Image.open(image_path) as img:
+        original_size = (img.height, img.width)
+        if max_size is not None and max(img.size) > max_size:
+            scale = max_size / max(img.size)
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            # Let the JPEG decoder skip the detail that is thrown away by the resize
+            img.draft('RGB', size)
+            img = img.convert('RGB').resize(size, Image.Resampling.BILINEAR)
+        else:
+            img = img.convert('RGB')
+        return np.asarray(img, dtype=np.uint8), original_size
+
+
+def _write_shard(shard_path: str, image_paths: Sequence[str], max_size: Optional[int]) -> List[List[int]]:
+    """ Decode the images and write them one after another into a shard file.
+
+    Args:
+        shard_path (str): The path to the shard file.
+        image_paths (Sequence[str]): The paths to the images of the shard.
+        max_size (Optional[int]): The resolution cap, or None to keep the original resolution.
+
+    Returns:
+        rows (List[List[int]]): The rows of the table without the shard column filled in.
+    """
+    rows = []
+    with open(shard_path, 'wb') as file:
+        for image_path in image_paths:
+            array, (original_height, original_width) = _decode(image_path, max_size)
+            offset = file.tell()
+            file.write(array.tobytes())
+            file.write(b'\0' * (-file.tell() % ALIGNMENT))
+            rows.append([0, offset, array.shape[0], array.shape[1], original_height, original_width])
+    return rows
+
+
+def cache_key(image_paths: Sequence[str], max_size: Optional[int]) -> str:
+    """ Compute the key of the cache from the image paths, their sizes and modification times, and the resolution cap.
+
+    Args:
+        image_paths (Sequence[str]): The paths to the images.
+        max_size (Optional[int]): The resolution cap.
+
+    Returns:
+        key (str): The hexadecimal digest which changes whenever the cache has to be rebuilt.
+    """
+    digest = hashlib.sha1(f'{max_size}'.encode('utf-8'))
+    for image_path in image_paths:
+        stat = os.stat(image_path)
+        digest.update(f'\0{image_path}:{stat.st_mtime_ns}:{stat.st_size}'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ImageCache:
+    """ A cache of decoded images stored as raw uint8 pixels in shard files.
+
+    Every image is decoded once into (H, W, 3) uint8 layout. The shards are memory-mapped lazily in every process, so
+    the DataLoader workers read the same pages from the page cache and the images are returned without copying.
+
+    Attributes:
+        cache_dir (Path): The directory containing the shards and the metadata.
+        max_size (Optional[int]): The resolution cap of the longer side of the images.
+        image_paths (List[str]): The paths to the cached images, in the order of the cache.
+        table (np.ndarray): The (N, 6) int64 table with the shard, the byte offset, the cached height and width and the
+            original height and width of every image.
+    """
+
+    def __init__(self, cache_dir: str = IMAGE_CACHE_DIR):
+        """ Open an existing cache. The shards are mapped on the first access.
+
+        Args:
+            cache_dir (str): The directory containing the shards and the metadata.
+        """
+        self.cache_dir = Path(cache_dir)
+
+        with open(Path(self.cache_dir, 'meta.json'), encoding='utf-8') as file:
+            meta = json.load(file)
+
+        self.key = meta['key']
+        self.max_size = meta['max_size']
+        self.image_paths = meta['image_paths']
+        self.shards = meta['shards']
+        self.table = np.load(Path(self.cache_dir, 'table.npy'))
+        self._maps = {}
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """ Drop the memory maps when pickled, so the DataLoader workers map the shards themselves.
+        """
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+    def __len__(self) -> int:
+        return len(self.image_paths)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        """ Get a decoded image without copying.
+
+        The shards are mapped copy-on-write, so the array can be wrapped with `torch.from_numpy` or given to
+        `ToTensor`, but writing to it never changes the cache.
+
+        Args:
+            index (int): The index of the image in the cache.
+
+        Returns:
+            img (np.ndarray): The (H, W, 3) uint8 array.
+        """
+        shard, offset, height, width = (int(value) for value in self.table[index, :ORIGINAL_HEIGHT])
+
+        if shard not in self._maps:
+            self._maps[shard] = np.memmap(Path(self.cache_dir, self.shards[shard]), dtype=np.uint8, mode='c')
+
+        return self._maps[shard][offset:offset + height * width * 3].reshape(height, width, 3)
+
+    def scale(self, index: int) -> Tuple[float, float]:
+        """ Get the factors the image was resized by when cached.
+
+        Args:
+            index (int): The index of the image in the cache.
+
+        Returns:
+            Tuple[scale_x, scale_y]: The cached width and height divided by the original ones.
+        """
+        height, width, original_height, original_width = self.table[index, HEIGHT:]
+        return width / original_width, height / original_height
+
+    @classmethod
+    def build(
+            cls,
+            image_paths: Sequence[str],
+            cache_dir: str = IMAGE_CACHE_DIR,
+            max_size: Optional[int] = DEFAULT_MAX_SIZE,
+            images_per_shard: int = 1024,
+            num_workers: Optional[int] = None,
+            key: Optional[str] = None,
+    ) -> 'ImageCache':
+        """ Decode all the images into a new cache. The shards are written in parallel.
+
+        The metadata is written last, so an interrupted build leaves no valid cache behind.
+
+        Args:
+            image_paths (Sequence[str]): The paths to the images.
+            cache_dir (str): The directory to write the shards and the metadata to. A previous cache in it is removed.
+            max_size (Optional[int]): The resolution cap of the longer side, or None to keep the original resolution.
+            images_per_shard (int): The number of images in a shard.
+            num_workers (Optional[int]): The number of decoding processes, by default the number of CPUs.
+            key (Optional[str]): The precomputed key of the cache.
+
+        Returns:
+            cache (ImageCache): The built cache.
+        """
+        image_paths = [str(image_path) for image_path in image_paths]
+        if key is None:
+            key = cache_key(image_paths, max_size)
+
+        cache_dir = Path(cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        for path in [Path(cache_dir, 'meta.json'), Path(cache_dir, 'table.npy'), *cache_dir.glob('shard_*.bin')]:
+            path.unlink(missing_ok=True)
+
+        chunks = [image_paths[start:start + images_per_shard] for start in range(0, len(image_paths), images_per_shard)]
+        shards = [f'shard_{number:05d}.bin' for number in range(len(chunks))]
+
+        table = []
+        with ProcessPoolExecutor(num_workers) as executor:
+            futures = [
+                executor.submit(_write_shard, str(Path(cache_dir, shard)), chunk, max_size)
+                for shard, chunk in zip(shards, chunks)
+            ]
+            for number, future in enumerate(futures):
+                for row in future.result():
+                    row[SHARD] = number
+                    table.append(row)
+
+        np.save(Path(cache_dir, 'table.npy'), np.asarray(table, dtype=np.int64).reshape(-1, 6))
+        with open(Path(cache_dir, 'meta.json'), 'w', encoding='utf-8') as file:
+            json.dump({'key': key, 'max_size': max_size, 'image_paths': image_paths, 'shards': shards}, file)
+
+        return cls(cache_dir)
+
+    @classmethod
+    def load(
+            cls,
+            image_paths: Sequence[str],
+            cache_dir: str = IMAGE_CACHE_DIR,
+            max_size: Optional[int] = DEFAULT_MAX_SIZE,
+            **kwargs: Any,
+    ) -> 'ImageCache':
+        """ Open the cache of the images, building it first if it does not exist or is out of date.
+
+        Args:
+            image_paths (Sequence[str]): The paths to the images.
+            cache_dir (str): The directory containing the shards and the metadata.
+            max_size (Optional[int]): The resolution cap of the longer side, or None to keep the original resolution.
+            **kwargs (Any): The keyword arguments given to `build`.
+
+        Returns:
+            cache (ImageCache): The up-to-date cache.
+        """
+        image_paths = [str(image_path) for image_path in image_paths]
+        key = cache_key(image_paths, max_size)
+
+        try:
+            cache = cls(cache_dir)
+            if cache.key == key:
+                return cache
+        except (OSError, ValueError, KeyError):
+            pass
+
+        return cls.build(image_paths, cache_dir, max_size, key=key, **kwargs)
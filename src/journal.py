@@ -0,0 +1,197 @@
+import json
+import os
+import sys
+import threading
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+from src.annotation_store import Annotation, get_store
+from src.config import *
+
+
+def apply_record(annotation: Annotation, record: Dict) -> None:
+    """ Apply an edit of the journal to the annotation of its image in place.
+
+    Every record carries the number of boxes of the image after the edit, and an edit first cuts the boxes to the
+    count it started from. Applying the records of a journal again to an annotation which already contains them gives
+    the same annotation, so a compaction interrupted by a crash can simply be repeated.
+
+    Args:
+        annotation (Annotation): The labels, bounding boxes and label colors of the image.
+        record (Dict): The edit, with the 'op' 'insert', 'undo' or 'reset' and the 'count'.
+
+    Returns:
+        None
+    """
+    labels, bounding_boxes, label_color_dict = annotation
+    operation, count = record['op'], record['count']
+    if operation == 'insert':
+        del labels[count - 1:], bounding_boxes[count - 1:]
+        labels.append(record['label'])
+        bounding_boxes.append(tuple(record['box']))
+        label_color_dict[record['label']] = record['color']
+    elif operation == 'undo':
+        del labels[count:], bounding_boxes[count:]
+        if record['label'] not in labels:
+            label_color_dict.pop(record['label'], None)
+    elif operation == 'reset':
+        labels.clear()
+        bounding_boxes.clear()
+        label_color_dict.clear()
+    else:
+        raise ValueError(f'Unknown journal operation {operation}')
+
+
+def read_records(path: str) -> Iterator[Dict]:
+    """ Read the records of a journal file in order.
+
+    A crash during an append can leave the last line incomplete, that edit was never acknowledged and is skipped.
+
+    Args:
+        path (str): The path to the journal file.
+
+    Returns:
+        records (Iterator[Dict]): The records.
+    """
+    with open(path, 'rb') as file:
+        for line in file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                return
+
+
+class Journal:
+    """ An append-only journal of the edits of the annotations.
+
+    Every edit is appended to the journal as one JSON line and flushed to the disk, which costs the same however many
+    boxes the image has, instead of writing the whole annotation. `compact` folds the journal into the annotation
+    backend: the journal is renamed, its edits are applied to the stored annotations, which are written once per
+    image, and the renamed file is removed. The edits appended meanwhile go to a new journal. A journal left behind by
+    a crash is folded by the next `compact`, e.g. when the program starts again.
+
+    Attributes:
+        path (Path): The path to the journal file.
+        compacting_path (Path): The path to the renamed journal while it is folded.
+    """
+
+    def __init__(self, path: str = JOURNAL_PATH):
+        """ Initialize the instance. The journal file is created by the first append.
+
+        Args:
+            path (str): The path to the journal file.
+        """
+        self.path = Path(path)
+        self.compacting_path = self.path.with_name(f'{self.path.name}.compacting')
+
+        self._file = None
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+
+    def append(self, record: Dict) -> None:
+        """ Append an edit to the journal and flush it to the disk.
+
+        Args:
+            record (Dict): The JSON serializable edit.
+
+        Returns:
+            None
+        """
+        line = json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+        with self._lock:
+            if self._file is None:
+                os.makedirs(self.path.parent, exist_ok=True)
+                self._file = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            os.write(self._file, line)
+            os.fsync(self._file)
+
+    def pending(self) -> bool:
+        """ Return a boolean indicating if the journal has edits which are not folded into the annotations yet.
+
+        Returns:
+            bool: True if there are edits to compact else False
+        """
+        return self.compacting_path.is_file() or (self.path.is_file() and self.path.stat().st_size > 0)
+
+    def close(self) -> None:
+        """ Close the journal file. The next append opens it again.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if self._file is not None:
+                os.close(self._file)
+                self._file = None
+
+    def compact(self, store: Optional[object] = None) -> Dict[str, str]:
+        """ Fold the journal into the annotation backend.
+
+        Args:
+            store (XmlStore | SqliteStore): The annotation backend, the configured backend by default.
+
+        Returns:
+            locations (Dict[str, str]): Where the annotation of every image with edits was saved, by the image path.
+        """
+        if store is None:
+            store = get_store()
+
+        locations = {}
+        with self._compact_lock:
+            # A journal left by an interrupted compaction first, then the edits appended until now
+            for _ in range(2):
+                if not self.compacting_path.is_file() and not self._rotate():
+                    break
+                locations.update(self._fold(store))
+        return locations
+
+    def _rotate(self) -> bool:
+        """ Rename the journal, so the following appends go to a new journal file.
+
+        Returns:
+            bool: True if there were edits to fold, False if the journal is empty
+        """
+        with self._lock:
+            if self._file is not None:
+                os.close(self._file)
+                self._file = None
+            if not self.path.is_file() or self.path.stat().st_size == 0:
+                return False
+            os.replace(self.path, self.compacting_path)
+            return True
+
+    def _fold(self, store: object) -> Dict[str, str]:
+        """ Apply the edits of the renamed journal to the stored annotations and remove it once they are written.
+
+        Args:
+            store (XmlStore | SqliteStore): The annotation backend.
+
+        Returns:
+            locations (Dict[str, str]): Where the annotation of every image with edits was saved, by the image path.
+        """
+        annotations = {}
+        sizes = {}
+        for record in read_records(self.compacting_path):
+            image_path = record['image']
+            if image_path not in annotations:
+                labels, bounding_boxes, label_color_dict = store.load(image_path) or ([], [], {})
+                annotations[image_path] = (list(labels), list(bounding_boxes), dict(label_color_dict))
+            apply_record(annotations[image_path], record)
+            sizes[image_path] = record['size']
+
+        # The journal is removed only after the annotations are on the disk
+        locations = {
+            image_path: store.save(image_path, *sizes[image_path], *annotation, fsync=True)
+            for image_path, annotation in annotations.items()
+        }
+        os.remove(self.compacting_path)
+        return locations
+
+
+if __name__ == '__main__':
+    journal = Journal(*sys.argv[1:2])
+    if not journal.pending():
+        print(f'No edits to compact in {journal.path}')
+        sys.exit(0)
+    locations = journal.compact()
+    print(f'Compacted the edits of {len(locations)} images from {journal.path}')
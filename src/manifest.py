@@ -0,0 +1,181 @@
+import fnmatch
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from src.config import *
+
+# A directory listing is only reused if the directory was modified at least this long before it was listed, so that
+# files created within the resolution of the file system timestamps are never missed
+RACY_INTERVAL_NS = 2_000_000_000
+
+
+class Manifest:
+    """ A persistent manifest pairing the images with their annotation files by the file name stem.
+
+    The listings of the image and the annotation directories are stored together with the modification times of the
+    directories. A directory is only listed again with `os.scandir` if it was modified since, which is the case
+    whenever a file was added, removed or renamed in it.
+
+    Attributes:
+        image_dir (Path): The directory containing the images.
+        annotation_dir (Path): The directory containing the .xml annotation files.
+        path (Path): The path to the persisted manifest file.
+        images (Dict[str, str]): The image file names by their stems.
+        annotations (Dict[str, str]): The annotation file names by their stems.
+        duplicates (List[str]): The image file names skipped because another image has the same stem.
+    """
+
+    def __init__(self, image_dir: str = IMAGE_DIR, annotation_dir: str = ANNOTATION_DIR, path: str = MANIFEST_PATH):
+        """ Initialize the instance. The directories are not scanned until `scan` is called.
+
+        Args:
+            image_dir (str): The directory containing the images.
+            annotation_dir (str): The directory containing the .xml annotation files.
+            path (str): The path to the persisted manifest file.
+        """
+        self.image_dir = Path(image_dir)
+        self.annotation_dir = Path(annotation_dir)
+        self.path = Path(path)
+        self.images = {}
+        self.annotations = {}
+        self.duplicates = []
+        self._listings = {}
+
+    @property
+    def pairs(self) -> List[Tuple[Path, Path]]:
+        """ Get the annotated images sorted by the stem.
+
+        Returns:
+            pairs (List[Tuple[Path, Path]]): The list of (image path, annotation path) tuples.
+        """
+        return [
+            (Path(self.image_dir, self.images[stem]), Path(self.annotation_dir, self.annotations[stem]))
+            for stem in sorted(self.images.keys() & self.annotations.keys())
+        ]
+
+    @property
+    def unannotated(self) -> List[Path]:
+        """ Get the images that do not have an annotation file.
+
+        Returns:
+            unannotated (List[Path]): The sorted list of image paths.
+        """
+        return [Path(self.image_dir, self.images[stem]) for stem in sorted(self.images.keys() - self.annotations.keys())]
+
+    @property
+    def orphans(self) -> List[Path]:
+        """ Get the annotation files that do not have an image.
+
+        Returns:
+            orphans (List[Path]): The sorted list of annotation file paths.
+        """
+        return [
+            Path(self.annotation_dir, self.annotations[stem])
+            for stem in sorted(self.annotations.keys() - self.images.keys())
+        ]
+
+    def scan(self) -> 'Manifest':
+        """ Update the manifest from the directories and persist it.
+
+        Only the directories modified since the last scan are listed again.
+
+        Returns:
+            manifest (Manifest): The manifest itself.
+        """
+        self._load()
+
+        image_names = self._list('images', self.image_dir, IMAGE_EXTENSIONS)
+        annotation_names = self._list('annotations', self.annotation_dir, ['*.xml'])
+
+        # The stem of an image is paired with the first matching extension in the order of IMAGE_EXTENSIONS
+        self.images = {}
+        self.duplicates = []
+        priority = {name: min(i for i, pattern in enumerate(IMAGE_EXTENSIONS) if fnmatch.fnmatch(name, pattern))
+                    for name in image_names}
+        for name in sorted(image_names, key=lambda name: (priority[name], name)):
+            stem = Path(name).stem
+            if stem in self.images:
+                self.duplicates.append(name)
+            else:
+                self.images[stem] = name
+
+        self.annotations = {Path(name).stem: name for name in annotation_names}
+
+        self._save()
+        return self
+
+    def _list(self, key: str, directory: Path, patterns: List[str]) -> List[str]:
+        """ List the file names of the directory matching any of the patterns, reusing the persisted listing if the
+        directory was not modified since.
+
+        Args:
+            key (str): The key of the listing in the manifest file.
+            directory (Path): The directory to list.
+            patterns (List[str]): The glob patterns of the file names, e.g. '*.jpg'.
+
+        Returns:
+            names (List[str]): The matching file names.
+        """
+        if not directory.is_dir():
+            self._listings.pop(key, None)
+            return []
+
+        mtime_ns = os.stat(directory).st_mtime_ns
+        listing = self._listings.get(key)
+        if (listing is not None and listing['directory'] == str(directory.resolve())
+                and listing['mtime_ns'] == mtime_ns and listing['listed_ns'] - mtime_ns > RACY_INTERVAL_NS):
+            return listing['names']
+
+        listed_ns = time.time_ns()
+        with os.scandir(directory) as iterator:
+            names = [
+                entry.name for entry in iterator
+                if any(fnmatch.fnmatch(entry.name, pattern) for pattern in patterns) and entry.is_file()
+            ]
+
+        self._listings[key] = {
+            'directory': str(directory.resolve()),
+            'mtime_ns': mtime_ns,
+            'listed_ns': listed_ns,
+            'names': names,
+        }
+        return names
+
+    def _load(self) -> None:
+        """ Read the persisted listings, ignoring a missing or unreadable manifest file.
+
+        Returns:
+            None
+        """
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                self._listings = json.load(file)['listings']
+        except (OSError, ValueError, KeyError):
+            self._listings = {}
+
+    def _save(self) -> None:
+        """ Write the listings to the manifest file through a temporary file, so a crash never leaves a partial file.
+
+        Returns:
+            None
+        """
+        content: Dict[str, Any] = {'listings': self._listings}
+        temporary_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        try:
+            with open(temporary_path, 'w', encoding='utf-8') as file:
+                json.dump(content, file)
+            os.replace(temporary_path, self.path)
+        except OSError:
+            # The manifest is only a cache, so a read-only data directory is not an error
+            pass
+
+
+if __name__ == '__main__':
+    manifest = Manifest().scan()
+    print(f'{len(manifest.pairs)} annotated images, {len(manifest.unannotated)} unannotated images, '
+          f'{len(manifest.orphans)} annotations without an image')
+    for image_path in manifest.unannotated:
+        print(f'Unannotated: {image_path}')
@@ -37,8 +37,16 @@ class MenuBar(QMenuBar):
         help_action.setShortcut('Ctrl+H')
         help_action.triggered.connect(self._show_help)
 
+        # Pre-annotate action
+        self.pre_annotate_action = QAction('Pre-annotate with the model', self)
+        self.pre_annotate_action.setShortcut('Ctrl+P')
+        self.pre_annotate_action.setCheckable(True)
+        self.pre_annotate_action.toggled.connect(self._toggle_pre_annotation)
+
         file_menu = self.addMenu('&File')
         file_menu.addAction(open_action)
+        model_menu = self.addMenu('&Model')
+        model_menu.addAction(self.pre_annotate_action)
         file_menu = self.addMenu('&Help')
         file_menu.addAction(help_action)
 
@@ -52,5 +60,17 @@ class MenuBar(QMenuBar):
         directory_path = QFileDialog.getExistingDirectory(self, 'Select a directory')
         self.main_window.file_view.file_list.update_sub_view(directory_path)
 
+    def _toggle_pre_annotation(self, checked: bool) -> None:
+        """ Turn the pre-annotation mode on or off. The action is unchecked again if there is no trained model.
+
+        Args:
+            checked (bool): The check state of the action.
+
+        Returns:
+            None
+        """
+        if not self.main_window.pre_annotator.set_enabled(checked):
+            self.pre_annotate_action.setChecked(False)
+
     def _show_help(self):
         pass
@@ -0,0 +1,110 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+
+def chunk_ranges(length: int, chunk_size: int) -> List[Tuple[int, int]]:
+    """ Split the positions 0 to length into (start, end) ranges.
+
+    Args:
+        length (int): The number of positions.
+        chunk_size (int): The number of positions per range.
+
+    Returns:
+        chunks (List[Tuple[int, int]]): The ranges.
+    """
+    return [(start, min(start + chunk_size, length)) for start in range(0, length, chunk_size)]
+
+
+def chunked(items: Sequence, chunk_size: int) -> List[Sequence]:
+    """ Split the items into chunks of chunk_size items, the last chunk may be shorter.
+
+    Args:
+        items (Sequence): The items.
+        chunk_size (int): The number of items per chunk.
+
+    Returns:
+        chunks (List[Sequence]): The chunks in order.
+    """
+    return [items[start:end] for start, end in chunk_ranges(len(items), chunk_size)]
+
+
+def worker_count(num_workers: Optional[int], num_tasks: int) -> int:
+    """ Get the number of worker processes for some tasks, never more than the tasks.
+
+    Args:
+        num_workers (Optional[int]): The requested number of worker processes, the number of CPUs by default.
+        num_tasks (int): The number of tasks.
+
+    Returns:
+        num_workers (int): The number of worker processes, the tasks run in the calling process if it is 1 or less.
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    return min(num_workers, num_tasks)
+
+
+def ordered_map(
+        function: Callable,
+        arguments: Iterable[Tuple],
+        num_workers: int,
+        progress: Optional[Callable[[Any], None]] = None,
+) -> Iterator[Any]:
+    """ Map the function over the arguments on a process pool, yielding the results in order.
+
+    At most two tasks per worker are in flight, so the results waiting to be consumed stay bounded however many tasks
+    there are.
+
+    Args:
+        function (Callable): The picklable function.
+        arguments (Iterable[Tuple]): The arguments of every call.
+        num_workers (int): The number of worker processes, the calls run in this process if it is 1 or less.
+        progress (Optional[Callable[[Any], None]]): The callback called with every result before it is yielded.
+
+    Returns:
+        results (Iterator[Any]): The results in the order of the arguments.
+    """
+    if num_workers <= 1:
+        results = (function(*argument) for argument in arguments)
+    else:
+        results = _pool_map(function, arguments, num_workers)
+
+    for result in results:
+        if progress is not None:
+            progress(result)
+        yield result
+
+
+def _pool_map(function: Callable, arguments: Iterable[Tuple], num_workers: int) -> Iterator[Any]:
+    """ Map the function over the arguments on a process pool with at most two tasks per worker in flight.
+
+    Returns:
+        results (Iterator[Any]): The results in the order of the arguments.
+    """
+    # Forking a process which runs threads, e.g. the intra-op threads of PyTorch, can deadlock the children
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(num_workers, mp_context=context) as executor:
+        pending = deque()
+        for argument in arguments:
+            pending.append(executor.submit(function, *argument))
+            if len(pending) >= 2 * num_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def merge_errors(errors: Iterable[Dict[str, str]]) -> Dict[str, str]:
+    """ Merge the error messages of the chunks into one dictionary.
+
+    Args:
+        errors (Iterable[Dict[str, str]]): The error messages of every chunk, by the file name or path.
+
+    Returns:
+        errors (Dict[str, str]): The error messages of all the chunks, in the order of the chunks.
+    """
+    merged = {}
+    for chunk_errors in errors:
+        merged.update(chunk_errors)
+    return merged
@@ -0,0 +1,439 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+try:
+    from PyQt6.QtCore import QObject, pyqtSignal
+    from PyQt6.QtWidgets import QMainWindow
+except ImportError:
+    raise ImportError("Requires PyQt6")
+
+from src.config import *
+
+# A suggestion is a (label, (xmin, ymin, xmax, ymax), score) tuple
+Suggestion = Tuple[str, Tuple[int, int, int, int], float]
+
+# The model of the worker process, loaded once by the initializer
+_model = None
+_classes = None
+
+
+def _init_worker(model_path: str, classes: Sequence[str], num_threads: int, quantization: str) -> None:
+    """ Load the trained model once in every worker process of the pool.
+
+    Args:
+        model_path (str): The path to the saved model weights.
+        classes (Sequence[str]): The label names of the vocabulary, indexed by the class ids.
+        num_threads (int): The number of intra-op threads of the worker.
+        quantization (str): 'fp32', or 'dynamic'/'static' for the weights of an int8 model exported by quantization.py.
+
+    Returns:
+        None
+    """
+    global _model, _classes
+    import torch
+    from anchors import ANCHORS_PATH, load_anchors
+    from rcnn import faster_rcnn
+
+    torch.set_num_threads(num_threads)
+    # The packed weights of the int8 models are not plain tensors
+    state_dict = torch.load(model_path, map_location='cpu', weights_only=quantization == 'fp32')
+    # The vocabulary may have grown after the training, the model only knows the classes it was trained with
+    num_classes = state_dict['roi_heads.box_predictor.cls_score.weight'].shape[0]
+    # The anchors the model was trained with, fitted by anchors.py
+    anchors = load_anchors(Path(BASE_DIR, ANCHORS_PATH))
+    _model = faster_rcnn(num_classes, quantization=quantization, anchors=anchors)
+    _model.load_state_dict(state_dict)
+    _model.eval()
+    _classes = list(classes[:num_classes])
+
+
+def _predict(jobs: List[Tuple[str, str]], score_limit: float) -> List[Tuple[str, List[Suggestion]]]:
+    """ Run the model on a batch of images in a worker process and cache the suggestions.
+
+    Args:
+        jobs (List[Tuple[str, str]]): The image paths and the paths of their cache files.
+        score_limit (float): The minimum score of a suggestion.
+
+    Returns:
+        results (List[Tuple[str, List[Suggestion]]]): The image paths and their suggestions.
+    """
+    import torch
+    from PIL import Image as PILImage
+    from torchvision.transforms.functional import to_tensor
+
+    images = []
+    for image_path, _ in jobs:
+        with PILImage.open(image_path) as image:
+            images.append(to_tensor(image.convert('RGB')))
+
+    with torch.no_grad():
+        responses = _model(images)
+
+    results = []
+    for (image_path, cache_path), response in zip(jobs, responses):
+        keep = response['scores'] >= score_limit
+        suggestions = [
+            (_classes[label] if label < len(_classes) else str(label), tuple(round(value) for value in box), score)
+            for box, label, score in zip(
+                response['boxes'][keep].tolist(), response['labels'][keep].tolist(), response['scores'][keep].tolist()
+            )
+        ]
+        _write_cache(cache_path, suggestions)
+        results.append((image_path, suggestions))
+    return results
+
+
+def _write_cache(cache_path: str, suggestions: List[Suggestion]) -> None:
+    """ Write the suggestions of an image to its cache file through a temporary file.
+
+    Args:
+        cache_path (str): The path to the cache file.
+        suggestions (List[Suggestion]): The suggestions of the image.
+
+    Returns:
+        None
+    """
+    cache_path = Path(cache_path)
+    os.makedirs(cache_path.parent, exist_ok=True)
+    temporary_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.tmp')
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump([{'label': label, 'box': box, 'score': score} for label, box, score in suggestions], file)
+    os.replace(temporary_path, cache_path)
+
+
+def _read_cache(cache_path: Path) -> Optional[List[Suggestion]]:
+    """ Read the cached suggestions of an image.
+
+    Args:
+        cache_path (Path): The path to the cache file.
+
+    Returns:
+        suggestions (Optional[List[Suggestion]]): The suggestions, or None if they are not cached.
+    """
+    try:
+        with open(cache_path, encoding='utf-8') as file:
+            records = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return [(record['label'], tuple(record['box']), record['score']) for record in records]
+
+
+class PreAnnotator(QObject):
+    """ Suggests bounding boxes for the images of the opened directory with the trained model.
+
+    The model runs in a pool of worker processes, which is fed by a background thread, so the GUI thread never waits
+    on the inference. The results are delivered to the GUI thread with the Qt signals. The suggestions of every image
+    are cached on disk by the image and the model file, so reopening a directory does not run the model again. Images
+    which already have an annotation file are skipped.
+
+    Attributes:
+        main_window (QMainWindow): The parent main window.
+        model_path (Path): The path to the saved model weights.
+        cache_dir (Path): The directory of the cached suggestions.
+        num_workers (int): The number of worker processes.
+        batch_size (int): The number of images per inference.
+        score_limit (float): The minimum score of a suggestion.
+        quantization (str): 'fp32', or 'dynamic'/'static' when the model is int8 quantized.
+        enabled (bool): Whether the pre-annotation mode is on.
+        image_paths (List[str]): The paths to the images of the opened directory.
+        suggestions (Dict[str, List[Suggestion]]): The received suggestions by the image paths.
+    """
+
+    # The signals carry the generation of the start call which produced them
+    predicted = pyqtSignal(int, str, list)
+    failed = pyqtSignal(int, str)
+    finished = pyqtSignal(int)
+
+    def __init__(
+            self,
+            main_window: QMainWindow,
+            model_path: str = MODEL_PATH,
+            cache_dir: str = SUGGESTION_DIR,
+            num_workers: int = 2,
+            batch_size: int = 2,
+            score_limit: float = 0.5,
+            quantization: str = 'fp32',
+    ):
+        """ Initialize the instance. The worker processes are started by `start`.
+
+        Args:
+            main_window (QMainWindow): The parent main window.
+            model_path (str): The path to the saved model weights.
+            cache_dir (str): The directory of the cached suggestions.
+            num_workers (int): The number of worker processes.
+            batch_size (int): The number of images per inference.
+            score_limit (float): The minimum score of a suggestion.
+            quantization (str): 'fp32', or 'dynamic'/'static' when the model_path is the weights of an int8 model
+                exported by quantization.py, which needs fewer CPU cores per image.
+        """
+        super().__init__()
+
+        self.main_window = main_window
+        self.model_path = Path(model_path)
+        self.cache_dir = Path(cache_dir)
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.score_limit = score_limit
+        self.quantization = quantization
+        self.enabled = False
+        self.image_paths = []
+        self.suggestions = {}
+
+        self._running = False
+        self._executor = None
+        self._futures = []
+        self._pending = 0
+        # Incremented by every start and stop, so the results of an earlier directory are dropped
+        self._generation = 0
+        # Reentrant, because a future which is already done runs its callback in the submitting thread
+        self._lock = threading.RLock()
+
+        self.predicted.connect(self._on_predicted)
+        self.failed.connect(self._on_failed)
+        self.finished.connect(self._on_finished)
+
+    def set_enabled(self, enabled: bool) -> bool:
+        """ Turn the pre-annotation mode on or off.
+
+        Args:
+            enabled (bool): Whether to pre-annotate the images.
+
+        Returns:
+            bool: True for success, False if the mode could not be turned on
+        """
+        self.enabled = enabled
+        if not enabled:
+            self.stop()
+        elif not self.start(self.image_paths):
+            self.enabled = False
+        return self.enabled == enabled
+
+    def set_images(self, image_paths: List[str]) -> None:
+        """ Set the images of the opened directory and pre-annotate them if the mode is on.
+
+        Args:
+            image_paths (List[str]): The paths to the images.
+
+        Returns:
+            None
+        """
+        self.image_paths = list(image_paths)
+        if self.enabled:
+            self.start(self.image_paths)
+
+    def is_running(self) -> bool:
+        """ Return a boolean indicating if the pre-annotation is running.
+
+        Returns:
+            bool: True if started and not stopped
+        """
+        return self._running
+
+    def start(self, image_paths: List[str]) -> bool:
+        """ Start suggesting the bounding boxes of the images in background. The suggestions found in the cache are
+        delivered first.
+
+        Args:
+            image_paths (List[str]): The paths to the images of the opened directory.
+
+        Returns:
+            bool: True for success, False if there is no trained model
+        """
+        self.stop()
+        if not self.model_path.is_file():
+            self.main_window.statusBar().showMessage(f'No trained model {self.model_path} to pre-annotate with.', 5000)
+            return False
+
+        self._running = True
+        self.suggestions = {}
+        with self._lock:
+            generation = self._generation
+        threading.Thread(
+            target=self._submit, args=(generation, list(image_paths)), name='PreAnnotator', daemon=True
+        ).start()
+        self.main_window.statusBar().showMessage('Pre-annotating the images in background.', 3000)
+        return True
+
+    def stop(self) -> None:
+        """ Stop the pre-annotation without waiting for the running inference.
+
+        Returns:
+            None
+        """
+        self._running = False
+        with self._lock:
+            self._generation += 1
+            futures, self._futures = self._futures, []
+            executor, self._executor = self._executor, None
+        for future in futures:
+            future.cancel()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def cache_path(self, image_path: str) -> Path:
+        """ Get the path to the cache file of an image. The key changes whenever the image or the model changes.
+
+        Args:
+            image_path (str): The path to the image.
+
+        Returns:
+            cache_path (Path): The path to the cache file.
+        """
+        image_stat = os.stat(image_path)
+        model_stat = os.stat(self.model_path)
+        key = '|'.join(map(str, [
+            Path(image_path).resolve(), image_stat.st_mtime_ns, image_stat.st_size,
+            model_stat.st_mtime_ns, model_stat.st_size, self.score_limit,
+        ]))
+        return Path(self.cache_dir, f'{hashlib.sha1(key.encode()).hexdigest()}.json')
+
+    def update(self, image_path: str, suggestions: List[Suggestion]) -> None:
+        """ Replace the suggestions of an image after the annotator has accepted or rejected some of them.
+
+        Args:
+            image_path (str): The path to the image.
+            suggestions (List[Suggestion]): The remaining suggestions.
+
+        Returns:
+            None
+        """
+        self.suggestions[image_path] = list(suggestions)
+
+    def _submit(self, generation: int, image_paths: List[str]) -> None:
+        """ Deliver the cached suggestions and submit the other images to the workers. Runs in a background thread.
+
+        Args:
+            generation (int): The generation of the start call.
+            image_paths (List[str]): The paths to the images.
+
+        Returns:
+            None
+        """
+        try:
+            from src.annotation_store import get_store
+            from src.vocabulary import Vocabulary
+            # Only read, as loading may compile the annotation index and rewrite the vocabulary file
+            classes = Vocabulary.read().classes
+
+            store = get_store()
+            jobs = []
+            for image_path in image_paths:
+                if store.has_annotation(image_path):
+                    continue
+                cache_path = self.cache_path(image_path)
+                suggestions = _read_cache(cache_path)
+                if suggestions is not None:
+                    self.predicted.emit(generation, image_path, suggestions)
+                else:
+                    jobs.append((image_path, str(cache_path)))
+
+            if not jobs:
+                self.finished.emit(generation)
+                return
+
+            num_threads = max(1, (os.cpu_count() or 1) // self.num_workers)
+            with self._lock:
+                if generation != self._generation:
+                    return
+                # Forking the GUI process is not safe
+                executor = ProcessPoolExecutor(
+                    self.num_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(str(self.model_path), classes, num_threads, self.quantization),
+                )
+                self._executor = executor
+                self._pending = -(-len(jobs) // self.batch_size)
+                for start in range(0, len(jobs), self.batch_size):
+                    future = executor.submit(_predict, jobs[start:start + self.batch_size], self.score_limit)
+                    future.add_done_callback(lambda future: self._on_done(future, generation))
+                    self._futures.append(future)
+        except Exception as error:
+            self.failed.emit(generation, str(error))
+
+    def _on_done(self, future: Future, generation: int) -> None:
+        """ Forward the result of a batch to the GUI thread. Runs in the thread of the pool.
+
+        Args:
+            future (Future): The finished batch.
+            generation (int): The generation of the start call.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if generation != self._generation or future.cancelled():
+                return
+            self._pending -= 1
+            last = self._pending == 0
+
+        error = future.exception()
+        if error is not None:
+            self.failed.emit(generation, str(error))
+            return
+        for image_path, suggestions in future.result():
+            self.predicted.emit(generation, image_path, suggestions)
+        if last:
+            self.finished.emit(generation)
+
+    def _on_predicted(self, generation: int, image_path: str, suggestions: List[Suggestion]) -> None:
+        """ Store the suggestions of an image and show them if the image is on the canvas.
+
+        Args:
+            generation (int): The generation of the start call.
+            image_path (str): The path to the image.
+            suggestions (List[Suggestion]): The suggestions of the image.
+
+        Returns:
+            None
+        """
+        if not self._is_current(generation):
+            return
+        self.suggestions[image_path] = suggestions
+        canvas = getattr(self.main_window, 'canvas', None)
+        if canvas is not None and canvas.image.get_path() == image_path:
+            canvas.set_suggestions(suggestions)
+
+    def _on_failed(self, generation: int, message: str) -> None:
+        """ Stop the pre-annotation after an error, e.g. an incompatible model file.
+
+        Args:
+            generation (int): The generation of the start call.
+            message (str): The error message.
+
+        Returns:
+            None
+        """
+        if self._is_current(generation):
+            self.stop()
+            self.main_window.statusBar().showMessage(f'Pre-annotation failed: {message}', 5000)
+
+    def _on_finished(self, generation: int) -> None:
+        """ Report the end of the pre-annotation.
+
+        Args:
+            generation (int): The generation of the start call.
+
+        Returns:
+            None
+        """
+        if self._is_current(generation):
+            self.main_window.statusBar().showMessage('Pre-annotation finished.', 3000)
+
+    def _is_current(self, generation: int) -> bool:
+        """ Return a boolean indicating if a signal comes from the running start call.
+
+        Args:
+            generation (int): The generation of the start call.
+
+        Returns:
+            bool: True if the signal is not from a stopped start call
+        """
+        with self._lock:
+            return self._running and generation == self._generation
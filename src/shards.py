@@ -0,0 +1,187 @@
+import io
+import json
+import os
+import tarfile
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from src.annotation_index import read_annotation
+from src.config import *
+from src.manifest import Manifest
+
+# The file listing the shards and their number of samples
+SHARD_INDEX = 'shards.json'
+
+
+def encode_record(size: Tuple[int, int], labels: List[str], bounding_boxes: List[Tuple[int, int, int, int]]) -> bytes:
+    """ Encode the annotation of an image into the compact record stored in the shards.
+
+    Args:
+        size (Tuple[int, int]): The (width, height) of the image.
+        labels (List[str]): The label names.
+        bounding_boxes (List[Tuple[int, int, int, int]]): The bounding boxes as (xmin, ymin, xmax, ymax).
+
+    Returns:
+        record (bytes): The UTF-8 encoded JSON record.
+    """
+    record = {'size': list(size), 'labels': labels, 'boxes': [list(box) for box in bounding_boxes]}
+    return json.dumps(record, separators=(',', ':')).encode('utf-8')
+
+
+def decode_record(record: bytes) -> Dict[str, Any]:
+    """ Decode a compact annotation record.
+
+    Args:
+        record (bytes): The UTF-8 encoded JSON record.
+
+    Returns:
+        record (Dict[str, Any]): The dictionary with the 'size', the 'labels' and the 'boxes'.
+    """
+    return json.loads(record)
+
+
+class ShardWriter:
+    """ Write samples into consecutive tar shards of a bounded number of samples.
+
+    Every sample is stored as two consecutive members named after the image stem: the original image bytes, e.g.
+    'cat.jpg', and the compact annotation record 'cat.json'.
+
+    Attributes:
+        output_dir (Path): The directory to write the shards to.
+        samples_per_shard (int): The maximum number of samples of a shard.
+        shards (List[Dict[str, Any]]): The names and the sample counts of the written shards.
+    """
+
+    def __init__(self, output_dir: str = SHARD_DIR, samples_per_shard: int = 1000):
+        """ Initialize the instance and create the output directory.
+
+        Args:
+            output_dir (str): The directory to write the shards to.
+            samples_per_shard (int): The maximum number of samples of a shard.
+        """
+        self.output_dir = Path(output_dir)
+        self.samples_per_shard = samples_per_shard
+        self.shards = []
+        self._tar = None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def __enter__(self) -> 'ShardWriter':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def write(self, image_name: str, image_bytes: bytes, record: bytes) -> None:
+        """ Append a sample to the current shard, starting a new shard if it is full.
+
+        Args:
+            image_name (str): The file name of the image, e.g. 'cat.jpg'.
+            image_bytes (bytes): The encoded image.
+            record (bytes): The compact annotation record.
+
+        Returns:
+            None
+        """
+        if self._tar is None or self.shards[-1]['count'] >= self.samples_per_shard:
+            self._next_shard()
+
+        for name, content in [(image_name, image_bytes), (f'{Path(image_name).stem}.json', record)]:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            self._tar.addfile(info, io.BytesIO(content))
+        self.shards[-1]['count'] += 1
+
+    def close(self) -> None:
+        """ Close the current shard and write the shard index.
+
+        Returns:
+            None
+        """
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+        with open(Path(self.output_dir, SHARD_INDEX), 'w', encoding='utf-8') as file:
+            json.dump({'shards': self.shards}, file)
+
+    def _next_shard(self) -> None:
+        """ Close the current shard and open the next one.
+
+        Returns:
+            None
+        """
+        if self._tar is not None:
+            self._tar.close()
+        name = f'shard-{len(self.shards):06d}.tar'
+        self._tar = tarfile.open(Path(self.output_dir, name), 'w')
+        self.shards.append({'name': name, 'count': 0})
+
+
+def export_shards(
+        output_dir: str = SHARD_DIR,
+        samples_per_shard: int = 1000,
+        pairs: Optional[Sequence[Tuple[Path, Path]]] = None,
+) -> List[Dict[str, Any]]:
+    """ Pack the annotated images into tar shards. The images are stored as they are, without decoding.
+
+    Args:
+        output_dir (str): The directory to write the shards to.
+        samples_per_shard (int): The maximum number of samples of a shard.
+        pairs (Optional[Sequence[Tuple[Path, Path]]]): The (image path, annotation path) pairs to export. By default
+            the pairs of the manifest of the data directory.
+
+    Returns:
+        shards (List[Dict[str, Any]]): The names and the sample counts of the written shards.
+    """
+    if pairs is None:
+        pairs = Manifest().scan().pairs
+
+    with ShardWriter(output_dir, samples_per_shard) as writer:
+        for image_path, annotation_path in pairs:
+            with open(image_path, 'rb') as file:
+                image_bytes = file.read()
+            writer.write(Path(image_path).name, image_bytes, encode_record(*read_annotation(annotation_path)))
+
+    return writer.shards
+
+
+def read_shard_index(shard_dir: str = SHARD_DIR) -> List[Dict[str, Any]]:
+    """ Read the names and the sample counts of the shards of a directory.
+
+    Args:
+        shard_dir (str): The directory containing the shards.
+
+    Returns:
+        shards (List[Dict[str, Any]]): The names and the sample counts of the shards.
+    """
+    with open(Path(shard_dir, SHARD_INDEX), encoding='utf-8') as file:
+        return json.load(file)['shards']
+
+
+def iterate_shard(shard_path: str) -> Iterator[Tuple[str, bytes, bytes]]:
+    """ Read the samples of a shard sequentially in a single pass.
+
+    Args:
+        shard_path (str): The path to the shard.
+
+    Yields:
+        Tuple[image_name, image_bytes, record]
+    """
+    image_name, image_bytes = None, None
+    with tarfile.open(shard_path, 'r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            content = tar.extractfile(member).read()
+            if member.name.endswith('.json'):
+                if image_name is not None and Path(image_name).stem == Path(member.name).stem:
+                    yield image_name, image_bytes, content
+                image_name, image_bytes = None, None
+            else:
+                image_name, image_bytes = member.name, content
+
+
+if __name__ == '__main__':
+    shards = export_shards()
+    print(f'Exported {sum(shard["count"] for shard in shards)} samples into {len(shards)} shards in {SHARD_DIR}')
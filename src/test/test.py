@@ -1,12 +1,36 @@
+import json
 import os
 import sys
+import tempfile
+import time
 import unittest
 from PIL import Image
 from pathlib import Path
+import numpy as np
+import torch
 
 from PyQt6.QtWidgets import QApplication
 
-from src.writer import Writer
+from src.annotation_index import AnnotationIndex
+from src.annotation_store import SqliteStore, XmlStore, read_voc
+from src.autosave import AutoSaver
+from src.bulk_loader import load_annotations
+from src.exporters import export_coco, export_yolo
+from src.image import Image as AnnotatedImage
+from src.journal import Journal, apply_record
+from src.image_cache import ImageCache
+from src.manifest import Manifest
+from src.shards import export_shards
+from src.validator import DUPLICATE, INVERTED, UNKNOWN_LABEL, fix_annotations, validate_annotations
+from src.vocabulary import Vocabulary
+from src.watcher import DirectoryWatcher
+from src.writer import Writer, serialize_annotation, write_annotations
+from checkpoint import CheckpointManager
+from anchors import DEFAULT_ANCHORS, anchor_fitness, kmeans_iou, load_boxes, propose_anchors
+from dataset import ShardDataset
+from metrics import DetectionEvaluator
+from quantization import fold_batch_norms
+from sampler import GroupedBatchSampler, create_groups
 from src.utils import *
 from src.file_list import *
 
@@ -33,6 +57,32 @@ class TestExport(unittest.TestCase):
         self.assertTrue(Path(file_path).is_file())
         os.remove(file_path)
 
+    def test_fast_writer(self):
+        writer = Writer('images/a&b.jpg', 300, 200)
+        writer.add_object('cat', 1, 2, 3, 4)
+        writer.add_object('dog', 5, 6, 7, 8)
+        writer.add_label_color_dict('cat', 'ffffff')
+        file_path = writer.save('test.xml')
+        with open(file_path, encoding='utf-8') as file:
+            expected = file.read()
+        os.remove(file_path)
+
+        self.assertEqual(expected, serialize_annotation(
+            'images/a&b.jpg', 300, 200, ['cat', 'dog'], [(1, 2, 3, 4), (5, 6, 7, 8)], {'cat': 'ffffff'}
+        ))
+
+        with tempfile.TemporaryDirectory() as directory:
+            annotations = [
+                {'path': Path(directory, f'{index}.xml'), 'image_path': f'{index}.jpg', 'width': 30, 'height': 20,
+                 'labels': ['cat'], 'bounding_boxes': [(index, 1, 10, 11)]}
+                for index in range(3)
+            ]
+            annotations.append({**annotations[0], 'path': Path(directory, 'missing', 'a.xml')})
+            errors = write_annotations(annotations, num_workers=0, chunk_size=2)
+            self.assertEqual([str(Path(directory, 'missing', 'a.xml'))], list(errors))
+            self.assertEqual(['0.xml', '1.xml', '2.xml'], sorted(os.listdir(directory)))
+            self.assertEqual([(2, 1, 10, 11)], load_annotation_file(Path(directory, '2.xml'))[1])
+
     def test_annotations_content(self):
         label, x1, y1, x2, y2 = 'test_object', 100, 50, 200, 250
         label_color_dict = {label: 'ffffff'}
@@ -48,6 +98,14 @@ class TestExport(unittest.TestCase):
         self.assertEqual((x1, y1, x2, y2), result_bounding_boxes[0])
         self.assertEqual(label_color_dict, result_label_color_dict)
 
+        self.assertEqual(
+            (result_labels, result_bounding_boxes, result_label_color_dict), load_annotation_file(file_path)
+        )
+        labels, bounding_boxes, _ = parse_annotation(file_path)
+        self.assertEqual([label], labels)
+        self.assertEqual([[x1, y1, x2, y2]], bounding_boxes.tolist())
+        self.assertEqual(parse_xml(ET.parse(file_path).getroot()), parse_annotation_xml(file_path))
+
         os.remove(file_path)
 
 
@@ -85,6 +143,569 @@ class TestImport(unittest.TestCase):
         self.assertEqual(length, 3)
 
 
+class TestAnnotationIndex(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.annotation_dir = Path(self.temp_dir.name, 'annotations')
+        self.index_path = Path(self.temp_dir.name, 'annotations.idx')
+        os.mkdir(self.annotation_dir)
+
+        for name, objects in [('a', [('cat', 1, 2, 3, 4), ('dog', 5, 6, 7, 8)]), ('b', []), ('c', [('dog', 0, 0, 9, 9)])]:
+            writer = Writer(f'{name}.jpg', 300, 200)
+            for label, x1, y1, x2, y2 in objects:
+                writer.add_object(label, x1, y1, x2, y2)
+            writer.save(Path(self.annotation_dir, f'{name}.xml'))
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_index_content(self):
+        index = AnnotationIndex.load(self.annotation_dir, self.index_path)
+
+        boxes, labels = index.get('a')
+        self.assertEqual([[1, 2, 3, 4], [5, 6, 7, 8]], boxes.tolist())
+        self.assertEqual({'boxes': [[0, 0, 9, 9]], 'labels': ['dog']},
+                         {**index.get_target('c'), 'boxes': index.get_target('c')['boxes'].tolist()})
+        self.assertEqual((0, 4), index.get('b')[0].shape)
+        self.assertEqual([300, 200], index.arrays['sizes'][index.row('a')].tolist())
+
+    def test_index_rebuild(self):
+        index = AnnotationIndex.load(self.annotation_dir, self.index_path)
+        self.assertFalse(index.is_stale(self.annotation_dir))
+
+        writer = Writer('b.jpg', 300, 200)
+        writer.add_object('bird', 10, 10, 20, 20)
+        writer.save(Path(self.annotation_dir, 'b.xml'))
+        os.utime(Path(self.annotation_dir, 'b.xml'), ns=(0, 0))
+
+        self.assertTrue(index.is_stale(self.annotation_dir))
+        index = AnnotationIndex.load(self.annotation_dir, self.index_path)
+        self.assertEqual(['bird'], index.get_target('b')['labels'])
+
+    def test_bulk_load(self):
+        Path(self.annotation_dir, 'd.xml').write_text('<annotation><object>')
+        progress = []
+
+        # One file per chunk, so the label ids of the chunks are merged
+        annotations = load_annotations(self.annotation_dir, num_workers=0, chunk_size=1,
+                                       progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(['a', 'b', 'c'], list(annotations))
+        self.assertEqual(['cat', 'dog'], annotations.classes)
+        self.assertEqual(['dog'], annotations.label_names('c'))
+        self.assertEqual([[0, 0, 9, 9]], annotations['c'][0].tolist())
+        self.assertEqual({'cat': 1, 'dog': 2}, annotations.class_counts())
+        self.assertEqual(['d.xml'], list(annotations.errors))
+        self.assertEqual((4, 4), progress[-1])
+
+    def test_vocabulary(self):
+        vocabulary_path = Path(self.temp_dir.name, 'classes.json')
+        vocabulary = Vocabulary.load(vocabulary_path, self.annotation_dir, self.index_path)
+        self.assertEqual(['background', 'cat', 'dog'], vocabulary.classes)
+
+        writer = Writer('d.jpg', 300, 200)
+        writer.add_object('ant', 1, 1, 2, 2)
+        writer.save(Path(self.annotation_dir, 'd.xml'))
+
+        # The existing labels keep their ids
+        vocabulary = Vocabulary.load(vocabulary_path, self.annotation_dir, self.index_path)
+        self.assertEqual(['background', 'cat', 'dog', 'ant'], vocabulary.classes)
+        index = AnnotationIndex(self.index_path)
+        self.assertEqual([1, 2], index.get_target('a', vocabulary.encode(index.classes))['labels'].tolist())
+        self.assertRaises(KeyError, vocabulary.encode, ['bird'])
+
+
+class TestValidator(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.annotation_dir = Path(self.temp_dir.name, 'annotations')
+        self.index_path = Path(self.temp_dir.name, 'annotations.idx')
+        os.mkdir(self.annotation_dir)
+
+        objects = {
+            'a': [('cat', 1, 2, 3, 4), ('cat', 3, 4, 1, 2), ('dog', 5, 5, 5, 9), ('dog', -5, 190, 20, 250)],
+            'b': [('cat', 1, 1, 9, 9)],
+            'c': [('Cat', 1, 1, 9, 9)],
+        }
+        for name, boxes in objects.items():
+            writer = Writer(f'{name}.jpg', 300, 200)
+            for label, x1, y1, x2, y2 in boxes:
+                writer.add_object(label, x1, y1, x2, y2)
+            writer.add_label_color_dict('cat', '#ffffff')
+            writer.save(Path(self.annotation_dir, f'{name}.xml'))
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_validate_and_fix(self):
+        index = AnnotationIndex.load(self.annotation_dir, self.index_path)
+        report = validate_annotations(index, known_labels=['cat', 'dog'])
+        self.assertEqual(
+            {'inverted': 1, 'degenerate': 1, 'out of bounds': 1, 'duplicate': 1, 'unknown label': 1}, report.counts()
+        )
+        self.assertEqual(['a'], report.affected())
+        self.assertEqual(['c'], report.affected(UNKNOWN_LABEL))
+        self.assertEqual(INVERTED | DUPLICATE, report.flags[1])
+
+        result = fix_annotations(report, self.annotation_dir, num_workers=0)
+        self.assertEqual({'fixed': 1, 'removed': 2, 'errors': {}}, result)
+        self.assertEqual(
+            (['cat', 'dog'], [(1, 2, 3, 4), (0, 190, 20, 200)], {'cat': '#ffffff'}),
+            XmlStore(self.annotation_dir).load('a.jpg')
+        )
+        index = AnnotationIndex.load(self.annotation_dir, self.index_path)
+        self.assertEqual(1, len(validate_annotations(index, known_labels=['cat', 'dog'])))
+
+
+class TestAnnotationStore(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store = SqliteStore(Path(self.temp_dir.name, 'annotations.db'))
+
+    def tearDown(self) -> None:
+        self.store.close()
+        self.temp_dir.cleanup()
+
+    def test_save_load(self):
+        self.assertIsNone(self.store.load('a.jpg'))
+        self.store.save('/images/a.jpg', 300, 200, ['cat', 'dog'], [(1, 2, 3, 4), (5, 6, 7, 8)], {'cat': '#ffffff'})
+        self.store.save('/images/b.jpg', 300, 200, ['dog'], [(0, 0, 9, 9)], {'dog': '#000000'})
+        self.store.save('/images/a.jpg', 300, 200, ['cat'], [(1, 2, 3, 4)], {'cat': '#ffffff'})
+
+        self.assertEqual((['cat'], [(1, 2, 3, 4)], {'cat': '#ffffff'}), self.store.load('a.png'))
+        self.assertEqual({'cat': 1, 'dog': 1}, self.store.label_counts())
+        self.assertEqual(['b'], self.store.images_with_label('dog'))
+        self.assertEqual(['c.jpg'], self.store.unannotated(['a.jpg', 'c.jpg']))
+
+    def test_voc_round_trip(self):
+        annotation_dir = Path(self.temp_dir.name, 'annotations')
+        export_dir = Path(self.temp_dir.name, 'export')
+        os.mkdir(annotation_dir)
+        XmlStore(annotation_dir).save('a.jpg', 300, 200, ['cat'], [(1, 2, 3, 4)], {'cat': '#ffffff'})
+        # The elements of other tools are kept too
+        Path(annotation_dir, 'b.xml').write_text(
+            '<annotation><filename>b.jpg</filename><size><width>5</width><height>5</height></size>'
+            '<object><name>dog</name><difficult>1</difficult>'
+            '<bndbox><xmin>1</xmin><ymin>1</ymin><xmax>2</xmax><ymax>2</ymax></bndbox></object>'
+            '<segmented>0</segmented></annotation>'
+        )
+
+        self.assertEqual((2, {}), self.store.import_voc(annotation_dir))
+        self.assertEqual(2, self.store.export_voc(export_dir))
+        for name in ('a', 'b'):
+            self.assertEqual(read_voc(Path(annotation_dir, f'{name}.xml')), read_voc(Path(export_dir, f'{name}.xml')))
+
+    def test_save_keeps_object_extra(self):
+        annotation_dir = Path(self.temp_dir.name, 'annotations')
+        export_dir = Path(self.temp_dir.name, 'export')
+        os.mkdir(annotation_dir)
+        Path(annotation_dir, 'b.xml').write_text(
+            '<annotation><filename>b.jpg</filename><size><width>5</width><height>5</height></size>'
+            '<object><name>dog</name><difficult>1</difficult>'
+            '<bndbox><xmin>1</xmin><ymin>1</ymin><xmax>2</xmax><ymax>2</ymax></bndbox></object></annotation>'
+        )
+        self.store.import_voc(annotation_dir)
+
+        # Saved by the annotator with the unchanged box and a new box
+        labels, bounding_boxes, label_color_dict = self.store.load('b.jpg')
+        self.store.save('b.jpg', 5, 5, labels + ['cat'], bounding_boxes + [(0, 0, 3, 3)], label_color_dict)
+        self.store.export_voc(export_dir)
+        objects = read_voc(Path(export_dir, 'b.xml'))['objects']
+        self.assertEqual([('dog', (1, 1, 2, 2)), ('cat', (0, 0, 3, 3))], [(label, box) for label, box, _ in objects])
+        self.assertIn('<difficult>1</difficult>', objects[0][2])
+        self.assertEqual('', objects[1][2])
+
+        # A moved box no longer carries the elements
+        self.store.save('b.jpg', 5, 5, ['dog'], [(1, 1, 3, 3)], {})
+        self.store.export_voc(export_dir)
+        self.assertEqual('', read_voc(Path(export_dir, 'b.xml'))['objects'][0][2])
+
+
+class TestAutoSaver(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.image_path = str(Path(self.temp_dir.name, 'a.jpg'))
+        Image.new('RGB', (30, 20)).save(self.image_path)
+        self.store = XmlStore(self.temp_dir.name)
+        self.journal = Journal(Path(self.temp_dir.name, 'journal.jsonl'))
+        self.saver = AutoSaver(store=self.store, journal=self.journal)
+
+    def tearDown(self) -> None:
+        self.saver.stop()
+        self.temp_dir.cleanup()
+
+    def test_save_changed(self):
+        image = AnnotatedImage(self.image_path)
+        self.assertFalse(image.is_dirty())
+        self.assertIsNone(self.saver.save(image))
+
+        image.add_label('cat')
+        image.bounding_boxes.append((1, 2, 3, 4))
+        image.label_color_dict['cat'] = '#ffffff'
+        image.mark_dirty()
+        self.saver.record(image, 'insert', label='cat', box=(1, 2, 3, 4), color='#ffffff')
+        self.assertTrue(self.journal.pending())
+        self.saver.flush()
+        self.assertFalse(image.is_dirty())
+        self.assertFalse(self.journal.pending())
+        self.assertEqual((['cat'], [(1, 2, 3, 4)], {'cat': '#ffffff'}), self.store.load(self.image_path))
+
+        # Unchanged annotations are not written again
+        self.assertIsNone(self.saver.save(image))
+        self.assertIsNotNone(self.saver.save(image, force=True))
+
+    def test_journal_recovery(self):
+        records = [
+            {'op': 'insert', 'label': 'cat', 'box': [1, 2, 3, 4], 'color': '#ffffff', 'count': 1},
+            {'op': 'insert', 'label': 'dog', 'box': [5, 6, 7, 8], 'color': '#000000', 'count': 2},
+            {'op': 'undo', 'label': 'dog', 'count': 1},
+            {'op': 'insert', 'label': 'cat', 'box': [0, 0, 9, 9], 'color': '#ffffff', 'count': 2},
+        ]
+        for record in records:
+            self.journal.append({'image': self.image_path, 'size': [30, 20], **record})
+        # A crash during the last append
+        self.journal.close()
+        with open(self.journal.path, 'a', encoding='utf-8') as file:
+            file.write('{"op": "reset"')
+
+        AutoSaver(store=self.store, journal=self.journal).stop()
+        expected = (['cat', 'cat'], [(1, 2, 3, 4), (0, 0, 9, 9)], {'cat': '#ffffff'})
+        self.assertEqual(expected, self.store.load(self.image_path))
+        self.assertFalse(self.journal.pending())
+
+        # Folding the edits again after an interrupted compaction gives the same annotation
+        annotation = self.store.load(self.image_path)
+        for record in records:
+            apply_record(annotation, record)
+        self.assertEqual(expected, annotation)
+
+
+class TestDirectoryWatcher(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.watcher = DirectoryWatcher(delay=50)
+        self.batches = []
+        self.watcher.changed.connect(lambda directory, changes: self.batches.append((directory, changes)))
+
+    def tearDown(self) -> None:
+        self.watcher.stop()
+        self.temp_dir.cleanup()
+
+    def test_coalesced_changes(self):
+        directory = os.path.abspath(self.temp_dir.name)
+        Path(directory, 'a.jpg').touch()
+        self.assertTrue(self.watcher.watch(directory))
+
+        for index in range(100):
+            Path(directory, f'b{index}.jpg').touch()
+        os.rename(Path(directory, 'a.jpg'), Path(directory, 'c.jpg'))
+        os.remove(Path(directory, 'b0.jpg'))
+
+        deadline = time.time() + 5
+        while not self.batches and time.time() < deadline:
+            self.app.processEvents()
+            time.sleep(0.01)
+        self.assertEqual(1, len(self.batches))
+        changes = self.batches[0][1]
+        self.assertEqual(directory, self.batches[0][0])
+        self.assertEqual(102, len(changes))
+        self.assertEqual([False, False, True, True], [changes[name] for name in ('a.jpg', 'b0.jpg', 'b1.jpg', 'c.jpg')])
+
+
+class TestExporters(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        annotation_dir = Path(self.temp_dir.name, 'annotations')
+        os.mkdir(annotation_dir)
+        annotations = [('a', [('cat', 10, 20, 30, 60), ('dog', 50, 50, 0, 0)]), ('b', []), ('c', [('dog', 1, 1, 2, 2)])]
+        for name, objects in annotations:
+            writer = Writer(f'{name}.jpg', 100, 200)
+            for label, x1, y1, x2, y2 in objects:
+                writer.add_object(label, x1, y1, x2, y2)
+            writer.save(Path(annotation_dir, f'{name}.xml'))
+
+        self.index = AnnotationIndex.load(annotation_dir, Path(self.temp_dir.name, 'annotations.idx'))
+        self.vocabulary = Vocabulary(['background', 'dog', 'cat'])
+        # The image of c is missing
+        self.image_names = {'a': 'a.jpg', 'b': 'b.png'}
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_coco(self):
+        path = Path(self.temp_dir.name, 'coco.json')
+        counts = export_coco(path, self.index, self.vocabulary, self.image_names, num_workers=0, chunk_size=1)
+        self.assertEqual({'images': 2, 'annotations': 2, 'skipped': 1}, counts)
+
+        with open(path, encoding='utf-8') as file:
+            coco = json.load(file)
+        self.assertEqual([{'id': 1, 'name': 'dog'}, {'id': 2, 'name': 'cat'}], coco['categories'])
+        self.assertEqual(['a.jpg', 'b.png'], [image['file_name'] for image in coco['images']])
+        self.assertEqual([[10, 20, 20, 40], [0, 0, 50, 50]], [annotation['bbox'] for annotation in coco['annotations']])
+        self.assertEqual([2, 1], [annotation['category_id'] for annotation in coco['annotations']])
+
+    def test_yolo(self):
+        output_dir = Path(self.temp_dir.name, 'yolo')
+        counts = export_yolo(output_dir, self.index, self.vocabulary, self.image_names, num_workers=0)
+        self.assertEqual({'images': 2, 'annotations': 2, 'skipped': 1}, counts)
+
+        self.assertEqual('dog\ncat\n', Path(output_dir, 'classes.txt').read_text())
+        self.assertEqual('1 0.200000 0.200000 0.200000 0.200000\n0 0.250000 0.125000 0.500000 0.250000\n',
+                         Path(output_dir, 'a.txt').read_text())
+        self.assertEqual('', Path(output_dir, 'b.txt').read_text())
+        self.assertFalse(Path(output_dir, 'c.txt').exists())
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.image_dir = Path(self.temp_dir.name, 'images')
+        self.annotation_dir = Path(self.temp_dir.name, 'annotations')
+        self.manifest_path = Path(self.temp_dir.name, 'manifest.json')
+        os.mkdir(self.image_dir)
+        os.mkdir(self.annotation_dir)
+
+        for name in ['b.jpg', 'a.png', 'c.jpeg', 'notes.txt']:
+            Path(self.image_dir, name).touch()
+        for name in ['a.xml', 'b.xml', 'd.xml']:
+            Path(self.annotation_dir, name).touch()
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_manifest_pairs(self):
+        manifest = Manifest(self.image_dir, self.annotation_dir, self.manifest_path).scan()
+
+        self.assertEqual(
+            [(Path(self.image_dir, 'a.png'), Path(self.annotation_dir, 'a.xml')),
+             (Path(self.image_dir, 'b.jpg'), Path(self.annotation_dir, 'b.xml'))],
+            manifest.pairs
+        )
+        self.assertEqual([Path(self.image_dir, 'c.jpeg')], manifest.unannotated)
+        self.assertEqual([Path(self.annotation_dir, 'd.xml')], manifest.orphans)
+
+    def test_manifest_rescan(self):
+        Manifest(self.image_dir, self.annotation_dir, self.manifest_path).scan()
+        self.assertTrue(self.manifest_path.is_file())
+
+        Path(self.annotation_dir, 'c.xml').touch()
+        manifest = Manifest(self.image_dir, self.annotation_dir, self.manifest_path).scan()
+
+        self.assertEqual([], manifest.unannotated)
+        self.assertEqual(3, len(manifest.pairs))
+
+
+class TestImageCache(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.image_paths = []
+        for index, size in enumerate([(300, 200), (50, 80), (120, 120)]):
+            image_path = Path(self.temp_dir.name, f'{index}.png')
+            Image.new('RGB', size, (index, 100, 200)).save(image_path)
+            self.image_paths.append(image_path)
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_cache_content(self):
+        cache_dir = Path(self.temp_dir.name, 'cache')
+        cache = ImageCache.build(self.image_paths, cache_dir, max_size=100, images_per_shard=2, num_workers=1)
+
+        self.assertEqual(3, len(cache))
+        self.assertEqual((67, 100, 3), cache[0].shape)
+        self.assertEqual((80, 50, 3), cache[1].shape)
+        self.assertEqual([2, 100, 200], cache[2][0, 0].tolist())
+        self.assertEqual((0.333, 0.335), tuple(round(scale, 3) for scale in cache.scale(0)))
+        self.assertEqual(cache.key, ImageCache.load(self.image_paths, cache_dir, 100).key)
+        self.assertEqual(None, ImageCache.load(self.image_paths, cache_dir, None, num_workers=1).max_size)
+
+
+class TestGroupedBatchSampler(unittest.TestCase):
+
+    def test_batches_grouped(self):
+        sizes = [(300, 200), (200, 300), (310, 200), (200, 310), (300, 210), (100, 100)]
+        group_ids = create_groups(sizes)
+        batches = list(GroupedBatchSampler(range(len(sizes)), group_ids, 2))
+
+        self.assertEqual(len(batches), len(GroupedBatchSampler(range(len(sizes)), group_ids, 2)))
+        self.assertEqual(list(range(len(sizes))), sorted(index for batch in batches for index in batch))
+        self.assertIn([0, 2], batches)
+        self.assertIn([1, 3], batches)
+        for batch in batches:
+            self.assertEqual(1, len({group_ids[index] for index in batch}))
+
+    def test_distributed_slices(self):
+        sizes = [(300, 200), (200, 300), (310, 200), (200, 310), (300, 210), (100, 100)]
+        group_ids = create_groups(sizes)
+        indices = []
+        for rank in range(2):
+            sampler = torch.utils.data.DistributedSampler(range(len(sizes)), num_replicas=2, rank=rank)
+            batch_sampler = GroupedBatchSampler(sampler, group_ids, 2)
+            batches = list(batch_sampler)
+            self.assertEqual(len(batches), len(batch_sampler))
+            indices += [index for batch in batches for index in batch]
+        self.assertEqual(list(range(len(sizes))), sorted(indices))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_average_precision(self):
+        boxes = [[0, 0, 10, 10], [50, 50, 60, 60], [20, 20, 30, 30]]
+        gt_boxes = [[0, 0, 10, 10], [20, 20, 30, 30]]
+
+        # The false positive is ranked between the true positives
+        evaluator = DetectionEvaluator('voc', class_names=['background', 'cat'])
+        evaluator.add(boxes, [1, 1, 1], [.9, .8, .7], gt_boxes, [1, 1])
+        report = evaluator.summary()
+        self.assertAlmostEqual(.5 + .5 * 2 / 3, report['classes']['cat']['AP'], places=5)
+        self.assertEqual(1., report['classes']['cat']['recall_per_threshold']['0.50'])
+
+        evaluator = DetectionEvaluator('coco')
+        evaluator.add(boxes, [1, 1, 1], [.9, .8, .7], gt_boxes, [1, 1])
+        self.assertAlmostEqual((51 + 50 * 2 / 3) / 101, evaluator.summary()['mAP'], places=5)
+
+    def test_iou_thresholds(self):
+        evaluator = DetectionEvaluator('coco')
+        # IoU 0.9 matches below the threshold 0.95 only, the wrong class never
+        evaluator.add([[0, 0, 10, 10], [0, 0, 10, 10]], [2, 3], [.5, .5], [[0, 0, 10, 9]], [2])
+        report = evaluator.summary()
+        self.assertEqual(1., report['mAP_per_threshold']['0.90'])
+        self.assertEqual(0., report['mAP_per_threshold']['0.95'])
+        self.assertIsNone(report['classes']['3']['AP'])
+        self.assertAlmostEqual(.9, report['mAP'], places=5)
+
+
+class TestAnchors(unittest.TestCase):
+
+    def setUp(self) -> None:
+        generator = np.random.default_rng(0)
+        self.shapes = np.array([[20, 40], [60, 60], [200, 100], [400, 800]], dtype=float)
+        self.wh = np.concatenate([shape * generator.uniform(.95, 1.05, (100, 2)) for shape in self.shapes])
+
+    def test_kmeans_iou(self):
+        centroids = kmeans_iou(self.wh, 4)
+        self.assertTrue(np.allclose(self.shapes, centroids, rtol=.05))
+
+    def test_propose_anchors(self):
+        anchors = propose_anchors(self.wh)
+        self.assertEqual(5, len(anchors['sizes']))
+        self.assertTrue(all(len(ratios) == 3 for ratios in anchors['aspect_ratios']))
+        self.assertGreater(anchor_fitness(self.wh, anchors)[0], anchor_fitness(self.wh, DEFAULT_ANCHORS)[0])
+
+    def test_load_boxes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            writer = Writer('a.jpg', 400, 600)
+            writer.add_object('cat', 10, 20, 110, 70)
+            writer.save(Path(directory, 'a.xml'))
+            # Without a size, the scale of the image is unknown
+            Path(directory, 'b.xml').write_text(
+                '<annotation><object><name>cat</name>'
+                '<bndbox><xmin>1</xmin><ymin>1</ymin><xmax>5</xmax><ymax>5</ymax></bndbox></object></annotation>'
+            )
+            wh = load_boxes(directory, Path(directory, 'annotations.idx'))
+        self.assertEqual([[200., 100.]], wh.tolist())
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.model = torch.nn.Linear(2, 1)
+        self.optimizer = torch.optim.SGD(self.model.parameters(), lr=0.1)
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def save(self, checkpoints, epoch, step):
+        with torch.no_grad():
+            self.model.bias.fill_(epoch * 1000 + step)
+        checkpoints.save(self.model, self.optimizer, epoch, step)
+        checkpoints.wait()
+
+    def test_retention_and_resume(self):
+        checkpoints = CheckpointManager(self.temp_dir.name, keep=2)
+        for epoch in range(5):
+            self.save(checkpoints, epoch, 0)
+        self.assertEqual(['checkpoint-0003-00000000.pt', 'checkpoint-0004-00000000.pt'],
+                         [path.name for path in checkpoints.paths()])
+        # A damaged newest checkpoint is skipped
+        Path(self.temp_dir.name, 'checkpoint-0005-00000000.pt').write_bytes(b'broken')
+        self.assertEqual(4, checkpoints.load_latest()['epoch'])
+
+        # A new run does not resume from, nor prune its checkpoints by, the earlier run
+        checkpoints.clear()
+        self.save(checkpoints, 0, 100)
+        state = checkpoints.load_latest()
+        self.assertEqual((0, 100), (state['epoch'], state['step']))
+        self.assertEqual(100, state['model']['bias'].item())
+        checkpoints.close()
+
+        with self.assertRaises(ValueError):
+            CheckpointManager(self.temp_dir.name, keep=0)
+
+
+class TestQuantization(unittest.TestCase):
+
+    def test_fold_batch_norms(self):
+        from torchvision.ops.misc import FrozenBatchNorm2d
+
+        torch.manual_seed(0)
+        norm = FrozenBatchNorm2d(4)
+        norm.weight.uniform_(.5, 2)
+        norm.bias.normal_()
+        norm.running_mean.normal_()
+        norm.running_var.uniform_(.5, 2)
+        module = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3, bias=False), norm, torch.nn.ReLU())
+        x = torch.randn(2, 3, 8, 8)
+
+        with torch.no_grad():
+            expected = module(x)
+            fold_batch_norms(module)
+            self.assertIsInstance(module[1], torch.nn.Identity)
+            self.assertTrue(torch.allclose(expected, module(x), atol=1e-5))
+
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.pairs = []
+        for index in range(5):
+            image_path = Path(self.temp_dir.name, f'{index}.png')
+            annotation_path = Path(self.temp_dir.name, f'{index}.xml')
+            Image.new('RGB', (30, 20)).save(image_path)
+            writer = Writer(str(image_path), 30, 20)
+            writer.add_object(f'label{index}', index, 1, 10, 11)
+            writer.save(annotation_path)
+            self.pairs.append((image_path, annotation_path))
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_shards_round_trip(self):
+        shard_dir = Path(self.temp_dir.name, 'shards')
+        shards = export_shards(shard_dir, 2, self.pairs)
+        self.assertEqual([2, 2, 1], [shard['count'] for shard in shards])
+
+        dataset = ShardDataset(shard_dir, buffer_size=3)
+        samples = list(dataset)
+        self.assertEqual(5, len(dataset))
+        self.assertEqual(5, len(samples))
+        for img, target in samples:
+            index = int(target['labels'][0][len('label'):])
+            self.assertEqual((30, 20), img.size)
+            self.assertEqual([[index, 1, 10, 11]], target['boxes'].tolist())
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -1,13 +1,20 @@
 import collections
+import os
+import sys
+import timeit
 from typing import Dict, Any, List, Tuple
 
 import xml.etree.ElementTree as ET
 
+import numpy as np
+
 try:
     from PyQt6.QtGui import QColor
 except ImportError:
     raise ImportError("Requires PyQt6")
 
+from src.config import *
+
 
 def parse_xml(node: ET.Element) -> Dict[str, Any]:
     """ Parse the xml of the given node
@@ -78,3 +85,123 @@ def parse_annotation_dict(result_dict: Dict[str, Any]) -> \
         label_color_dict = dict_list
 
     return labels, bounding_boxes, label_color_dict
+
+
+def parse_annotation(path: str) -> Tuple[List[str], np.ndarray, Dict[str, str]]:
+    """ Parse an annotation file into the labels, the bounding boxes and the label colors in a single pass
+
+    Only the direct children of the root are visited, and the coordinates are converted once into a flat list which
+    becomes the box array, without the intermediate dictionaries of parse_xml. Files without a color_dict element give
+    an empty color map.
+
+    Args:
+        path (str): The path to the .xml annotation file.
+
+    Returns:
+        Tuple[labels, bounding_boxes, label_color_dict]: The label names, the (N, 4) int32 array of
+            [xmin, ymin, xmax, ymax] and the dictionary of the hexadecimal colors of the labels.
+    """
+    labels = []
+    coordinates = []
+    label_color_dict = {}
+
+    for element in ET.parse(path).getroot():
+        tag = element.tag
+        if tag == 'object':
+            labels.append(element.findtext('name', '').strip())
+            bounding_box = element.find('bndbox')
+            coordinates.append(int(bounding_box.findtext('xmin')))
+            coordinates.append(int(bounding_box.findtext('ymin')))
+            coordinates.append(int(bounding_box.findtext('xmax')))
+            coordinates.append(int(bounding_box.findtext('ymax')))
+        elif tag == 'color_dict':
+            label_color_dict.update(element.attrib)
+
+    return labels, np.array(coordinates, dtype=np.int32).reshape(-1, 4), label_color_dict
+
+
+def parse_annotation_xml(path: str) -> Dict[str, Any]:
+    """ Parse an annotation file into the same nested dictionary as parse_xml(ET.parse(path).getroot())
+
+    The children of the root are visited once like in parse_annotation, the label colors are taken from the
+    attributes directly and only the other elements are converted by parse_xml, so the elements of other tools, e.g.
+    the <difficult> of an object, are kept.
+
+    Args:
+        path (str): The path to the .xml annotation file.
+
+    Returns:
+        result_dict (Dict[str, Any]): The dictionary of the 'annotation' with the list of its objects.
+    """
+    children: Dict[str, List[Any]] = collections.defaultdict(list)
+    for element in ET.parse(path).getroot():
+        if element.tag == 'color_dict':
+            children['color_dict'].append(element.attrib)
+            continue
+        for tag, value in parse_xml(element).items():
+            children[tag].append(value)
+
+    annotation = {tag: values[0] if len(values) == 1 else values for tag, values in children.items() if tag != 'object'}
+    annotation['object'] = children['object']
+    return {'annotation': annotation}
+
+
+def load_annotation_file(path: str) -> \
+        Tuple[
+            List[str],
+            List[Tuple[int, int, int, int]],
+            Dict[str, str]
+        ]:
+    """ Parse an annotation file into the same result as parse_annotation_dict(parse_xml(...)), using parse_annotation
+
+    Args:
+        path (str): The path to the .xml annotation file.
+
+    Returns:
+        Tuple[labels, bounding_boxes, label_color_dict]: The bounding boxes are a list of (x1, y1, x2, y2) tuples.
+    """
+    labels, bounding_boxes, label_color_dict = parse_annotation(path)
+    return labels, list(map(tuple, bounding_boxes.tolist())), label_color_dict
+
+
+def benchmark_parsers(annotation_dir: str = ANNOTATION_DIR, number: int = 10, repeat: int = 5) -> Dict[str, float]:
+    """ Time parse_annotation against parse_xml with parse_annotation_dict on the annotation files
+
+    The files which parse_annotation_dict cannot read, e.g. without a color_dict element, are skipped.
+
+    Args:
+        annotation_dir (str): The directory containing the .xml annotation files.
+        number (int): The number of passes over the files per measurement.
+        repeat (int): The number of measurements, of which the fastest is kept.
+
+    Returns:
+        Dict[str, float]: The microseconds per file of both parsers.
+    """
+    paths = []
+    for file_name in sorted(os.listdir(annotation_dir)):
+        path = os.path.join(annotation_dir, file_name)
+        if file_name.endswith('.xml'):
+            try:
+                parse_annotation_dict(parse_xml(ET.parse(path).getroot()))
+            except (KeyError, TypeError, ValueError):
+                continue
+            paths.append(path)
+    if not paths:
+        raise ValueError(f'No annotation files to parse in {annotation_dir}')
+
+    parsers = {
+        'parse_xml': lambda path: parse_annotation_dict(parse_xml(ET.parse(path).getroot())),
+        'parse_annotation': parse_annotation,
+    }
+    results = {}
+    for name, parser in parsers.items():
+        seconds = min(timeit.repeat(lambda: [parser(path) for path in paths], number=number, repeat=repeat))
+        results[name] = seconds / number / len(paths) * 1e6
+    return results
+
+
+if __name__ == '__main__':
+    results = benchmark_parsers(*sys.argv[1:2])
+    for name, microseconds in results.items():
+        print(f'{name}: {microseconds:.1f} us per file')
+    print(f'Speedup {results["parse_xml"] / results["parse_annotation"]:.2f}x')
@@ -0,0 +1,342 @@
+import os
+import sys
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from src.annotation_index import AnnotationIndex
+from src.annotation_store import read_voc, write_voc
+from src.config import *
+from src.parallel import chunked, merge_errors, ordered_map, worker_count
+from src.vocabulary import Vocabulary
+
+# The problems of a box, one bit each
+INVERTED = 1
+DEGENERATE = 2
+OUT_OF_BOUNDS = 4
+DUPLICATE = 8
+UNKNOWN_LABEL = 16
+PROBLEMS = {
+    INVERTED: 'inverted',
+    DEGENERATE: 'degenerate',
+    OUT_OF_BOUNDS: 'out of bounds',
+    DUPLICATE: 'duplicate',
+    UNKNOWN_LABEL: 'unknown label',
+}
+# The problems the fix mode repairs, the unknown labels need a decision of the annotator
+FIXABLE = INVERTED | DEGENERATE | OUT_OF_BOUNDS | DUPLICATE
+
+# The number of files fixed by a worker per task
+CHUNK_SIZE = 256
+
+
+def normalize_boxes(boxes: np.ndarray) -> np.ndarray:
+    """ Order the corners of the boxes, so every box is [xmin, ymin, xmax, ymax] however it was drawn.
+
+    Args:
+        boxes (np.ndarray): The (N, 4) boxes as (x1, y1, x2, y2).
+
+    Returns:
+        boxes (np.ndarray): The (N, 4) normalized boxes.
+    """
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    return np.concatenate([np.minimum(boxes[:, :2], boxes[:, 2:]), np.maximum(boxes[:, :2], boxes[:, 2:])], axis=1)
+
+
+def check_boxes(
+        boxes: np.ndarray,
+        labels: np.ndarray,
+        offsets: np.ndarray,
+        sizes: np.ndarray,
+        unknown: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """ Find the problems of all the boxes at once, in the layout of the annotation index.
+
+    A box is inverted if a max corner is before its min corner, and degenerate if it has no area. It is out of bounds
+    if it reaches outside of the image, which is only checked for the images with a size. It is a duplicate if an
+    earlier box of the same image has the same label and the same normalized corners.
+
+    Args:
+        boxes (np.ndarray): The (N, 4) boxes of all the images.
+        labels (np.ndarray): The (N,) label ids.
+        offsets (np.ndarray): The (F + 1,) start of the boxes of every image.
+        sizes (np.ndarray): The (F, 2) (width, height) of every image.
+        unknown (Optional[np.ndarray]): Whether every label id is unknown, None not to check the labels.
+
+    Returns:
+        flags (np.ndarray): The (N,) uint8 problem bits of every box, 0 for the valid boxes.
+    """
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    labels = np.asarray(labels)
+    image_ids = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    normalized = normalize_boxes(boxes)
+    flags = np.zeros(len(boxes), dtype=np.uint8)
+
+    flags[(boxes[:, 0] > boxes[:, 2]) | (boxes[:, 1] > boxes[:, 3])] |= INVERTED
+    flags[((normalized[:, 2:] - normalized[:, :2]) <= 0).any(axis=1)] |= DEGENERATE
+
+    size = np.asarray(sizes, dtype=np.int64).reshape(-1, 2)[image_ids]
+    known_size = (size > 0).all(axis=1)
+    outside = (normalized[:, :2] < 0).any(axis=1) | (normalized[:, 2:] > size).any(axis=1)
+    flags[outside & known_size] |= OUT_OF_BOUNDS
+
+    flags[_repeated(np.column_stack([image_ids, labels, normalized]))] |= DUPLICATE
+
+    if unknown is not None:
+        flags[np.asarray(unknown, dtype=bool)[labels]] |= UNKNOWN_LABEL
+    return flags
+
+
+def _repeated(keys: np.ndarray) -> np.ndarray:
+    """ Find the rows equal to an earlier row.
+
+    The equal rows are next to each other once sorted, and the stable sort keeps the first of them in front. If the
+    ranges of the columns fit, the columns are packed into one int64 key, which sorts several times faster than
+    sorting by every column.
+
+    Args:
+        keys (np.ndarray): The (N, K) int64 rows.
+
+    Returns:
+        repeated (np.ndarray): The (N,) boolean mask of the repeated rows.
+    """
+    repeated = np.zeros(len(keys), dtype=bool)
+    if len(keys) < 2:
+        return repeated
+
+    low = keys.min(axis=0)
+    bits = [int(span).bit_length() for span in (keys.max(axis=0) - low).tolist()]
+    if sum(bits) <= 63:
+        packed = np.zeros(len(keys), dtype=np.int64)
+        for column, width in enumerate(bits):
+            packed = (packed << width) | (keys[:, column] - low[column])
+        order = np.argsort(packed, kind='stable')
+        sorted_keys = packed[order]
+        repeated[order[1:][sorted_keys[1:] == sorted_keys[:-1]]] = True
+    else:
+        order = np.lexsort(keys.T[::-1])
+        sorted_keys = keys[order]
+        repeated[order[1:][(sorted_keys[1:] == sorted_keys[:-1]).all(axis=1)]] = True
+    return repeated
+
+
+def fix_boxes(boxes: np.ndarray, labels: Sequence[str], size: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    """ Repair the boxes of one image: normalize them, clip them to the image and drop the degenerate and duplicate
+    ones, like `check_boxes` finds them.
+
+    Args:
+        boxes (np.ndarray): The (N, 4) boxes as (x1, y1, x2, y2).
+        labels (Sequence[str]): The label names of the boxes.
+        size (Tuple[int, int]): The (width, height) of the image, (0, 0) if unknown.
+
+    Returns:
+        Tuple[boxes, keep]: The (N, 4) repaired boxes and the (N,) boolean mask of the boxes to keep.
+    """
+    boxes = normalize_boxes(np.asarray(boxes, dtype=np.int64))
+    width, height = size
+    if width > 0 and height > 0:
+        boxes = np.clip(boxes, 0, [width, height, width, height])
+
+    keep = ((boxes[:, 2:] - boxes[:, :2]) > 0).all(axis=1)
+    label_ids = {}
+    keys = np.column_stack([[label_ids.setdefault(label, len(label_ids)) for label in labels], boxes]).reshape(-1, 5)
+    first = np.zeros(len(boxes), dtype=bool)
+    first[np.unique(keys, axis=0, return_index=True)[1]] = True
+    return boxes, keep & first
+
+
+class ValidationReport:
+    """ The problems of the boxes found by `validate_annotations`.
+
+    Attributes:
+        names (List[str]): The file name stems of the annotation files, one per image.
+        classes (List[str]): The label names, indexed by the label ids.
+        boxes (np.ndarray): The (N, 4) boxes of all the images.
+        labels (np.ndarray): The (N,) label ids.
+        offsets (np.ndarray): The (F + 1,) start of the boxes of every image.
+        flags (np.ndarray): The (N,) problem bits of every box.
+    """
+
+    def __init__(
+            self,
+            names: List[str],
+            classes: List[str],
+            boxes: np.ndarray,
+            labels: np.ndarray,
+            offsets: np.ndarray,
+            flags: np.ndarray,
+    ):
+        self.names = names
+        self.classes = classes
+        self.boxes = boxes
+        self.labels = labels
+        self.offsets = offsets
+        self.flags = flags
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.flags))
+
+    def counts(self) -> Dict[str, int]:
+        """ Count the boxes of every problem. A box can have several problems.
+
+        Returns:
+            counts (Dict[str, int]): The number of boxes by the problem name.
+        """
+        return {name: int(np.count_nonzero(self.flags & flag)) for flag, name in PROBLEMS.items()}
+
+    def affected(self, problems: int = FIXABLE) -> List[str]:
+        """ Get the annotation files with the given problems.
+
+        Args:
+            problems (int): The problem bits, e.g. INVERTED | DUPLICATE.
+
+        Returns:
+            names (List[str]): The file name stems of the files.
+        """
+        rows = np.flatnonzero(self.flags & problems)
+        image_ids = np.unique(np.searchsorted(self.offsets, rows, side='right') - 1)
+        return [self.names[image_id] for image_id in image_ids.tolist()]
+
+    def problems(self, limit: Optional[int] = None) -> Iterator[Tuple[str, int, str, Tuple[int, ...], List[str]]]:
+        """ List the boxes with problems.
+
+        Args:
+            limit (Optional[int]): The maximum number of boxes to list.
+
+        Returns:
+            problems (Iterator[Tuple[str, int, str, Tuple[int, ...], List[str]]]): The file name stem, the position of
+                the box in the file, the label, the box and the problem names.
+        """
+        rows = np.flatnonzero(self.flags)[:limit]
+        image_ids = np.searchsorted(self.offsets, rows, side='right') - 1
+        for row, image_id in zip(rows.tolist(), image_ids.tolist()):
+            flags = int(self.flags[row])
+            yield (
+                self.names[image_id], row - int(self.offsets[image_id]), self.classes[self.labels[row]],
+                tuple(self.boxes[row].tolist()), [name for flag, name in PROBLEMS.items() if flags & flag]
+            )
+
+
+def validate_annotations(
+        index: Optional[AnnotationIndex] = None,
+        known_labels: Optional[Sequence[str]] = None,
+) -> ValidationReport:
+    """ Check every box of the annotations in a few vectorized passes over the compiled annotation index.
+
+    Args:
+        index (Optional[AnnotationIndex]): The annotation index, by default the index of the annotation directory,
+            which is compiled if it is out of date.
+        known_labels (Optional[Sequence[str]]): The valid label names, by default the labels of the persisted
+            vocabulary, so the labels which would become new classes are reported. The labels are not checked if
+            there is no vocabulary yet.
+
+    Returns:
+        report (ValidationReport): The problems of the boxes.
+    """
+    if index is None:
+        index = AnnotationIndex.load()
+    if known_labels is None:
+        known_labels = Vocabulary.read().classes[1:] or None
+
+    unknown = None
+    if known_labels is not None:
+        known_labels = set(known_labels)
+        unknown = np.array([not label.strip() or label not in known_labels for label in index.classes], dtype=bool)
+
+    arrays = index.arrays
+    flags = check_boxes(arrays['boxes'], arrays['labels'], arrays['offsets'], arrays['sizes'], unknown)
+    return ValidationReport(index.names, index.classes, arrays['boxes'], arrays['labels'], arrays['offsets'], flags)
+
+
+def _fix_chunk(annotation_dir: str, names: List[str]) -> Tuple[int, int, Dict[str, str]]:
+    """ Repair the boxes of a chunk of annotation files in a worker, keeping the other elements of the files.
+
+    Args:
+        annotation_dir (str): The directory containing the .xml annotation files.
+        names (List[str]): The file name stems of the chunk.
+
+    Returns:
+        Tuple[fixed, removed, errors]: The number of rewritten files and removed boxes, and the error messages of the
+            files which could not be fixed, by the file name.
+    """
+    fixed = 0
+    removed = 0
+    errors = {}
+    for name in names:
+        path = os.path.join(annotation_dir, f'{name}.xml')
+        try:
+            record = read_voc(path)
+            objects = record['objects']
+            boxes, keep = fix_boxes(
+                np.array([box for _, box, _ in objects], dtype=np.int64).reshape(-1, 4),
+                [label for label, _, _ in objects],
+                (record['width'], record['height']),
+            )
+            record['objects'] = [
+                (label, tuple(box), extra)
+                for (label, _, extra), box, kept in zip(objects, boxes.tolist(), keep.tolist()) if kept
+            ]
+            write_voc(path, record)
+        except (ET.ParseError, OSError, AttributeError, TypeError, ValueError) as error:
+            errors[f'{name}.xml'] = f'{type(error).__name__}: {error}'
+            continue
+        fixed += 1
+        removed += len(objects) - len(record['objects'])
+    return fixed, removed, errors
+
+
+def fix_annotations(
+        report: Optional[ValidationReport] = None,
+        annotation_dir: str = ANNOTATION_DIR,
+        num_workers: Optional[int] = None,
+        chunk_size: int = CHUNK_SIZE,
+) -> Dict[str, object]:
+    """ Rewrite the annotation files with inverted, degenerate, out of bounds or duplicate boxes in parallel.
+
+    The boxes are normalized and clipped to the image, and the degenerate and the duplicate boxes are removed. Every
+    file is written atomically. The unknown labels are left as they are.
+
+    Args:
+        report (Optional[ValidationReport]): The report of the annotation directory, validated by default.
+        annotation_dir (str): The directory containing the .xml annotation files.
+        num_workers (Optional[int]): The number of worker processes, the number of CPUs by default. A single chunk
+            is fixed in the calling process.
+        chunk_size (int): The number of files fixed by a worker per task.
+
+    Returns:
+        result (Dict[str, object]): The number of 'fixed' files and 'removed' boxes and the 'errors' by the file name.
+    """
+    if report is None:
+        report = validate_annotations(AnnotationIndex.load(annotation_dir))
+    names = report.affected(FIXABLE)
+    chunks = chunked(names, chunk_size)
+    arguments = ((str(annotation_dir), chunk) for chunk in chunks)
+    results = list(ordered_map(_fix_chunk, arguments, worker_count(num_workers, len(chunks))))
+    return {
+        'fixed': sum(fixed for fixed, _, _ in results),
+        'removed': sum(removed for _, removed, _ in results),
+        'errors': merge_errors(chunk_errors for _, _, chunk_errors in results),
+    }
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 or sys.argv[1:] not in ([], ['fix']):
+        print('Usage: python -m src.validator [fix]')
+        sys.exit(1)
+
+    report = validate_annotations()
+    print(f'{len(report)} of {len(report.boxes)} boxes in {len(report.names)} annotation files have problems')
+    for problem, count in report.counts().items():
+        print(f'    {problem}: {count}')
+    for name, position, label, box, problems in report.problems(limit=20):
+        print(f'{name}.xml box {position} {label} {box}: {", ".join(problems)}')
+
+    if sys.argv[1:] == ['fix'] and len(report):
+        result = fix_annotations(report)
+        print(f'Fixed {result["fixed"]} annotation files, removed {result["removed"]} boxes')
+        for file_name, error in result['errors'].items():
+            print(f'Failed to fix {file_name}: {error}')
+        report = validate_annotations()
+        print(f'{len(report)} boxes have problems left')
+    sys.exit(1 if len(report) else 0)
@@ -0,0 +1,142 @@
+import json
+import os
+from pathlib import Path
+from typing import Iterable, Iterator, List, Sequence
+
+import numpy as np
+
+from src.annotation_index import AnnotationIndex
+from src.config import *
+
+# The id 0 is reserved for the background class of the detection models
+BACKGROUND = 'background'
+
+
+class Vocabulary:
+    """ The mapping between the label names and the class ids used for training.
+
+    The id 0 is the background and the labels keep their ids once assigned, so a trained model stays valid when new
+    labels are added to the annotations.
+
+    Attributes:
+        classes (List[str]): The label names, indexed by the class ids.
+    """
+
+    def __init__(self, classes: Sequence[str] = (BACKGROUND,)):
+        """ Initialize the instance given the label names in the order of their ids.
+
+        Args:
+            classes (Sequence[str]): The label names, starting with the background.
+        """
+        self.classes = list(classes)
+        self._ids = {label: class_id for class_id, label in enumerate(self.classes)}
+
+    def __len__(self) -> int:
+        return len(self.classes)
+
+    def __contains__(self, label: str) -> bool:
+        return label in self._ids
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.classes)
+
+    def __getitem__(self, label: str) -> int:
+        """ Get the class id of a label.
+
+        Args:
+            label (str): The label name.
+
+        Returns:
+            class_id (int): The class id.
+        """
+        try:
+            return self._ids[label]
+        except KeyError:
+            raise KeyError(f'Unknown label {label!r}, rebuild the vocabulary with Vocabulary.load()') from None
+
+    def extend(self, labels: Iterable[str]) -> List[str]:
+        """ Add the new labels in sorted order after the existing ones.
+
+        Args:
+            labels (Iterable[str]): The label names.
+
+        Returns:
+            added (List[str]): The labels that were not in the vocabulary.
+        """
+        added = sorted(set(labels) - self._ids.keys())
+        for label in added:
+            self._ids[label] = len(self.classes)
+            self.classes.append(label)
+        return added
+
+    def encode(self, labels: Sequence[str]) -> np.ndarray:
+        """ Get the class ids of the labels. Encoding the label names of the compiled annotation index gives the table
+        translating its label ids into the class ids.
+
+        Args:
+            labels (Sequence[str]): The label names.
+
+        Returns:
+            class_ids (np.ndarray): The int64 class ids.
+        """
+        return np.fromiter((self[label] for label in labels), dtype=np.int64, count=len(labels))
+
+    def save(self, path: str = VOCABULARY_PATH) -> None:
+        """ Write the label names to a JSON file through a temporary file.
+
+        Args:
+            path (str): The path to the vocabulary file.
+
+        Returns:
+            None
+        """
+        path = Path(path)
+        temporary_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            json.dump(self.classes, file, indent=4)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def read(cls, path: str = VOCABULARY_PATH) -> 'Vocabulary':
+        """ Read the persisted vocabulary as it is, without adding the labels of the annotations.
+
+        Args:
+            path (str): The path to the vocabulary file.
+
+        Returns:
+            vocabulary (Vocabulary): The persisted vocabulary, or only the background if there is no file.
+        """
+        if not Path(path).is_file():
+            return cls()
+        with open(path, encoding='utf-8') as file:
+            return cls(json.load(file))
+
+    @classmethod
+    def load(
+            cls,
+            path: str = VOCABULARY_PATH,
+            annotation_dir: str = ANNOTATION_DIR,
+            index_path: str = ANNOTATION_INDEX_PATH,
+    ) -> 'Vocabulary':
+        """ Read the persisted vocabulary and add the labels of the annotations that are not in it yet.
+
+        The labels are collected from the compiled annotation index, which is compiled if it is out of date.
+
+        Args:
+            path (str): The path to the vocabulary file.
+            annotation_dir (str): The directory containing the .xml annotation files.
+            index_path (str): The path to the compiled annotation index.
+
+        Returns:
+            vocabulary (Vocabulary): The vocabulary containing every label of the annotations.
+        """
+        vocabulary = cls.read(path)
+        if vocabulary.extend(AnnotationIndex.load(annotation_dir, index_path).classes) or not Path(path).is_file():
+            vocabulary.save(path)
+        return vocabulary
+
+
+if __name__ == '__main__':
+    vocabulary = Vocabulary.load()
+    for class_id, label in enumerate(vocabulary):
+        print(f'{class_id:4d} {label}')
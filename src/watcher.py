@@ -0,0 +1,249 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+from typing import Dict, Optional
+
+try:
+    from PyQt6.QtCore import QFileSystemWatcher, QObject, QSocketNotifier, QTimer, pyqtSignal
+except ImportError:
+    raise ImportError("Requires PyQt6")
+
+from src.config import *
+
+# The inotify flags, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# A file is reported once it is completely written or moved into the directory, and when it is removed
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_ONLYDIR
+
+# The wd, mask, cookie and len fields of struct inotify_event, followed by the file name of len bytes
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_inotify() -> Optional[ctypes.CDLL]:
+    """ Load the C library providing the inotify functions.
+
+    Returns:
+        libc (Optional[ctypes.CDLL]): The library, or None on the platforms without inotify, e.g. macOS and Windows.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class DirectoryWatcher(QObject):
+    """ Reports the files added, modified, removed or renamed in the watched directories.
+
+    On Linux the changes are read from inotify in the GUI thread whenever the kernel has events, which names the
+    changed files, so a directory is never listed again. The events are coalesced: the first event starts a
+    single-shot timer, and the net change of every file until the timer fires is delivered at once, so a burst of
+    thousands of events updates the file list once. A rename is the removal of the old name and the addition of the new
+    name. On the other platforms, QFileSystemWatcher only tells that a directory changed, so the directory is listed
+    and compared with the previous listing.
+
+    Attributes:
+        delay (int): The milliseconds the events are coalesced for.
+    """
+
+    # The directory and the changed file names, True if the file exists or was modified and False if it was removed.
+    # The changes are None if the kernel dropped events, then the directory has to be listed again
+    changed = pyqtSignal(str, object)
+
+    def __init__(self, parent: Optional[QObject] = None, delay: int = WATCH_DELAY):
+        """ Initialize the instance.
+
+        Args:
+            parent (Optional[QObject]): The parent object.
+            delay (int): The milliseconds the events are coalesced for.
+        """
+        super().__init__(parent)
+
+        self.delay = delay
+
+        # The net changes by the directory, None if the directory has to be listed again
+        self._pending: Dict[str, Optional[Dict[str, bool]]] = {}
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._deliver)
+
+        self._libc = _load_inotify()
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC) if self._libc is not None else -1
+        self._inotify = self._fd >= 0
+        if self._inotify:
+            # The directories by the watch descriptors
+            self._watches: Dict[int, str] = {}
+            self._notifier = QSocketNotifier(self._fd, QSocketNotifier.Type.Read, self)
+            self._notifier.activated.connect(self._read_events)
+        else:
+            # The names and the modification times of the files of every directory
+            self._listings: Dict[str, Dict[str, int]] = {}
+            self._watcher = QFileSystemWatcher(self)
+            self._watcher.directoryChanged.connect(self._on_directory_changed)
+
+    def watch(self, directory: str) -> bool:
+        """ Start reporting the changes of a directory.
+
+        Args:
+            directory (str): The path to the directory.
+
+        Returns:
+            bool: True for success, False if the directory cannot be watched
+        """
+        directory = os.path.abspath(directory)
+        if directory in self.directories():
+            return True
+        if self._inotify:
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK) if self._fd >= 0 else -1
+            if wd < 0:
+                return False
+            self._watches[wd] = directory
+            return True
+
+        if not self._watcher.addPath(directory):
+            return False
+        self._listings[directory] = self._list(directory)
+        return True
+
+    def unwatch(self, directory: str) -> None:
+        """ Stop reporting the changes of a directory.
+
+        Args:
+            directory (str): The path to the directory.
+
+        Returns:
+            None
+        """
+        directory = os.path.abspath(directory)
+        self._pending.pop(directory, None)
+        if self._inotify:
+            for wd in [wd for wd, watched in self._watches.items() if watched == directory]:
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._watches[wd]
+        elif directory in self._listings:
+            self._watcher.removePath(directory)
+            del self._listings[directory]
+
+    def directories(self) -> set:
+        """ Get the watched directories.
+
+        Returns:
+            directories (set): The absolute paths to the directories.
+        """
+        return set(self._watches.values()) if self._inotify else set(self._listings)
+
+    def stop(self) -> None:
+        """ Stop watching all the directories and release the inotify instance. No directory can be watched after.
+
+        Returns:
+            None
+        """
+        self._timer.stop()
+        for directory in self.directories():
+            self.unwatch(directory)
+        if self._fd >= 0:
+            self._notifier.setEnabled(False)
+            os.close(self._fd)
+            self._fd = -1
+
+    def _read_events(self, *args: object) -> None:
+        """ Read all the available inotify events and record the net change of every file.
+
+        Returns:
+            None
+        """
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    for directory in self._watches.values():
+                        self._pending[directory] = None
+                    continue
+                directory = self._watches.get(wd)
+                if directory is None:
+                    continue
+                if mask & IN_IGNORED:
+                    # The directory was removed
+                    del self._watches[wd]
+                    continue
+                changes = self._pending.setdefault(directory, {})
+                if changes is not None and name:
+                    changes[name] = not mask & (IN_MOVED_FROM | IN_DELETE)
+
+        if self._pending and not self._timer.isActive():
+            self._timer.start(self.delay)
+
+    def _on_directory_changed(self, directory: str) -> None:
+        """ Compare the directory with its previous listing, on the platforms without inotify.
+
+        Args:
+            directory (str): The changed directory.
+
+        Returns:
+            None
+        """
+        previous = self._listings.get(directory, {})
+        current = self._list(directory)
+        self._listings[directory] = current
+
+        changes = self._pending.setdefault(directory, {})
+        if changes is not None:
+            for name in previous.keys() - current.keys():
+                changes[name] = False
+            for name, mtime_ns in current.items():
+                if previous.get(name) != mtime_ns:
+                    changes[name] = True
+        if not self._timer.isActive():
+            self._timer.start(self.delay)
+
+    @staticmethod
+    def _list(directory: str) -> Dict[str, int]:
+        """ List the files of a directory with their modification times.
+
+        Args:
+            directory (str): The directory.
+
+        Returns:
+            listing (Dict[str, int]): The modification times in nanoseconds by the file name.
+        """
+        try:
+            with os.scandir(directory) as iterator:
+                return {entry.name: entry.stat().st_mtime_ns for entry in iterator if entry.is_file()}
+        except OSError:
+            return {}
+
+    def _deliver(self) -> None:
+        """ Emit the coalesced changes of every directory.
+
+        Returns:
+            None
+        """
+        pending, self._pending = self._pending, {}
+        for directory, changes in pending.items():
+            if changes is None or changes:
+                self.changed.emit(directory, changes)